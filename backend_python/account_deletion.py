@@ -0,0 +1,160 @@
+"""
+RideShare - Account Deletion
+Resumable cascade that removes a deleted user's data
+
+A deleted account is tombstoned immediately and an "account_deletion" job
+runs this cascade. Each step works through its collection in bounded
+batches and checkpoints into the job's state after every batch, so a job
+picked up again after a crash resumes where it stopped. Documents still
+carrying unrelayed events are left for a retry of their step, once the relay
+has emptied their outbox.
+"""
+
+import asyncio
+from datetime import datetime
+
+from bson import ObjectId
+from pymongo import UpdateOne
+
+from events import BOOKING_EVENT_FIELDS, OUTBOX_AT_FIELD, booking_status_event, with_event
+from jobs import Job
+from segments import booking_deltas, negate, seats_update
+
+STEPS = (
+    "ride_series", "rides", "bookings", "private_requests", "chats", "reviews",
+    "rides_archive", "bookings_archive", "chats_archive",
+)
+
+
+class OutboxPending(Exception):
+    """Documents of a step wait for the relay before they can be deleted"""
+
+
+class AccountDeletionCascade:
+    """Job handler deleting everything that belongs to a tombstoned user"""
+
+    def __init__(self, storage, batch_size: int = 500):
+        self.storage = storage
+        self.batch_size = batch_size
+
+    @staticmethod
+    def initial_state() -> dict:
+        return {
+            "checkpoints": {step: None for step in STEPS},
+            "progress": {step: 0 for step in STEPS},
+            "completed_steps": [],
+            "cancelled_bookings": 0,
+        }
+
+    async def run(self, job: Job):
+        remaining = [step for step in STEPS if step not in job.state["completed_steps"]]
+        await asyncio.gather(*(self._run_step(job, step) for step in remaining))
+
+        await self.storage.users.delete_one(
+            {"_id": ObjectId(job.payload["user_id"]), "deleted_at": {"$exists": True}}
+        )
+
+    async def _run_step(self, job: Job, step: str):
+        user_id = job.payload["user_id"]
+        checkpoint = job.state["checkpoints"].get(step)
+        query = self._step_query(step, user_id)
+        collection = getattr(self.storage, step)
+
+        while True:
+            batch_query = dict(query)
+            if checkpoint is not None:
+                batch_query["_id"] = {"$gt": checkpoint}
+            batch = await collection.find(batch_query, self._step_projection(step)) \
+                .sort("_id", 1).to_list(self.batch_size)
+            if not batch:
+                break
+
+            deleted, cancelled = await self._apply(step, user_id, batch)
+            checkpoint = batch[-1]["_id"]
+            await job.save_state(
+                set_fields={f"checkpoints.{step}": checkpoint},
+                inc_fields={f"progress.{step}": deleted, "cancelled_bookings": cancelled},
+            )
+
+        pending = await collection.count_documents({**query, OUTBOX_AT_FIELD: {"$exists": True}})
+        if pending:
+            # Rescan from the start once the job is retried with backoff
+            await job.save_state(set_fields={f"checkpoints.{step}": None})
+            raise OutboxPending(f"{pending} {step} wait for their events to be relayed")
+
+        await job.save_state(add_to_set={"completed_steps": step})
+
+    @staticmethod
+    def _step_query(step: str, user_id: str) -> dict:
+        step = step.replace("_archive", "")
+        if step in ("ride_series", "rides"):
+            return {"driver_id": user_id}
+        if step in ("bookings", "private_requests"):
+            return {"passenger_id": user_id}
+        if step == "chats":
+            return {"$or": [{"sender_id": user_id}, {"receiver_id": user_id}]}
+        return {"$or": [{"reviewer_id": user_id}, {"reviewee_id": user_id}]}
+
+    @staticmethod
+    def _step_projection(step: str) -> dict:
+        if step == "bookings":
+            return {**BOOKING_EVENT_FIELDS, "from_stop": 1, "to_stop": 1}
+        return {"_id": 1}
+
+    async def _apply(self, step: str, user_id: str, batch: list) -> tuple:
+        """Delete one batch; returns how many documents were deleted and how
+        many other users' bookings were cancelled"""
+        ids = [doc["_id"] for doc in batch]
+        cancelled = 0
+
+        if step == "rides":
+            # Passengers booked on the deleted driver's rides keep their booking
+            # history, marked cancelled, instead of pointing at a missing ride
+            bookings = await self.storage.bookings.find(
+                {
+                    "ride_id": {"$in": [str(i) for i in ids]},
+                    "passenger_id": {"$ne": user_id},
+                    "status": {"$in": ["pending", "accepted"]},
+                },
+                BOOKING_EVENT_FIELDS,
+            ).to_list(None)
+            if bookings:
+                now = datetime.utcnow()
+                result = await self.storage.bookings.bulk_write([
+                    UpdateOne(
+                        {"_id": booking["_id"], "status": booking["status"]},
+                        with_event(
+                            {"$set": {"status": "cancelled", "cancel_reason": "driver_account_deleted", "updated_at": now}},
+                            booking_status_event(booking, "cancelled", user_id),
+                        ),
+                    )
+                    for booking in bookings
+                ], ordered=False)
+                cancelled = result.modified_count
+            await self.storage.ride_tracks.delete_many({"_id": {"$in": [str(i) for i in ids]}})
+
+        if step == "bookings":
+            # Give seats held by the deleted passenger back to the rides. The
+            # status flip makes a release happen at most once across retries.
+            # The booking carries its event, so it is deleted on a later pass.
+            for doc in batch:
+                if doc.get("status") not in ("pending", "accepted"):
+                    continue
+                released = await self.storage.bookings.update_one(
+                    {"_id": doc["_id"], "status": doc["status"]},
+                    with_event(
+                        {"$set": {"status": "cancelled", "updated_at": datetime.utcnow()}},
+                        booking_status_event(doc, "cancelled", user_id),
+                    ),
+                )
+                if released.modified_count and doc["status"] == "accepted":
+                    result = await self.storage.rides.update_one(
+                        {"_id": ObjectId(doc["ride_id"])}, seats_update(negate(booking_deltas(doc)))
+                    )
+                    if not result.matched_count:
+                        print(f"WARNING: Ride {doc['ride_id']} of deleted booking {doc['_id']} is gone; no seats released")
+
+        result = await getattr(self.storage, step).delete_many(
+            {"_id": {"$in": ids}, OUTBOX_AT_FIELD: {"$exists": False}}
+        )
+        return result.deleted_count, cancelled
@@ -0,0 +1,196 @@
+"""
+RideShare - Admission Control
+Sheds low-priority requests early when the server is overloaded
+
+Every HTTP request is put in a priority class by its route: ``critical``
+(auth, bookings, health, own profile), ``normal`` or ``low`` (search and
+list endpoints). Each class has a cap on requests in flight; a request over
+its class's cap is answered at once with 503 and ``Retry-After`` instead of
+queueing behind slow database calls.
+
+The caps of the normal and low classes adapt. Every ``interval`` seconds the
+controller measures event-loop lag (how late its own timer fired) and the
+mean latency of critical requests completed since the last tick. When either
+exceeds its target the low cap is cut by ``backoff`` (and the normal cap
+too once a signal exceeds twice its target); when both are healthy the caps
+grow back by one per tick. Critical requests are only bounded by their own
+fixed cap, so booking and login keep working while search is shed.
+
+Normal and low requests also draw from a per-user token bucket (keyed by
+the bearer token's user, else the client address); an empty bucket gives
+429 with the time until the next token in ``Retry-After``.
+"""
+
+import math
+import re
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional, Tuple
+
+from starlette.responses import JSONResponse
+
+CRITICAL, NORMAL, LOW = "critical", "normal", "low"
+CLASSES = (CRITICAL, NORMAL, LOW)
+
+
+class TokenBuckets:
+    """Per-key token buckets refilled at rate tokens/s up to burst, LRU-bounded"""
+
+    def __init__(self, rate: float, burst: float, max_keys: int = 100000):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self._buckets: "OrderedDict[str, List[float]]" = OrderedDict()  # key -> [tokens, updated]
+
+    def take(self, key: str) -> float:
+        """0 if a token was taken, else seconds until one is available"""
+        now = time.monotonic()
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = [self.burst, now]
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        else:
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+            self._buckets.move_to_end(key)
+        if bucket[0] >= 1:
+            bucket[0] -= 1
+            return 0.0
+        return (1 - bucket[0]) / self.rate
+
+    def __len__(self):
+        return len(self._buckets)
+
+
+class AdmissionController:
+    """In-flight caps per priority class, adapted to event-loop lag and critical latency"""
+
+    def __init__(self, routes: List[Tuple[str, str, str]], max_inflight: Dict[str, int],
+                 min_inflight: int = 4, interval: float = 0.5, lag_target_ms: float = 50,
+                 latency_target_ms: float = 250, backoff: float = 0.7, retry_after: int = 1,
+                 user_rate: float = 20, user_burst: float = 40):
+        # (method or "*", path regex, class); the first match wins, unmatched routes are normal
+        self.routes = [(method, re.compile(pattern), cls) for method, pattern, cls in routes]
+        self.max_inflight = {cls: max_inflight.get(cls, 1000) for cls in CLASSES}
+        self.limits = dict(self.max_inflight)
+        self.min_inflight = min_inflight
+        self.interval = interval
+        self.lag_target_ms = lag_target_ms
+        self.latency_target_ms = latency_target_ms
+        self.backoff = backoff
+        self.retry_after = retry_after
+        self.buckets = TokenBuckets(user_rate, user_burst) if user_rate > 0 else None
+        self.inflight = dict.fromkeys(CLASSES, 0)
+        self.admitted = dict.fromkeys(CLASSES, 0)
+        self.shed = dict.fromkeys(CLASSES, 0)
+        self.throttled = dict.fromkeys(CLASSES, 0)
+        self.lag_ms = 0.0
+        self.latency_ms = 0.0
+        self._latency_total = 0.0
+        self._latency_count = 0
+        self._last_tick: Optional[float] = None
+        self._classes: Dict[Tuple[str, str], str] = {}
+
+    def classify(self, method: str, path: str) -> str:
+        key = (method, path)
+        cls = self._classes.get(key)
+        if cls is None:
+            cls = next(
+                (c for m, pattern, c in self.routes if m in ("*", method) and pattern.fullmatch(path)), NORMAL
+            )
+            if len(self._classes) < 10000:  # Paths with ids are unbounded; cache what fits
+                self._classes[key] = cls
+        return cls
+
+    def admit(self, cls: str, client: str) -> Tuple[int, float]:
+        """(0, 0) to admit, else (status, retry after seconds) for the rejection"""
+        if self.inflight[cls] >= self.limits[cls]:
+            self.shed[cls] += 1
+            return 503, self.retry_after
+        if cls != CRITICAL and self.buckets is not None:
+            wait = self.buckets.take(client)
+            if wait:
+                self.throttled[cls] += 1
+                return 429, wait
+        self.inflight[cls] += 1
+        self.admitted[cls] += 1
+        return 0, 0.0
+
+    def release(self, cls: str, started: float):
+        self.inflight[cls] -= 1
+        if cls == CRITICAL:
+            self._latency_total += time.perf_counter() - started
+            self._latency_count += 1
+
+    async def tick(self):
+        """Sample lag and latency, then adapt the caps; called every interval seconds"""
+        now = time.monotonic()
+        if self._last_tick is not None:
+            self.lag_ms = max(now - self._last_tick - self.interval, 0.0) * 1000
+        self._last_tick = now
+        self.latency_ms = self._latency_total / self._latency_count * 1000 if self._latency_count else 0.0
+        self._latency_total, self._latency_count = 0.0, 0
+
+        pressure = max(self.lag_ms / self.lag_target_ms, self.latency_ms / self.latency_target_ms)
+        for cls, threshold in ((LOW, 1), (NORMAL, 2)):
+            if pressure > threshold:
+                self.limits[cls] = max(self.min_inflight, int(self.limits[cls] * self.backoff))
+            elif pressure <= 1:
+                self.limits[cls] = min(self.max_inflight[cls], self.limits[cls] + 1)
+
+    def metrics(self) -> dict:
+        return {
+            "lag_ms": round(self.lag_ms, 1),
+            "critical_latency_ms": round(self.latency_ms, 1),
+            "limits": dict(self.limits),
+            "inflight": dict(self.inflight),
+            "admitted": dict(self.admitted),
+            "shed": dict(self.shed),
+            "throttled": dict(self.throttled),
+            "tracked_users": len(self.buckets) if self.buckets is not None else 0,
+        }
+
+
+class AdmissionMiddleware:
+    """ASGI middleware admitting or rejecting HTTP requests through an AdmissionController.
+
+    ``identify`` maps a bearer token to a user id (or None) for the token
+    buckets; requests without one are bucketed by client address.
+    """
+
+    def __init__(self, app, controller: AdmissionController, identify: Callable[[str], Optional[str]]):
+        self.app = app
+        self.controller = controller
+        self.identify = identify
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        controller = self.controller
+        cls = controller.classify(scope["method"], scope["path"])
+        client = None
+        if cls != CRITICAL and controller.buckets is not None:
+            for name, value in scope["headers"]:
+                if name == b"authorization":
+                    authorization = value.decode("latin-1")
+                    if authorization.lower().startswith("bearer "):
+                        client = self.identify(authorization[7:])
+                    break
+            if client is None:
+                client = scope["client"][0] if scope.get("client") else "unknown"
+
+        status, retry_after = controller.admit(cls, client)
+        if status:
+            detail = "Server is busy, retry later" if status == 503 else "Too many requests"
+            await JSONResponse(
+                {"detail": detail}, status_code=status, headers={"Retry-After": str(max(1, math.ceil(retry_after)))}
+            )(scope, receive, send)
+            return
+
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            controller.release(cls, started)
@@ -0,0 +1,169 @@
+"""
+RideShare - Analytics
+Hourly and daily operational rollups maintained from the event feed
+
+``AnalyticsRollup`` is a durable sink of the event stream: it receives every
+feed event after its saved cursor (the watermark) and folds ride and booking
+events into one document per granularity, time bucket and region (a grid
+cell of the ride's pickup point) with counters for rides posted, seats
+offered and booked, booking requests, acceptances (and the total time they
+took), rejections, completions and cancellations. Ops statistics are read
+from these documents only, never from the rides and bookings collections.
+
+Every rollup document records the sequence number of the last event folded
+into it, and a batch only adds events newer than that, with the update
+guarded on the number it read. A batch delivered again after a crash (the
+cursor is saved after delivery) is therefore not counted twice.
+"""
+
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Tuple
+
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+
+from corridors import cell
+
+GRANULARITIES = ("hour", "day")
+COUNTERS = (
+    "rides_posted", "seats_offered", "rides_cancelled",
+    "bookings_requested", "bookings_accepted", "bookings_rejected", "bookings_cancelled", "bookings_completed",
+    "seats_booked", "acceptance_seconds",
+)
+UNKNOWN_REGION = "unknown"
+
+
+def bucket_start(at: datetime, granularity: str) -> datetime:
+    if granularity == "hour":
+        return at.replace(minute=0, second=0, microsecond=0)
+    return at.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def derived(counts: dict) -> dict:
+    """Rates computed from summed counters"""
+    return {
+        "fill_rate": round(counts["seats_booked"] / counts["seats_offered"], 4) if counts["seats_offered"] else None,
+        "acceptance_rate": (
+            round(counts["bookings_accepted"] / counts["bookings_requested"], 4)
+            if counts["bookings_requested"] else None
+        ),
+        "avg_acceptance_seconds": (
+            round(counts["acceptance_seconds"] / counts["bookings_accepted"], 1)
+            if counts["bookings_accepted"] else None
+        ),
+    }
+
+
+class AnalyticsRollup:
+    """Event sink maintaining the rollups, and the queries over them"""
+
+    def __init__(self, collection, region_degrees: float = 0.5, hourly_retention_days: int = 30,
+                 daily_retention_days: int = 730, name: str = "analytics"):
+        self.collection = collection
+        self.region_degrees = region_degrees
+        self.retention = {"hour": timedelta(days=hourly_retention_days), "day": timedelta(days=daily_retention_days)}
+        self.name = name
+
+    def region(self, data: dict) -> str:
+        lat, lng = data.get("pickup_lat"), data.get("pickup_lng")
+        if lat is None or lng is None:
+            return UNKNOWN_REGION
+        return cell(lat, lng, self.region_degrees)
+
+    @staticmethod
+    def counts(event: dict) -> Dict[str, float]:
+        """Counter increments for one feed event"""
+        data = event["data"]
+        kind = event["type"]
+        if kind == "ride.created":
+            return {"rides_posted": 1, "seats_offered": data.get("seats", 0)}
+        if kind == "ride.cancelled":
+            return {"rides_cancelled": 1}
+        if kind == "booking.created":
+            return {"bookings_requested": 1}
+        if kind != "booking.status_changed":
+            return {}
+
+        to_status = data["to_status"]
+        counts = {f"bookings_{to_status}": 1} if f"bookings_{to_status}" in COUNTERS else {}
+        if to_status == "accepted":
+            counts["seats_booked"] = data["seats"]
+            if data.get("booked_at"):
+                counts["acceptance_seconds"] = max((event["at"] - data["booked_at"]).total_seconds(), 0)
+        elif data["from_status"] == "accepted" and to_status == "cancelled":
+            counts["seats_booked"] = -data["seats"]
+        return counts
+
+    async def deliver(self, events: List[dict]):
+        increments: Dict[str, Tuple[dict, List[Tuple[int, Dict[str, float]]]]] = {}
+        for event in events:
+            counts = self.counts(event)
+            if not counts:
+                continue
+            region = self.region(event["data"])
+            for granularity in GRANULARITIES:
+                bucket = bucket_start(event["at"], granularity)
+                key = f"{granularity}:{bucket.isoformat()}:{region}"
+                fields = {"granularity": granularity, "bucket": bucket, "region": region}
+                increments.setdefault(key, (fields, []))[1].append((event["seq"], counts))
+        if not increments:
+            return
+
+        applied = {
+            doc["_id"]: doc["seq"]
+            for doc in await self.collection.find({"_id": {"$in": list(increments)}}, {"seq": 1}).to_list(None)
+        }
+        now = datetime.utcnow()
+        writes = []
+        for key, (fields, entries) in increments.items():
+            last = applied.get(key)
+            totals: Dict[str, float] = {}
+            for seq, counts in entries:
+                if last is None or seq > last:
+                    for counter, value in counts.items():
+                        totals[counter] = totals.get(counter, 0) + value
+            newest = max(seq for seq, _ in entries)
+            if last is not None and newest <= last:
+                continue
+            writes.append(UpdateOne(
+                {"_id": key, "seq": last if last is not None else {"$exists": False}},
+                {
+                    "$inc": totals,
+                    "$set": {"seq": newest, "updated_at": now},
+                    "$setOnInsert": {**fields, "expires_at": fields["bucket"] + self.retention[fields["granularity"]]},
+                },
+                upsert=True,
+            ))
+        if writes:
+            try:
+                await self.collection.bulk_write(writes, ordered=False)
+            except BulkWriteError as e:
+                # A guard failed (the document moved on) and the upsert collided;
+                # the batch is redelivered and the rest applied then
+                if any(error["code"] != 11000 for error in e.details["writeErrors"]):
+                    raise
+                raise RuntimeError(f"{len(e.details['writeErrors'])} rollups changed concurrently") from e
+
+    # ---- Reading ----
+
+    async def stats(self, granularity: str, start: datetime, end: datetime, region: Optional[str] = None) -> dict:
+        """Rollups in [start, end) per bucket and region, with totals per region and overall"""
+        query = {"granularity": granularity, "bucket": {"$gte": start, "$lt": end}}
+        if region:
+            query["region"] = region
+        docs = await self.collection.find(query).sort([("bucket", 1), ("region", 1)]).to_list(None)
+
+        rows, regions = [], {}
+        total = dict.fromkeys(COUNTERS, 0)
+        for doc in docs:
+            counts = {counter: doc.get(counter, 0) for counter in COUNTERS}
+            rows.append({"bucket": doc["bucket"].isoformat(), "region": doc["region"], **counts, **derived(counts)})
+            region_total = regions.setdefault(doc["region"], dict.fromkeys(COUNTERS, 0))
+            for counter, value in counts.items():
+                region_total[counter] += value
+                total[counter] += value
+        return {
+            "buckets": rows,
+            "regions": [{"region": r, **counts, **derived(counts)} for r, counts in sorted(regions.items())],
+            "totals": {**total, **derived(total)},
+        }
@@ -0,0 +1,147 @@
+"""
+RideShare - Archival
+Moves past rides, bookings and their chats out of the hot collections
+
+Rides and bookings whose ride date is more than ``retention_days`` ago are
+moved by an "archival" job into ``rides_archive`` and ``bookings_archive``,
+and a booking's chat messages move with it into ``chats_archive``. The hot
+collections (and their indexes) then only hold rides that can still be
+searched, booked and talked about; the archives carry just the indexes the
+history reads need.
+
+A batch is copied first (replacing any copy left by an interrupted run) and
+then deleted from the hot collection, each delete matching the version that
+was copied; a document changed in between stays hot and is moved by a later
+run. Documents with events still waiting in the outbox are left for later.
+History reads query the hot collection first and the archive second, so a
+document being moved is seen at least once, and duplicates are dropped.
+Documents are archived by ride date but listed by creation time (a ride can
+be posted long before it happens), so history merges both collections.
+"""
+
+from datetime import datetime, timedelta
+from typing import List, Optional, Tuple
+
+from pymongo import DeleteOne, ReplaceOne
+
+from events import OUTBOX_AT_FIELD
+from jobs import Job
+
+ARCHIVES = {"rides": "rides_archive", "bookings": "bookings_archive", "chats": "chats_archive"}
+STEPS = ("rides", "bookings")
+
+# Field whose value must be unchanged for a copied document to be deleted
+VERSION_FIELDS = {"rides": "updated_at", "bookings": "updated_at", "chats": "read"}
+
+
+class Archiver:
+    """Job handler moving past rides and bookings to the archives, and the read path over both"""
+
+    def __init__(self, storage, retention_days: int = 90, batch_size: int = 500):
+        self.storage = storage
+        self.retention = timedelta(days=retention_days)
+        self.batch_size = batch_size
+
+    def archive(self, name: str):
+        return getattr(self.storage, ARCHIVES[name])
+
+    # ---- Job ----
+
+    async def run(self, job: Job):
+        cutoff = (datetime.utcnow() - self.retention).strftime("%Y-%m-%d")
+        completed = job.state.get("completed_steps", [])
+        for step in STEPS:
+            if step not in completed:
+                await self._run_step(job, step, cutoff)
+
+    async def _run_step(self, job: Job, step: str, cutoff: str):
+        checkpoint = job.state.get("checkpoints", {}).get(step)
+        query = {"date": {"$lt": cutoff}, OUTBOX_AT_FIELD: {"$exists": False}}
+        while True:
+            batch_query = dict(query)
+            if checkpoint is not None:
+                batch_query["_id"] = {"$gt": checkpoint}
+            batch = await getattr(self.storage, step).find(batch_query).sort("_id", 1).to_list(self.batch_size)
+            if not batch:
+                break
+
+            if step == "rides":
+                moved = {"rides": await self._move("rides", batch)}
+            else:
+                moved = await self._move_bookings(batch)
+            checkpoint = batch[-1]["_id"]
+            await job.save_state(
+                set_fields={f"checkpoints.{step}": checkpoint},
+                inc_fields={f"moved.{name}": count for name, count in moved.items()},
+            )
+
+        await job.save_state(add_to_set={"completed_steps": step})
+
+    async def _move_bookings(self, bookings: List[dict]) -> dict:
+        """Move bookings together with their chat messages"""
+        booking_ids = [str(b["_id"]) for b in bookings]
+        chats = await self.storage.chats.find({"booking_id": {"$in": booking_ids}}).to_list(None)
+        pending = {c["booking_id"] for c in chats if OUTBOX_AT_FIELD in c}
+        bookings = [b for b in bookings if str(b["_id"]) not in pending]
+        chats = [c for c in chats if c["booking_id"] not in pending]
+        moved_chats = await self._move("chats", chats)
+        moved_bookings = await self._move("bookings", bookings)
+
+        # Messages sent while the batch was moving would be left behind
+        stragglers = await self.storage.chats.find({
+            "booking_id": {"$in": [str(b["_id"]) for b in bookings]},
+            OUTBOX_AT_FIELD: {"$exists": False},
+        }).to_list(None)
+        moved_chats += await self._move("chats", stragglers)
+        return {"bookings": moved_bookings, "chats": moved_chats}
+
+    async def _move(self, name: str, docs: List[dict]) -> int:
+        """Copy docs to the archive, then delete those still unchanged; returns how many were deleted"""
+        if not docs:
+            return 0
+        now = datetime.utcnow()
+        await self.archive(name).bulk_write(
+            [ReplaceOne({"_id": doc["_id"]}, {**doc, "archived_at": now}, upsert=True) for doc in docs],
+            ordered=False,
+        )
+        version = VERSION_FIELDS[name]
+        result = await getattr(self.storage, name).bulk_write(
+            [DeleteOne({"_id": doc["_id"], version: doc.get(version)}) for doc in docs], ordered=False
+        )
+        return result.deleted_count
+
+    # ---- Reading ----
+
+    async def find_one(self, name: str, query: dict, projection: Optional[dict] = None) -> Optional[dict]:
+        doc = await getattr(self.storage, name).find_one(query, projection)
+        if doc is None:
+            doc = await self.archive(name).find_one(query, projection)
+        return doc
+
+    async def history(self, name: str, query: dict, sort: Tuple[str, int], limit: int,
+                      moved_together: bool = False) -> List[dict]:
+        """Documents matching query from the hot collection and its archive, sorted, at most limit.
+
+        The sort field is not the one documents are archived by, so the first
+        limit of each are merged. With moved_together (all matches are archived
+        at once, like one booking's chat) the archive is only read when the hot
+        collection has none.
+        """
+        field, direction = sort
+        docs = await getattr(self.storage, name).find(query).sort(field, direction).to_list(limit)
+        if moved_together and docs:
+            return docs
+        seen = {doc["_id"] for doc in docs}
+        archived = await self.archive(name).find(query).sort(field, direction).to_list(limit)
+        docs += [doc for doc in archived if doc["_id"] not in seen]
+        docs.sort(key=lambda doc: doc[field], reverse=direction < 0)
+        return docs[:limit]
+
+    async def metrics(self) -> dict:
+        return {
+            name: {
+                "hot": await getattr(self.storage, name).estimated_document_count(),
+                "archived": await self.archive(name).estimated_document_count(),
+            }
+            for name in ARCHIVES
+        }
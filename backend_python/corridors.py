@@ -0,0 +1,171 @@
+"""
+RideShare - Corridors
+Ride and search volume per route corridor, and a warm cache for busy ones
+
+A corridor is a pair of grid cells (origin, destination) of about 5 km. The
+``corridors`` collection holds one rollup document per corridor and travel
+day with the number of rides offered and searches made for that day
+(searches without a date count for the day they are made). Counts are buffered in memory
+and flushed periodically as ``$inc`` upserts, so a search costs no extra
+write and each app server adds only what it saw.
+
+The warmer runs the ride search query for today and tomorrow ahead of time
+and remembers which corridors are the most searched recently. Searches on
+those corridors are answered from the warmed candidates instead of the
+database. An entry is dropped once it is older than the warm interval
+allows, or when this process changes rides of that day; the next search on
+a hot corridor then stores its database result in its place.
+"""
+
+import math
+import time
+from datetime import date, datetime, timedelta
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+from pymongo import UpdateOne
+
+
+def cell(lat: float, lng: float, degrees: float) -> str:
+    """Grid cell containing a point, named by its south-west corner"""
+    return f"{math.floor(lat / degrees) * degrees:.4f},{math.floor(lng / degrees) * degrees:.4f}"
+
+
+class CorridorRollup:
+    """Buffered per-day ride and search counts per corridor"""
+
+    def __init__(self, collection, cell_degrees: float = 0.05, retention_days: int = 90):
+        self.collection = collection
+        self.cell_degrees = cell_degrees
+        self.retention = timedelta(days=retention_days)
+        self._pending: Dict[Tuple[str, str, str], dict] = {}
+
+    def corridor(self, from_lat: float, from_lng: float, to_lat: float, to_lng: float) -> Tuple[str, str]:
+        return cell(from_lat, from_lng, self.cell_degrees), cell(to_lat, to_lng, self.cell_degrees)
+
+    def _count(self, corridor: Tuple[str, str], day: str, field: str, names: Tuple[str, str]):
+        try:
+            date.fromisoformat(day)
+        except ValueError:
+            return
+        counts = self._pending.setdefault((*corridor, day), {"rides": 0, "searches": 0, "names": None})
+        counts[field] += 1
+        if names[0] and names[1]:
+            counts["names"] = names
+
+    def record_rides(self, rides: List[dict]):
+        for ride in rides:
+            corridor = self.corridor(ride["pickup_lat"], ride["pickup_lng"], ride["drop_lat"], ride["drop_lng"])
+            self._count(corridor, ride["date"], "rides", (ride.get("pickup_location"), ride.get("drop_location")))
+
+    def record_search(self, corridor: Tuple[str, str], day: str):
+        self._count(corridor, day, "searches", (None, None))
+
+    async def flush(self) -> int:
+        """Write buffered counts; returns how many corridor-days were updated"""
+        pending, self._pending = self._pending, {}
+        if not pending:
+            return 0
+        now = datetime.utcnow()
+        writes = []
+        for (origin, destination, day), counts in pending.items():
+            update = {
+                "$inc": {"rides": counts["rides"], "searches": counts["searches"]},
+                "$set": {"updated_at": now},
+                "$setOnInsert": {
+                    "origin": origin,
+                    "destination": destination,
+                    "date": day,
+                    "expires_at": datetime.fromisoformat(day) + self.retention,
+                },
+            }
+            if counts["names"]:
+                update["$set"].update({"origin_name": counts["names"][0], "destination_name": counts["names"][1]})
+            writes.append(UpdateOne({"_id": f"{origin}|{destination}|{day}"}, update, upsert=True))
+        try:
+            await self.collection.bulk_write(writes, ordered=False)
+        except Exception:
+            # Keep the counts for the next flush
+            for key, counts in pending.items():
+                merged = self._pending.setdefault(key, {"rides": 0, "searches": 0, "names": None})
+                merged["rides"] += counts["rides"]
+                merged["searches"] += counts["searches"]
+                merged["names"] = merged["names"] or counts["names"]
+            raise
+        return len(writes)
+
+    async def popular(self, start: str, limit: int = 10, by: str = "searches") -> List[dict]:
+        """Corridors with the most searches (or rides) for travel days from start on"""
+        return await self.collection.aggregate([
+            {"$match": {"date": {"$gte": start}}},
+            {"$group": {
+                "_id": {"origin": "$origin", "destination": "$destination"},
+                "rides": {"$sum": "$rides"},
+                "searches": {"$sum": "$searches"},
+                "origin_name": {"$max": "$origin_name"},
+                "destination_name": {"$max": "$destination_name"},
+            }},
+            {"$sort": {by: -1, "_id.origin": 1, "_id.destination": 1}},
+            {"$limit": limit},
+        ]).to_list(None)
+
+
+class SearchWarmer:
+    """Pre-computed ride search candidates for the most searched corridors"""
+
+    def __init__(self, rollup: CorridorRollup, fetch: Callable[[str], Awaitable[List[dict]]],
+                 top_n: int = 20, lookback_days: int = 7, max_age_seconds: float = 120):
+        self.rollup = rollup
+        self.fetch = fetch  # day -> rides the search query returns for it
+        self.top_n = top_n
+        self.lookback_days = lookback_days
+        self.max_age_seconds = max_age_seconds
+        self.hot = set()  # (origin cell, destination cell)
+        self._results: Dict[str, Tuple[float, List[dict]]] = {}  # day -> (fetched at, rides)
+        # Bumped by every invalidation so results fetched before it are not stored
+        self.version = 0
+        self.hits = 0
+        self.misses = 0
+
+    async def warm(self):
+        today = datetime.utcnow().date()
+        start = (today - timedelta(days=self.lookback_days)).isoformat()
+        corridors = await self.rollup.popular(start, self.top_n)
+        self.hot = {(c["_id"]["origin"], c["_id"]["destination"]) for c in corridors if c["searches"]}
+        now = time.monotonic()
+        self._results = {
+            day: entry for day, entry in self._results.items()
+            if self.hot and now - entry[0] <= self.max_age_seconds
+        }
+        if not self.hot:
+            return
+        for day in (today.isoformat(), (today + timedelta(days=1)).isoformat()):
+            version = self.version
+            self.put(day, await self.fetch(day), version)
+
+    def get(self, corridor: Tuple[str, str], day: str) -> Optional[List[dict]]:
+        """Warmed search candidates (copies), or None if the search must query the database"""
+        if corridor not in self.hot:
+            return None
+        entry = self._results.get(day)
+        if entry is None or time.monotonic() - entry[0] > self.max_age_seconds:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return [dict(ride) for ride in entry[1]]
+
+    def put(self, day: str, rides: List[dict], version: int):
+        """Store search candidates fetched when self.version was version"""
+        if version == self.version:
+            self._results[day] = (time.monotonic(), [dict(ride) for ride in rides])
+
+    def invalidate(self, day: Optional[str] = None):
+        """Drop warmed results of one day, or of every day"""
+        self.version += 1
+        if day is None:
+            self._results = {}
+        else:
+            self._results.pop(day, None)
+
+    def metrics(self) -> dict:
+        return {"hot_corridors": len(self.hot), "warm_days": sorted(self._results), "hits": self.hits,
+                "misses": self.misses}
@@ -0,0 +1,85 @@
+"""
+RideShare - ETags
+Strong ETags and conditional GETs for polled documents
+
+An ETag is a hash of the resource key and a version stamp (the document's
+``updated_at``, or a summary of a list). The last ETag served for each
+resource is kept in a small in-process cache for a couple of seconds, so a
+client polling with ``If-None-Match`` gets its 304 without any database read;
+writes made by this process drop the cached ETag at once, and writes made
+elsewhere are picked up when the entry expires.
+"""
+
+import hashlib
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable, Hashable, Optional
+
+from fastapi.responses import Response
+
+CACHE_CONTROL = "private, no-cache"
+
+
+def make_etag(*parts) -> str:
+    digest = hashlib.blake2b("|".join(str(p) for p in parts).encode(), digest_size=12).hexdigest()
+    return f'"{digest}"'
+
+
+def etag_matches(if_none_match: Optional[str], etag: Optional[str]) -> bool:
+    """Whether an If-None-Match header lists the ETag (weak comparison, as for GET)"""
+    if not if_none_match or not etag:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    candidates = (tag.strip() for tag in if_none_match.split(","))
+    return etag in (tag[2:] if tag.startswith("W/") else tag for tag in candidates)
+
+
+def not_modified(etag: str) -> Response:
+    return Response(status_code=304, headers={"ETag": etag, "Cache-Control": CACHE_CONTROL})
+
+
+def set_etag(response: Response, etag: str):
+    response.headers["ETag"] = etag
+    response.headers["Cache-Control"] = CACHE_CONTROL
+
+
+class ETagCache:
+    """Recently served ETags by resource key, expiring after ttl seconds"""
+
+    def __init__(self, ttl: float = 2.0, max_entries: int = 50000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[Hashable, tuple]" = OrderedDict()  # key -> (etag, expires)
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Hashable) -> Optional[str]:
+        entry = self._entries.get(key)
+        if entry is None or entry[1] < time.monotonic():
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry[0]
+
+    def put(self, key: Hashable, etag: str) -> str:
+        self._entries[key] = (etag, time.monotonic() + self.ttl)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        return etag
+
+    def invalidate(self, key: Hashable):
+        self._entries.pop(key, None)
+
+    async def current(self, key: Hashable, load_stamp: Callable[[], Awaitable[object]]) -> Optional[str]:
+        """ETag of a resource, reading only its version stamp when not cached"""
+        etag = self.get(key)
+        if etag is None:
+            stamp = await load_stamp()
+            if stamp is not None:
+                etag = self.put(key, make_etag(*key, stamp))
+        return etag
+
+    def metrics(self) -> dict:
+        return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses}
@@ -0,0 +1,372 @@
+"""
+RideShare - Events
+Transactional outbox and ordered event feed for state changes
+
+A state change records its event inside the document it modifies, in the
+same single-document write (``_outbox`` plus an indexed ``_outbox_at``), so
+an event exists if and only if the change was applied, without needing
+multi-document transactions. A relay, run by whichever process holds a
+lease, moves pending events into the ``events`` collection under a global
+sequence number and delivers the feed to sinks in batches. Each process
+also tails the feed for its in-process subscribers, so consumers share one
+poll instead of each polling the source collections.
+
+The lease is renewed between batches and the relay stops once it is lost.
+A relay that stalled after reserving sequence numbers may still insert them
+after its successor has moved on, so readers of the whole feed (sinks and
+subscribers) stop at a sequence gap until it is ``gap_grace_seconds`` old;
+a gap left by a relay that crashed is then skipped (its events are still in
+the outbox and are relayed again under new numbers).
+"""
+
+import asyncio
+import hashlib
+import hmac
+import json
+import os
+import urllib.request
+import uuid
+from datetime import datetime, timedelta
+from typing import Awaitable, Callable, Iterable, List, Optional
+
+from bson import ObjectId
+from pymongo import ReturnDocument
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+
+OUTBOX_FIELD = "_outbox"
+OUTBOX_AT_FIELD = "_outbox_at"
+
+
+def new_event(event_type: str, data: dict) -> dict:
+    return {"_id": ObjectId(), "type": event_type, "at": datetime.utcnow(), "data": data}
+
+
+def with_event(update, event: dict):
+    """Add an outbox event to an update document or pipeline"""
+    if isinstance(update, list):
+        return update + [{"$set": {
+            OUTBOX_FIELD: {"$concatArrays": [{"$ifNull": [f"${OUTBOX_FIELD}", []]}, [{"$literal": event}]]},
+            OUTBOX_AT_FIELD: {"$min": [f"${OUTBOX_AT_FIELD}", {"$literal": event["at"]}]},
+        }}]
+    update = dict(update)
+    update["$push"] = {**update.get("$push", {}), OUTBOX_FIELD: event}
+    update["$min"] = {**update.get("$min", {}), OUTBOX_AT_FIELD: event["at"]}
+    return update
+
+
+def with_event_doc(doc: dict, event: dict) -> dict:
+    """Add an outbox event to a document about to be inserted"""
+    doc[OUTBOX_FIELD] = [event]
+    doc[OUTBOX_AT_FIELD] = event["at"]
+    return doc
+
+
+def ride_created_event(ride: dict) -> dict:
+    """Event recording a new ride (its ``_id`` must already be set)"""
+    return new_event("ride.created", {
+        "ride_id": str(ride["_id"]),
+        "driver_id": ride["driver_id"],
+        "series_id": ride.get("series_id"),
+        "date": ride["date"],
+        "pickup_lat": ride["pickup_lat"],
+        "pickup_lng": ride["pickup_lng"],
+        "seats": ride["available_seats"],
+    })
+
+
+def ride_cancelled_event(ride: dict) -> dict:
+    """Event recording a ride's cancellation"""
+    return new_event("ride.cancelled", {
+        "ride_id": str(ride["_id"]),
+        "driver_id": ride["driver_id"],
+        "pickup_lat": ride["pickup_lat"],
+        "pickup_lng": ride["pickup_lng"],
+    })
+
+
+# Booking fields read by booking_status_event
+BOOKING_EVENT_FIELDS = {
+    "ride_id": 1, "passenger_id": 1, "driver_id": 1, "seats": 1, "status": 1,
+    "created_at": 1, "pickup_lat": 1, "pickup_lng": 1,
+}
+
+
+def booking_status_event(booking: dict, new_status: str, user_id: str) -> dict:
+    """Event recording a booking's move from its current status to new_status"""
+    return new_event("booking.status_changed", {
+        "booking_id": str(booking["_id"]),
+        "ride_id": booking["ride_id"],
+        "passenger_id": booking["passenger_id"],
+        "driver_id": booking["driver_id"],
+        "seats": booking["seats"],
+        "from_status": booking["status"],
+        "to_status": new_status,
+        "changed_by": user_id,
+        "booked_at": booking.get("created_at"),
+        "pickup_lat": booking.get("pickup_lat"),
+        "pickup_lng": booking.get("pickup_lng"),
+    })
+
+
+def event_json(event: dict) -> dict:
+    """Wire format of a feed event"""
+    return {
+        "id": str(event["_id"]),
+        "seq": event["seq"],
+        "type": event["type"],
+        "at": event["at"].isoformat() + "Z",
+        "data": event["data"],
+    }
+
+
+# ============== Sinks ==============
+
+class NDJSONFileSink:
+    """Appends the feed to a local newline-delimited JSON file"""
+
+    def __init__(self, path: str, name: str = "ndjson"):
+        self.path = path
+        self.name = name
+
+    async def deliver(self, events: List[dict]):
+        lines = "".join(json.dumps(event_json(e), default=str) + "\n" for e in events)
+        await asyncio.to_thread(self._append, lines)
+
+    def _append(self, lines: str):
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write(lines)
+            f.flush()
+            os.fsync(f.fileno())
+
+
+class WebhookSink:
+    """POSTs batches of events as {"events": [...]} to a URL.
+
+    With a secret, the body is signed in an X-RideShare-Signature header
+    (``sha256=<hex HMAC>``). Any non-2xx response fails the batch, which is
+    retried from the same position on the next dispatch.
+    """
+
+    def __init__(self, url: str, secret: Optional[str] = None, timeout: float = 10.0, name: str = "webhook"):
+        self.url = url
+        self.secret = secret
+        self.timeout = timeout
+        self.name = name
+
+    async def deliver(self, events: List[dict]):
+        body = json.dumps({"events": [event_json(e) for e in events]}, default=str).encode()
+        await asyncio.to_thread(self._post, body)
+
+    def _post(self, body: bytes):
+        headers = {"Content-Type": "application/json"}
+        if self.secret:
+            digest = hmac.new(self.secret.encode(), body, hashlib.sha256).hexdigest()
+            headers["X-RideShare-Signature"] = f"sha256={digest}"
+        request = urllib.request.Request(self.url, data=body, headers=headers, method="POST")
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            response.read()
+
+
+# ============== Event Stream ==============
+
+Subscriber = Callable[[List[dict]], Awaitable]
+
+
+class EventStream:
+    """Relays outbox events into the ordered feed and fans it out to sinks"""
+
+    def __init__(self, events, state, sources: Iterable, batch_size: int = 500,
+                 lease_seconds: float = 30.0, retention: timedelta = timedelta(days=7),
+                 gap_grace_seconds: Optional[float] = None):
+        self.events = events
+        self.state = state
+        self.sources = list(sources)
+        self.batch_size = batch_size
+        self.lease_seconds = lease_seconds
+        self.gap_grace_seconds = lease_seconds if gap_grace_seconds is None else gap_grace_seconds
+        self.retention = retention
+        self.sinks = []
+        self._subscribers = []  # (callback, types or None)
+        self._local_seq = None
+        self._owner = uuid.uuid4().hex
+
+    def add_sink(self, sink):
+        """Register a durable sink; it receives every event at least once"""
+        self.sinks.append(sink)
+
+    def subscribe(self, callback: Subscriber, types: Optional[Iterable[str]] = None):
+        """Call an in-process coroutine with batches of new events (optionally filtered by type)"""
+        self._subscribers.append((callback, set(types) if types else None))
+
+    # ---- relay ----
+
+    async def _acquire_lease(self) -> bool:
+        now = datetime.utcnow()
+        try:
+            await self.state.find_one_and_update(
+                {"_id": "relay", "$or": [{"owner": self._owner}, {"locked_until": {"$lte": now}}]},
+                {"$set": {"owner": self._owner, "locked_until": now + timedelta(seconds=self.lease_seconds)}},
+                upsert=True,
+            )
+        except DuplicateKeyError:
+            return False
+        return True
+
+    async def _renew_lease(self) -> bool:
+        """Extend the lease held by this process; False once another process took it"""
+        result = await self.state.update_one(
+            {"_id": "relay", "owner": self._owner},
+            {"$set": {"locked_until": datetime.utcnow() + timedelta(seconds=self.lease_seconds)}},
+        )
+        if result.matched_count == 0:
+            print("WARNING: Event relay lease lost; stopping this pass")
+            return False
+        return True
+
+    async def relay(self) -> int:
+        """Move pending outbox events into the feed; returns how many were relayed"""
+        pending = []  # (event, source collection, document id, outbox size)
+        for collection in self.sources:
+            docs = await collection.find(
+                {OUTBOX_AT_FIELD: {"$exists": True}}, {OUTBOX_FIELD: 1}
+            ).sort(OUTBOX_AT_FIELD, 1).to_list(self.batch_size)
+            for doc in docs:
+                outbox = doc.get(OUTBOX_FIELD, [])
+                pending.extend((event, collection, doc["_id"], len(outbox)) for event in outbox)
+        if not pending:
+            return 0
+
+        pending.sort(key=lambda p: (p[0]["at"], p[0]["_id"]))
+        counter = await self.state.find_one_and_update(
+            {"_id": "relay", "owner": self._owner},
+            {"$inc": {"seq": len(pending)}},
+            return_document=ReturnDocument.AFTER,
+        )
+        if counter is None:
+            return 0
+        first_seq = counter["seq"] - len(pending) + 1
+        now = datetime.utcnow()
+        expires_at = now + self.retention
+        feed = [
+            {**event, "seq": first_seq + i, "relayed_at": now, "expires_at": expires_at}
+            for i, (event, _, _, _) in enumerate(pending)
+        ]
+        # Ordered, so tailers never see a sequence number before the ones below it
+        while feed:
+            try:
+                await self.events.insert_many(feed, ordered=True)
+                break
+            except BulkWriteError as e:
+                # An event relayed before a crash keeps the sequence number it got then
+                error = e.details["writeErrors"][0]
+                if error["code"] != 11000:
+                    raise
+                feed = feed[error["index"] + 1:]
+
+        drained = {}  # (collection, document id) -> event ids relayed from it
+        for event, collection, doc_id, size in pending:
+            key = (id(collection), doc_id)
+            drained.setdefault(key, (collection, doc_id, size, []))[3].append(event["_id"])
+        for collection, doc_id, size, event_ids in drained.values():
+            # Clear the outbox only if nothing was added since it was read
+            cleared = await collection.update_one(
+                {"_id": doc_id, OUTBOX_FIELD: {"$size": size}},
+                {"$unset": {OUTBOX_FIELD: "", OUTBOX_AT_FIELD: ""}},
+            )
+            if cleared.matched_count == 0:
+                await collection.update_one(
+                    {"_id": doc_id}, {"$pull": {OUTBOX_FIELD: {"_id": {"$in": event_ids}}}}
+                )
+        return len(pending)
+
+    # ---- delivery ----
+
+    async def read(self, after_seq: int = 0, limit: int = 100, types: Optional[Iterable[str]] = None) -> List[dict]:
+        """Events of the feed after a sequence number, in order"""
+        query = {"seq": {"$gt": after_seq}}
+        if types:
+            query["type"] = {"$in": list(types)}
+        return await self.events.find(query, {"expires_at": 0}).sort("seq", 1).to_list(limit)
+
+    async def last_seq(self) -> int:
+        newest = await self.events.find_one({}, {"seq": 1}, sort=[("seq", -1)])
+        return newest["seq"] if newest else 0
+
+    async def sink_position(self, name: str) -> int:
+        """Sequence number up to which a sink has received the feed"""
+        cursor = await self.state.find_one({"_id": f"sink:{name}"})
+        return cursor["seq"] if cursor else 0
+
+    def _contiguous(self, after_seq: int, batch: List[dict]) -> List[dict]:
+        """Events of batch before the first sequence gap a relay may still fill"""
+        filling_since = datetime.utcnow() - timedelta(seconds=self.gap_grace_seconds)
+        expected = after_seq + 1
+        for i, event in enumerate(batch):
+            if event["seq"] != expected and event.get("relayed_at", filling_since) > filling_since:
+                return batch[:i]
+            expected = event["seq"] + 1
+        return batch
+
+    async def dispatch(self) -> bool:
+        """Deliver new feed events to each durable sink from its saved position.
+
+        Returns False if the lease was lost, which stops delivery.
+        """
+        for sink in self.sinks:
+            cursor_id = f"sink:{sink.name}"
+            position = await self.sink_position(sink.name)
+            while True:
+                batch = self._contiguous(position, await self.read(position, self.batch_size))
+                if not batch:
+                    break
+                if not await self._renew_lease():
+                    return False
+                try:
+                    await sink.deliver(batch)
+                except Exception as e:
+                    print(f"WARNING: Event sink {sink.name} failed at seq {position}: {str(e)}")
+                    break
+                position = batch[-1]["seq"]
+                await self.state.update_one({"_id": cursor_id}, {"$set": {"seq": position}}, upsert=True)
+        return True
+
+    async def tail(self):
+        """Hand new feed events to this process's subscribers"""
+        if not self._subscribers:
+            return
+        if self._local_seq is None:
+            self._local_seq = await self.last_seq()
+            return
+        while True:
+            batch = self._contiguous(self._local_seq, await self.read(self._local_seq, self.batch_size))
+            if not batch:
+                break
+            self._local_seq = batch[-1]["seq"]
+            for callback, types in self._subscribers:
+                selected = [e for e in batch if types is None or e["type"] in types]
+                if not selected:
+                    continue
+                try:
+                    await callback(selected)
+                except Exception as e:
+                    print(f"WARNING: Event subscriber {getattr(callback, '__name__', callback)} failed: {str(e)}")
+
+    async def run_once(self):
+        """One relay/dispatch/tail pass; relay and sinks run only on the lease holder"""
+        if await self._acquire_lease():
+            while await self.relay() >= self.batch_size and await self._renew_lease():
+                pass
+            if await self._renew_lease():
+                await self.dispatch()
+        await self.tail()
+
+    # ---- observability ----
+
+    async def metrics(self) -> dict:
+        last_seq = await self.last_seq()
+        result = {"last_seq": last_seq, "pending_outbox": 0, "sink_lag": {}}
+        for collection in self.sources:
+            result["pending_outbox"] += await collection.count_documents({OUTBOX_AT_FIELD: {"$exists": True}})
+        for sink in self.sinks:
+            result["sink_lag"][sink.name] = last_seq - await self.sink_position(sink.name)
+        return result
@@ -0,0 +1,81 @@
+"""
+RideShare - Profile Fan-out
+Propagates a user's name, photo and rating to the documents that copy them
+
+Rides, bookings, requests, chats and reviews carry denormalized copies of
+user fields so lists render without joins. After a profile or rating change
+a "profile_fanout" job rewrites the stale copies in chunked bulk writes.
+Changes in quick succession coalesce into one job (the job is deduplicated
+per user and delayed briefly), and the job always reads the user's current
+values, so the last change wins. Writes are paced to a documents-per-second
+budget so fan-out for a prolific driver leaves headroom for requests.
+"""
+
+import asyncio
+import time
+from datetime import datetime
+
+from bson import ObjectId
+from pymongo import UpdateOne
+
+from jobs import Job
+
+# collection attribute -> (field holding the user id, {copied field: user field})
+DENORMALIZED_FIELDS = {
+    "rides": ("driver_id", {"driver_name": "name", "driver_photo": "photo", "driver_rating": "rating"}),
+    "bookings": ("passenger_id", {"passenger_name": "name", "passenger_photo": "photo"}),
+    "private_requests": ("passenger_id", {"passenger_name": "name", "passenger_photo": "photo"}),
+    "chats": ("sender_id", {"sender_name": "name"}),
+    "reviews": ("reviewer_id", {"reviewer_name": "name"}),
+}
+
+
+class ProfileFanout:
+    """Job handler rewriting denormalized copies of one user's fields"""
+
+    def __init__(self, storage, chunk_size: int = 500, docs_per_second: float = 2000.0):
+        self.storage = storage
+        self.chunk_size = chunk_size
+        self.docs_per_second = docs_per_second
+
+    async def run(self, job: Job):
+        user_id = job.payload["user_id"]
+        user = await self.storage.users.find_one({"_id": ObjectId(user_id)}, {"name": 1, "photo": 1, "rating": 1})
+        if user is None:
+            return
+        for attr, (owner_field, fields) in DENORMALIZED_FIELDS.items():
+            values = {copy: user[source] for copy, source in fields.items() if source in user}
+            if values:
+                updated = await self._fan_out(getattr(self.storage, attr), owner_field, user_id, values)
+                if updated:
+                    await job.save_state(inc_fields={f"updated.{attr}": updated})
+
+    async def _fan_out(self, collection, owner_field: str, user_id: str, values: dict) -> int:
+        """Rewrite stale copies in one collection; returns how many documents changed"""
+        stale = {owner_field: user_id, "$or": [{field: {"$ne": value}} for field, value in values.items()]}
+        updated = 0
+        last_id = None
+        while True:
+            query = dict(stale)
+            if last_id is not None:
+                query["_id"] = {"$gt": last_id}
+            chunk = await collection.find(query, {"_id": 1}).sort("_id", 1).to_list(self.chunk_size)
+            if not chunk:
+                return updated
+
+            started = time.monotonic()
+            now = datetime.utcnow()
+            result = await collection.bulk_write(
+                [
+                    UpdateOne({"_id": doc["_id"], owner_field: user_id}, {"$set": {**values, "updated_at": now}})
+                    for doc in chunk
+                ],
+                ordered=False,
+            )
+            updated += result.modified_count
+            last_id = chunk[-1]["_id"]
+
+            # Pace to the write budget
+            pause = len(chunk) / self.docs_per_second - (time.monotonic() - started)
+            if pause > 0:
+                await asyncio.sleep(pause)
@@ -0,0 +1,224 @@
+"""
+RideShare - Idempotency Keys
+Safe retries of mutating requests carrying an ``Idempotency-Key`` header
+
+The first request with a key claims it by inserting an ``in_progress``
+record (the unique ``_id`` makes the claim atomic), runs normally, and then
+stores its response in the record. A retry of a completed request is
+answered from the stored response, with ``Idempotent-Replayed: true``,
+without running the endpoint. A retry arriving while the first is still
+running waits for it: on the same worker through a future the first
+resolves, on other workers by polling the record. Keys are scoped to the
+user and the endpoint, and reusing one with a different body is rejected.
+
+Responses with a 5xx status (and requests that raise) release the key, so a
+retry runs again. A claim left by a worker that died is taken over once its
+lock expires. Records are removed by a TTL index after ``ttl_seconds``.
+"""
+
+import asyncio
+import hashlib
+import time
+import uuid
+from datetime import datetime, timedelta
+from typing import Callable, Dict, Optional, Set, Tuple
+
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+from starlette.responses import JSONResponse
+
+HEADER = b"idempotency-key"
+MAX_KEY_LENGTH = 255
+
+# Outcomes of IdempotencyStore.begin
+EXECUTE, REPLAY, MISMATCH, BUSY = "execute", "replay", "mismatch", "busy"
+
+
+class IdempotencyStore:
+    """Claims, waits on and completes idempotency records"""
+
+    def __init__(self, collection, ttl_seconds: float = 86400, lock_seconds: float = 60,
+                 wait_seconds: float = 10, poll_seconds: float = 0.1):
+        self.collection = collection
+        self.ttl = timedelta(seconds=ttl_seconds)
+        self.lock = timedelta(seconds=lock_seconds)
+        self.wait_seconds = wait_seconds
+        self.poll_seconds = poll_seconds
+        self._running: Dict[str, asyncio.Future] = {}  # record id -> response of the run in this process
+        self.replays = 0
+        self.waits = 0
+
+    async def begin(self, record_id: str, fingerprint: str) -> Tuple[str, Optional[object]]:
+        """(EXECUTE, owner), (REPLAY, response), (MISMATCH, None) or (BUSY, None)"""
+        deadline = time.monotonic() + self.wait_seconds
+        waited = False
+        while True:
+            now = datetime.utcnow()
+            owner = uuid.uuid4().hex
+            try:
+                await self.collection.insert_one({
+                    "_id": record_id,
+                    "fingerprint": fingerprint,
+                    "status": "in_progress",
+                    "owner": owner,
+                    "locked_until": now + self.lock,
+                    "created_at": now,
+                    "expires_at": now + self.ttl,
+                })
+                return self._claimed(record_id, owner)
+            except DuplicateKeyError:
+                pass
+
+            record = await self.collection.find_one({"_id": record_id})
+            if record is None:
+                continue  # Released since our insert
+            if record["fingerprint"] != fingerprint:
+                return MISMATCH, None
+            if record["status"] == "completed":
+                self.replays += 1
+                self.waits += waited
+                return REPLAY, record["response"]
+            if record["locked_until"] <= now:
+                # The worker running it died; take the claim over
+                taken = await self.collection.find_one_and_update(
+                    {"_id": record_id, "status": "in_progress", "owner": record["owner"]},
+                    {"$set": {"owner": owner, "locked_until": now + self.lock}},
+                    return_document=ReturnDocument.AFTER,
+                )
+                if taken is not None:
+                    return self._claimed(record_id, owner)
+                continue
+
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return BUSY, None
+            waited = True
+            running = self._running.get(record_id)
+            if running is None:
+                await asyncio.sleep(min(self.poll_seconds, remaining))
+                continue
+            try:
+                response = await asyncio.wait_for(asyncio.shield(running), remaining)
+            except asyncio.TimeoutError:
+                return BUSY, None
+            if response is not None:
+                self.replays += 1
+                self.waits += 1
+                return REPLAY, response
+            # The first run failed and released the key; try to claim it
+
+    def _claimed(self, record_id: str, owner: str) -> Tuple[str, str]:
+        self._running[record_id] = asyncio.get_running_loop().create_future()
+        return EXECUTE, owner
+
+    async def finish(self, record_id: str, owner: str, response: Optional[dict]):
+        """Store the response of a run, or release the key if there is none (failure)"""
+        running = self._running.pop(record_id, None)
+        try:
+            if response is not None:
+                await self.collection.update_one(
+                    {"_id": record_id, "owner": owner},
+                    {"$set": {"status": "completed", "response": response, "completed_at": datetime.utcnow()}},
+                )
+            else:
+                await self.collection.delete_one({"_id": record_id, "owner": owner})
+        finally:
+            if running is not None and not running.done():
+                running.set_result(response)
+
+    def metrics(self) -> dict:
+        return {"running": len(self._running), "replays": self.replays, "waits": self.waits}
+
+
+class IdempotencyMiddleware:
+    """ASGI middleware applying Idempotency-Key handling to the given routes.
+
+    ``identify`` maps a bearer token to a user id, or None when the token is
+    invalid; such requests pass through and are rejected by the endpoint.
+    """
+
+    def __init__(self, app, store: IdempotencyStore, routes: Set[Tuple[str, str]],
+                 identify: Callable[[str], Optional[str]]):
+        self.app = app
+        self.store = store
+        self.routes = routes
+        self.identify = identify
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or (scope["method"], scope["path"]) not in self.routes:
+            await self.app(scope, receive, send)
+            return
+        headers = dict(scope["headers"])
+        key = headers.get(HEADER)
+        authorization = headers.get(b"authorization", b"").decode("latin-1")
+        user_id = self.identify(authorization[7:]) if authorization.lower().startswith("bearer ") else None
+        if key is None or user_id is None:
+            await self.app(scope, receive, send)
+            return
+        if not key or len(key) > MAX_KEY_LENGTH:
+            await JSONResponse({"detail": "Invalid Idempotency-Key"}, status_code=400)(scope, receive, send)
+            return
+
+        body = await _read_body(receive)
+        record_id = hashlib.sha256(b"\n".join(
+            [user_id.encode(), scope["method"].encode(), scope["path"].encode(), key]
+        )).hexdigest()
+        fingerprint = hashlib.sha256(scope.get("query_string", b"") + b"\n" + body).hexdigest()
+
+        outcome, value = await self.store.begin(record_id, fingerprint)
+        if outcome == REPLAY:
+            await _replay(value, send)
+        elif outcome == MISMATCH:
+            await JSONResponse(
+                {"detail": "Idempotency-Key was already used with a different request"}, status_code=422
+            )(scope, receive, send)
+        elif outcome == BUSY:
+            await JSONResponse(
+                {"detail": "A request with this Idempotency-Key is still in progress"},
+                status_code=409, headers={"Retry-After": "1"},
+            )(scope, receive, send)
+        else:
+            await self._execute(scope, receive, send, body, record_id, value)
+
+    async def _execute(self, scope, receive, send, body: bytes, record_id: str, owner: str):
+        response = {"status": 500, "headers": [], "body": b""}
+        body_sent = False
+
+        async def receive_body():
+            nonlocal body_sent
+            if not body_sent:
+                body_sent = True
+                return {"type": "http.request", "body": body, "more_body": False}
+            return await receive()
+
+        async def capture(message):
+            if message["type"] == "http.response.start":
+                response["status"] = message["status"]
+                response["headers"] = [[k.decode("latin-1"), v.decode("latin-1")] for k, v in message.get("headers", [])]
+            elif message["type"] == "http.response.body":
+                response["body"] += message.get("body", b"")
+            await send(message)
+
+        completed = None
+        try:
+            await self.app(scope, receive_body, capture)
+            if response["status"] < 500:
+                completed = response
+        finally:
+            await self.store.finish(record_id, owner, completed)
+
+
+async def _read_body(receive) -> bytes:
+    chunks = []
+    while True:
+        message = await receive()
+        chunks.append(message.get("body", b""))
+        if not message.get("more_body", False):
+            return b"".join(chunks)
+
+
+async def _replay(response: dict, send):
+    headers = [(k.encode("latin-1"), v.encode("latin-1")) for k, v in response["headers"]]
+    headers.append((b"idempotent-replayed", b"true"))
+    await send({"type": "http.response.start", "status": response["status"], "headers": headers})
+    await send({"type": "http.response.body", "body": bytes(response["body"])})
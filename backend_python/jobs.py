@@ -0,0 +1,308 @@
+"""
+RideShare - Job Queue
+Durable job queue backed by a Mongo collection, run by asyncio workers
+
+Jobs are claimed atomically with find_one_and_update and hidden from other
+workers for a visibility timeout that a heartbeat keeps extending while the
+handler runs. A worker that dies simply stops heartbeating and its job
+becomes claimable again. Failed jobs are retried with exponential backoff
+until max_attempts, then kept as "dead" for inspection.
+"""
+
+import asyncio
+import traceback
+import uuid
+from datetime import datetime, timedelta
+from typing import Awaitable, Callable, Dict, Optional
+
+from bson import ObjectId
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+from profiling import current_db_timing
+
+
+class Job:
+    """A claimed job as seen by its handler"""
+
+    def __init__(self, queue: "JobQueue", doc: dict):
+        self.queue = queue
+        self.id = doc["_id"]
+        self.name = doc["name"]
+        self.payload = doc.get("payload", {})
+        self.state = doc.get("state", {})
+        self.attempts = doc["attempts"]
+        self.lock_id = doc["lock_id"]
+        self.lost_lease = False
+
+    async def save_state(self, set_fields: Optional[dict] = None, inc_fields: Optional[dict] = None,
+                         add_to_set: Optional[dict] = None):
+        """Persist handler progress (checkpoints) and renew the lease"""
+        update = {"$set": {f"state.{k}": v for k, v in (set_fields or {}).items()}}
+        update["$set"].update(self.queue._lease_fields())
+        if inc_fields:
+            update["$inc"] = {f"state.{k}": v for k, v in inc_fields.items()}
+        if add_to_set:
+            update["$addToSet"] = {f"state.{k}": v for k, v in add_to_set.items()}
+        result = await self.queue.collection.update_one({"_id": self.id, "lock_id": self.lock_id}, update)
+        if result.matched_count == 0:
+            raise LostLease(f"Job {self.id} was reclaimed by another worker")
+
+
+class LostLease(Exception):
+    """The job's visibility timeout expired and another worker took it"""
+
+
+class JobQueue:
+    """Enqueue jobs and run them on a pool of asyncio workers"""
+
+    def __init__(
+        self,
+        collection,
+        visibility_timeout: float = 60.0,
+        max_attempts: int = 5,
+        backoff_base: float = 2.0,
+        backoff_max: float = 600.0,
+        poll_interval: float = 1.0,
+        retention: timedelta = timedelta(days=1),
+    ):
+        self.collection = collection
+        self.visibility_timeout = visibility_timeout
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.poll_interval = poll_interval
+        self.retention = retention
+        self.handlers: Dict[str, Callable[[Job], Awaitable]] = {}
+        self._workers = []
+        self._wakeup: Optional[asyncio.Event] = None
+        self._stopping = False
+
+    def handler(self, name: str):
+        """Decorator registering the coroutine that runs jobs called name"""
+        def register(fn):
+            self.handlers[name] = fn
+            return fn
+        return register
+
+    def _lease_fields(self):
+        return {"locked_until": datetime.utcnow() + timedelta(seconds=self.visibility_timeout)}
+
+    # ---- producing ----
+
+    async def enqueue(self, name: str, payload: Optional[dict] = None, delay: float = 0,
+                      dedupe_key: Optional[str] = None, state: Optional[dict] = None) -> str:
+        """Add a job. With dedupe_key, a job already queued under the same key
+        absorbs this one (useful for recomputations triggered in bursts)."""
+        now = datetime.utcnow()
+        job = {
+            "name": name,
+            "payload": payload or {},
+            "state": state or {},
+            "status": "queued",
+            "attempts": 0,
+            "run_at": now + timedelta(seconds=delay),
+            "locked_until": None,
+            "lock_id": None,
+            "dedupe_key": dedupe_key,
+            "created_at": now,
+            "updated_at": now,
+        }
+        if dedupe_key:
+            # A unique index on queued dedupe keys makes concurrent upserts
+            # collide instead of inserting twice; the loser finds the winner
+            for attempt in range(3):
+                try:
+                    existing = await self.collection.find_one_and_update(
+                        {"dedupe_key": dedupe_key, "status": "queued"},
+                        {"$setOnInsert": job},
+                        upsert=True,
+                        projection={"_id": 1},
+                        return_document=ReturnDocument.AFTER,
+                    )
+                    break
+                except DuplicateKeyError:
+                    if attempt == 2:
+                        raise
+            job_id = existing["_id"]
+        else:
+            await self.collection.insert_one(job)
+            job_id = job["_id"]
+
+        if self._wakeup is not None and not delay:
+            self._wakeup.set()
+        return str(job_id)
+
+    async def get(self, job_id: str):
+        return await self.collection.find_one({"_id": ObjectId(job_id)})
+
+    # ---- consuming ----
+
+    async def claim(self) -> Optional[Job]:
+        """Atomically take the oldest runnable job"""
+        now = datetime.utcnow()
+        doc = await self.collection.find_one_and_update(
+            {
+                "name": {"$in": list(self.handlers)},
+                "$or": [
+                    {"status": "queued", "run_at": {"$lte": now}},
+                    # Its worker died or stalled; retried like a failure
+                    {"status": "running", "locked_until": {"$lte": now}, "attempts": {"$lt": self.max_attempts}},
+                ],
+            },
+            {
+                "$set": {
+                    "status": "running",
+                    "lock_id": uuid.uuid4().hex,
+                    "started_at": now,
+                    "updated_at": now,
+                    **self._lease_fields(),
+                },
+                "$inc": {"attempts": 1},
+            },
+            sort=[("run_at", 1)],
+            return_document=ReturnDocument.AFTER,
+        )
+        if doc is None:
+            await self._bury_expired(now)
+            return None
+        return Job(self, doc)
+
+    async def _bury_expired(self, now: datetime):
+        """Mark dead the jobs whose lease expired on their last attempt"""
+        await self.collection.update_many(
+            {"status": "running", "locked_until": {"$lte": now}, "attempts": {"$gte": self.max_attempts}},
+            {"$set": {
+                "status": "dead",
+                "last_error": "Lease expired on the last attempt (worker died or the job stalled)",
+                "finished_at": now,
+                "updated_at": now,
+                "expires_at": now + self.retention,
+            }},
+        )
+
+    async def run_one(self) -> bool:
+        """Claim and run a single job; returns False when the queue is empty"""
+        job = await self.claim()
+        if job is None:
+            return False
+
+        handler = asyncio.create_task(self.handlers[job.name](job))
+        heartbeat = asyncio.create_task(self._heartbeat(job, handler))
+        try:
+            await handler
+        except LostLease:
+            return True
+        except asyncio.CancelledError:
+            if job.lost_lease:
+                return True
+            raise
+        except Exception as e:
+            await self._fail(job, e)
+        else:
+            await self._finish(job, {"status": "completed"})
+        finally:
+            heartbeat.cancel()
+        return True
+
+    async def _heartbeat(self, job: Job, handler: asyncio.Task):
+        """Extend the lease while the handler runs; cancel the handler if the lease is lost"""
+        while True:
+            await asyncio.sleep(self.visibility_timeout / 3)
+            try:
+                result = await self.collection.update_one(
+                    {"_id": job.id, "lock_id": job.lock_id}, {"$set": self._lease_fields()}
+                )
+            except Exception as e:
+                # Retried on the next beat; the lease outlasts two missed beats
+                print(f"WARNING: Heartbeat of job {job.name} {job.id} failed: {str(e)}")
+                continue
+            if result.matched_count == 0:
+                print(f"WARNING: Job {job.name} {job.id} lost its lease; stopping it")
+                job.lost_lease = True
+                handler.cancel()
+                return
+
+    async def _finish(self, job: Job, fields: dict):
+        now = datetime.utcnow()
+        await self.collection.update_one(
+            {"_id": job.id, "lock_id": job.lock_id},
+            {"$set": {**fields, "finished_at": now, "updated_at": now, "expires_at": now + self.retention}},
+        )
+
+    async def _fail(self, job: Job, error: Exception):
+        print(f"WARNING: Job {job.name} {job.id} failed (attempt {job.attempts}): {error!r}")
+        last_error = "".join(traceback.format_exception_only(type(error), error)).strip()
+        if job.attempts >= self.max_attempts:
+            await self._finish(job, {"status": "dead", "last_error": last_error})
+            return
+        delay = min(self.backoff_base ** job.attempts, self.backoff_max)
+        try:
+            await self.collection.update_one(
+                {"_id": job.id, "lock_id": job.lock_id},
+                {"$set": {
+                    "status": "queued",
+                    "run_at": datetime.utcnow() + timedelta(seconds=delay),
+                    "last_error": last_error,
+                    "lock_id": None,
+                    "locked_until": None,
+                    "updated_at": datetime.utcnow(),
+                }},
+            )
+        except DuplicateKeyError:
+            # A job enqueued under the same dedupe key while this one ran is
+            # already queued and will redo the work; let it absorb the retry
+            await self._finish(job, {"status": "superseded", "last_error": last_error})
+
+    async def _worker(self):
+        # Work done by jobs is not attributed to any request
+        current_db_timing.set(None)
+        while not self._stopping:
+            try:
+                if await self.run_one():
+                    continue
+            except Exception as e:
+                print(f"WARNING: Job worker error: {str(e)}")
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    def start(self, workers: int):
+        """Start worker tasks on the running event loop"""
+        self._stopping = False
+        self._wakeup = asyncio.Event()
+        self._workers = [asyncio.create_task(self._worker(), name=f"job-worker-{i}") for i in range(workers)]
+
+    async def stop(self, timeout: float = 30.0):
+        """Stop claiming new jobs and wait for running ones to finish"""
+        self._stopping = True
+        if self._wakeup is not None:
+            self._wakeup.set()
+        if self._workers:
+            done, pending = await asyncio.wait(self._workers, timeout=timeout)
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+        self._workers = []
+
+    # ---- observability ----
+
+    async def metrics(self) -> dict:
+        """Queue depth per status/name and the age of the oldest runnable job"""
+        now = datetime.utcnow()
+        result = {"workers": len(self._workers), "by_status": {}, "queued_by_name": {}}
+        for status in ("queued", "running", "dead"):
+            result["by_status"][status] = await self.collection.count_documents({"status": status})
+        for name in self.handlers:
+            result["queued_by_name"][name] = await self.collection.count_documents(
+                {"name": name, "status": "queued"}
+            )
+        oldest = await self.collection.find_one(
+            {"status": "queued", "run_at": {"$lte": now}}, {"run_at": 1}, sort=[("run_at", 1)]
+        )
+        result["oldest_queued_age_seconds"] = (
+            round((now - oldest["run_at"]).total_seconds(), 3) if oldest else 0.0
+        )
+        return result
@@ -0,0 +1,207 @@
+"""
+RideShare - Live Locations
+Latest driver positions kept in memory, with a downsampled track persisted
+
+Drivers on an active ride push GPS pings over a WebSocket or in batches over
+HTTP. A ping overwrites the ride's latest position in place (a fixed-size
+``array`` of timestamp, lat, lng, heading, speed) and wakes the ride's
+watchers; nothing is written to the database per ping. A point joins the
+persisted track only when it is ``track_interval`` seconds after the last
+kept one, and kept points are flushed periodically as one ``$push`` per ride
+into ``ride_tracks``.
+
+Who may publish or watch a ride is checked against the database once and
+then remembered for ``grant_ttl`` seconds. Watchers are woken through an
+``asyncio.Event`` and read the newest position, so a slow client skips
+pings instead of queueing them. Positions live in the worker that received
+them; a watcher connected to another worker falls back to the last flushed
+track point.
+"""
+
+import asyncio
+import math
+import time
+from array import array
+from datetime import datetime, timedelta
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+from pymongo import UpdateOne
+
+# Layout of a latest-position array
+TS, LAT, LNG, HEADING, SPEED = range(5)
+
+# Pings stamped this far ahead of the server clock are rejected
+MAX_CLOCK_SKEW_SECONDS = 60
+
+
+def _number(value) -> float:
+    return math.nan if value is None else float(value)
+
+
+class LiveLocations:
+    """Latest position, track buffer and watchers of each ride being driven"""
+
+    def __init__(self, collection, track_interval: float = 15, max_track_points: int = 5000,
+                 grant_ttl: float = 60, idle_seconds: float = 900, retention_days: int = 30):
+        self.collection = collection
+        self.track_interval = track_interval
+        self.max_track_points = max_track_points
+        self.grant_ttl = grant_ttl
+        self.idle_seconds = idle_seconds
+        self.retention = timedelta(days=retention_days)
+        self._latest: Dict[str, array] = {}
+        self._track: Dict[str, List[List[float]]] = {}  # ride -> [ts, lat, lng] points to persist
+        self._last_kept: Dict[str, float] = {}  # ride -> ts of the last track point
+        self._watchers: Dict[str, set] = {}  # ride -> asyncio.Events
+        self._grants: Dict[Tuple[str, str, str], float] = {}  # (ride, user, role) -> expires
+        self.pings = 0
+        self.rejected = 0
+
+    # ---- Authorization ----
+
+    def granted(self, ride_id: str, user_id: str, role: str) -> bool:
+        expires = self._grants.get((ride_id, user_id, role))
+        return expires is not None and expires > time.monotonic()
+
+    async def authorize(self, ride_id: str, user_id: str, role: str,
+                        check: Callable[[], Awaitable[bool]]) -> bool:
+        """Whether a user may publish/watch a ride, asking check() only when no grant is remembered"""
+        if self.granted(ride_id, user_id, role):
+            return True
+        if not await check():
+            return False
+        self._grants[(ride_id, user_id, role)] = time.monotonic() + self.grant_ttl
+        return True
+
+    def end(self, ride_id: str):
+        """Forget a ride that stopped (its pending track is still flushed)"""
+        self._latest.pop(ride_id, None)
+        self._grants = {key: expires for key, expires in self._grants.items() if key[0] != ride_id}
+        for event in self._watchers.get(ride_id, ()):
+            event.set()
+
+    # ---- Ingestion ----
+
+    def ping(self, ride_id: str, lat: float, lng: float, ts: Optional[float] = None,
+             heading: Optional[float] = None, speed: Optional[float] = None) -> bool:
+        """Record a position; returns False if it is invalid or older than the latest one"""
+        now = time.time()
+        ts = now if ts is None else ts
+        if not (-90 <= lat <= 90 and -180 <= lng <= 180 and math.isfinite(ts)) or ts > now + MAX_CLOCK_SKEW_SECONDS:
+            self.rejected += 1
+            return False
+        latest = self._latest.get(ride_id)
+        if latest is None:
+            self._latest[ride_id] = array("d", (ts, lat, lng, _number(heading), _number(speed)))
+        elif ts <= latest[TS]:
+            self.rejected += 1
+            return False
+        else:
+            latest[TS], latest[LAT], latest[LNG] = ts, lat, lng
+            latest[HEADING], latest[SPEED] = _number(heading), _number(speed)
+        self.pings += 1
+
+        if ts - self._last_kept.get(ride_id, -math.inf) >= self.track_interval:
+            self._track.setdefault(ride_id, []).append([ts, lat, lng])
+            self._last_kept[ride_id] = ts
+        for event in self._watchers.get(ride_id, ()):
+            event.set()
+        return True
+
+    def ingest(self, ride_id: str, points: List[dict]) -> int:
+        """Record pings given as dicts; returns how many were accepted"""
+        accepted = 0
+        for point in points:
+            try:
+                accepted += self.ping(
+                    ride_id, float(point["lat"]), float(point["lng"]),
+                    None if point.get("ts") is None else float(point["ts"]),
+                    point.get("heading"), point.get("speed"),
+                )
+            except (KeyError, TypeError, ValueError):
+                self.rejected += 1
+        return accepted
+
+    # ---- Reading ----
+
+    def position(self, ride_id: str) -> Optional[dict]:
+        latest = self._latest.get(ride_id)
+        if latest is None:
+            return None
+        return {
+            "ts": latest[TS],
+            "lat": latest[LAT],
+            "lng": latest[LNG],
+            "heading": None if math.isnan(latest[HEADING]) else latest[HEADING],
+            "speed": None if math.isnan(latest[SPEED]) else latest[SPEED],
+        }
+
+    async def last_persisted(self, ride_id: str) -> Optional[dict]:
+        """Newest flushed track point, for workers that hold no live position"""
+        doc = await self.collection.find_one({"_id": ride_id}, {"last": 1})
+        if not doc or not doc.get("last"):
+            return None
+        ts, lat, lng = doc["last"]
+        return {"ts": ts, "lat": lat, "lng": lng, "heading": None, "speed": None}
+
+    def watch(self, ride_id: str):
+        """Event set whenever the ride's position changes"""
+        event = asyncio.Event()
+        self._watchers.setdefault(ride_id, set()).add(event)
+        return event
+
+    def unwatch(self, ride_id: str, event):
+        watchers = self._watchers.get(ride_id)
+        if watchers is not None:
+            watchers.discard(event)
+            if not watchers:
+                del self._watchers[ride_id]
+
+    # ---- Persistence ----
+
+    async def flush(self) -> int:
+        """Persist kept track points and drop idle rides; returns how many rides were written"""
+        pending, self._track = self._track, {}
+        self._evict()
+        if not pending:
+            return 0
+        now = datetime.utcnow()
+        writes = [
+            UpdateOne(
+                {"_id": ride_id},
+                {
+                    "$push": {"points": {"$each": points, "$slice": -self.max_track_points}},
+                    "$set": {"last": points[-1], "updated_at": now},
+                    "$setOnInsert": {"expires_at": now + self.retention},
+                },
+                upsert=True,
+            )
+            for ride_id, points in pending.items()
+        ]
+        try:
+            await self.collection.bulk_write(writes, ordered=False)
+        except Exception:
+            # Keep the points for the next flush
+            for ride_id, points in pending.items():
+                self._track[ride_id] = points + self._track.get(ride_id, [])
+            raise
+        return len(writes)
+
+    def _evict(self):
+        cutoff = time.time() - self.idle_seconds
+        for ride_id in [r for r, latest in self._latest.items() if latest[TS] < cutoff]:
+            if ride_id not in self._watchers:
+                del self._latest[ride_id]
+        for ride_id in [r for r, ts in self._last_kept.items() if ts < cutoff]:
+            del self._last_kept[ride_id]
+        now = time.monotonic()
+        self._grants = {key: expires for key, expires in self._grants.items() if expires > now}
+
+    def metrics(self) -> dict:
+        return {
+            "live_rides": len(self._latest),
+            "watchers": sum(len(w) for w in self._watchers.values()),
+            "pending_track_points": sum(len(p) for p in self._track.values()),
+            "pings": self.pings,
+            "rejected": self.rejected,
+        }
@@ -0,0 +1,180 @@
+"""
+RideShare - Places
+In-memory prefix index of the locations users have already entered
+
+Pickup/drop strings of rides and private requests are normalized (case,
+accents, punctuation, spacing) and grouped with their coordinates rounded to
+about a kilometre, so "Airport Terminal" and "airport  terminal" near the
+same spot are one place while a "Main St" in another town stays separate.
+A query matches places having a word that starts with each query word,
+most used first. For every word prefix the index keeps the top places by
+use, so a one-word query is a dictionary lookup. Longer queries start from
+the query word matching the fewest places (found by binary search in a
+sorted list of all words) and check the remaining words against those
+candidates; when even that word matches very many places, only its top
+places are checked.
+
+Only places entered by at least ``min_users`` different users are suggested,
+and with their rounded coordinates, so one passenger's home address in a
+private request never shows up in anyone's autocomplete.
+
+The index is filled once at startup and then refreshed incrementally by
+reading documents whose ``_id`` is newer than the last refresh (less an
+overlap for clock skew between app servers). Documents created by this
+process are added immediately through ``observe``.
+"""
+
+import bisect
+import heapq
+import re
+import unicodedata
+from datetime import datetime, timedelta
+from typing import Iterable, List, Optional, Tuple
+
+from bson import ObjectId
+
+# (collection, [(name field, lat field, lng field), ...], user id field)
+Source = Tuple[object, List[Tuple[str, str, str]], str]
+
+_NON_WORD = re.compile(r"[^\w]+")
+
+
+def normalize(text: str) -> str:
+    """Lowercase, strip accents and punctuation, collapse whitespace"""
+    text = unicodedata.normalize("NFKD", text)
+    text = "".join(c for c in text if not unicodedata.combining(c))
+    return " ".join(_NON_WORD.sub(" ", text.casefold()).split())
+
+
+class PlaceIndex:
+    """Popularity-ranked autocomplete over known place names"""
+
+    def __init__(self, sources: Iterable[Source], batch_size: int = 1000, overlap_seconds: float = 120,
+                 coordinate_digits: int = 2, top_k: int = 32, max_prefix: int = 12, scan_limit: int = 4096,
+                 min_users: int = 2):
+        self.sources = list(sources)
+        self.batch_size = batch_size
+        self.overlap = timedelta(seconds=overlap_seconds)
+        self.coordinate_digits = coordinate_digits
+        self.top_k = top_k
+        self.max_prefix = max_prefix
+        self.scan_limit = scan_limit
+        self.min_users = min_users
+        self.places = {}  # (normalized name, lat, lng) -> {"name", "count", "users"}
+        self._top = {}  # word prefix -> suggested place keys by descending use (at most top_k)
+        self._tokens: List[Tuple[str, tuple]] = []  # sorted (word, place key)
+        self._new_tokens: List[Tuple[str, tuple]] = []  # merged into _tokens by refresh()
+        self._watermarks = {}  # collection name -> time of the last refresh
+        self._seen = set()  # ids read within the overlap window
+
+    def __len__(self):
+        return len(self.places)
+
+    def _suggested(self, place: dict) -> bool:
+        return len(place["users"]) >= self.min_users
+
+    def _result(self, key) -> dict:
+        place = self.places[key]
+        return {"name": place["name"], "lat": key[1], "lng": key[2], "count": place["count"]}
+
+    def _rank(self, key) -> tuple:
+        return -self.places[key]["count"], key[0]
+
+    def add(self, name: Optional[str], lat: Optional[float], lng: Optional[float], user_id: Optional[str] = None,
+            count: int = 1):
+        normalized = normalize(name or "")
+        if not normalized or lat is None or lng is None:
+            return
+        key = (normalized, round(lat, self.coordinate_digits), round(lng, self.coordinate_digits))
+        place = self.places.get(key)
+        if place is None:
+            place = self.places[key] = {"name": name.strip(), "count": 0, "users": set()}
+            listed = False
+        else:
+            listed = self._suggested(place)
+        place["count"] += count
+        if not listed:
+            # User ids are only kept until min_users is reached
+            if user_id is not None:
+                place["users"].add(user_id)
+            if not self._suggested(place):
+                return
+            self._new_tokens.extend((word, key) for word in set(normalized.split()))
+
+        for word in set(normalized.split()):
+            for length in range(1, min(len(word), self.max_prefix) + 1):
+                top = self._top.setdefault(word[:length], [])
+                # A full list whose last place is used more can't contain this one
+                if len(top) == self.top_k and self.places[top[-1]]["count"] > place["count"]:
+                    continue
+                if key in top:
+                    top.remove(key)
+                bisect.insort(top, key, key=self._rank)
+                del top[self.top_k:]
+
+    def observe(self, doc: dict, fields: List[Tuple[str, str, str]], user_field: str) -> bool:
+        """Index the places of a document once, even if a refresh reads it again"""
+        if doc["_id"] in self._seen:
+            return False
+        self._seen.add(doc["_id"])
+        for name_field, lat_field, lng_field in fields:
+            self.add(doc.get(name_field), doc.get(lat_field), doc.get(lng_field), doc.get(user_field))
+        return True
+
+    async def refresh(self) -> int:
+        """Read documents created since the last refresh; returns how many were new"""
+        added = 0
+        for collection, fields, user_field in self.sources:
+            started = datetime.utcnow()
+            query = {}
+            since = self._watermarks.get(collection.name)
+            if since is not None:
+                query["_id"] = {"$gte": ObjectId.from_datetime(since - self.overlap)}
+            projection = {field: 1 for triple in fields for field in triple}
+            projection[user_field] = 1
+            async for doc in collection.find(query, projection).sort("_id", 1).batch_size(self.batch_size):
+                if self.observe(doc, fields, user_field):
+                    added += 1
+            self._watermarks[collection.name] = started
+
+        self._merge_tokens()
+        # Ids older than every overlap window can't be read again
+        oldest = min(self._watermarks.values(), default=datetime.utcnow()) - self.overlap
+        self._seen = {i for i in self._seen if i.generation_time.replace(tzinfo=None) >= oldest}
+        return added
+
+    def _merge_tokens(self):
+        if self._new_tokens:
+            self._tokens.extend(self._new_tokens)
+            self._tokens.sort()
+            self._new_tokens = []
+
+    def search(self, query: str, limit: int = 10) -> List[dict]:
+        """Places with a word starting with each query word, most used first"""
+        words = normalize(query).split()
+        if not words:
+            return []
+        if len(words) == 1 and len(words[0]) <= self.max_prefix:
+            return [self._result(key) for key in self._top.get(words[0], [])[:limit]]
+
+        ranges = {word: self._word_range(word) for word in words}
+        narrowest = min(words, key=lambda word: ranges[word][1] - ranges[word][0])
+        start, end = ranges[narrowest]
+        if end - start <= self.scan_limit or len(narrowest) > self.max_prefix:
+            candidates = {key for _, key in self._tokens[start:end]}
+            # Places added since the last refresh are not in the sorted list yet
+            candidates.update(key for w, key in self._new_tokens if w.startswith(narrowest))
+        else:
+            candidates = self._top.get(narrowest, [])
+        others = [word for word in words if word != narrowest]
+        matches = [
+            key for key in candidates
+            if all(any(w.startswith(word) for w in key[0].split()) for word in others)
+        ]
+        return [self._result(key) for key in heapq.nsmallest(limit, matches, key=self._rank)]
+
+    def _word_range(self, word: str) -> Tuple[int, int]:
+        """Slice of the sorted word list starting with word"""
+        start = bisect.bisect_left(self._tokens, (word,))
+        end = bisect.bisect_left(self._tokens, (word + "\U0010ffff",))
+        return start, end
@@ -0,0 +1,409 @@
+"""
+RideShare - Request Profiling
+Opt-in per-request profiling with a bounded report store
+"""
+
+import contextvars
+import cProfile
+import hmac
+import io
+import json
+import marshal
+import os
+import pstats
+import random
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from datetime import datetime
+from typing import Optional
+
+from pymongo import monitoring
+
+try:
+    from pyinstrument import Profiler as PyinstrumentProfiler
+except ImportError:  # pyinstrument is optional, cProfile is the fallback
+    PyinstrumentProfiler = None
+
+# Per-request Mongo timing. Motor copies the current context into its executor
+# threads, so the command listener below sees the same object as the handler.
+current_db_timing = contextvars.ContextVar("current_db_timing", default=None)
+
+
+class DBTiming:
+    """Mongo round trips and time spent waiting on them during one request"""
+
+    __slots__ = ("round_trips", "time_ms", "pool_wait_ms", "commands", "_lock")
+
+    def __init__(self):
+        self.round_trips = 0
+        self.time_ms = 0.0
+        self.pool_wait_ms = 0.0
+        self.commands = {}
+        self._lock = threading.Lock()
+
+    def record(self, command_name: str, duration_ms: float):
+        with self._lock:
+            self.round_trips += 1
+            self.time_ms += duration_ms
+            entry = self.commands.setdefault(command_name, {"count": 0, "time_ms": 0.0})
+            entry["count"] += 1
+            entry["time_ms"] += duration_ms
+
+    def record_pool_wait(self, wait_ms: float):
+        with self._lock:
+            self.pool_wait_ms += wait_ms
+
+    def to_dict(self):
+        return {
+            "round_trips": self.round_trips,
+            "time_ms": round(self.time_ms, 3),
+            "pool_wait_ms": round(self.pool_wait_ms, 3),
+            "commands": {
+                name: {"count": c["count"], "time_ms": round(c["time_ms"], 3)}
+                for name, c in self.commands.items()
+            },
+        }
+
+
+class MongoTimingListener(monitoring.CommandListener):
+    """Attribute Mongo command durations to the request that issued them"""
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        self._record(event)
+
+    def failed(self, event):
+        self._record(event)
+
+    def _record(self, event):
+        timing = current_db_timing.get()
+        if timing is not None:
+            timing.record(event.command_name, event.duration_micros / 1000)
+
+
+class PoolWaitListener(monitoring.ConnectionPoolListener):
+    """Time requests spend waiting for a pooled Mongo connection.
+
+    A long wait means the pool (maxPoolSize/maxConnecting) is too small for
+    the concurrency, not that the server is slow. Waits are added to the
+    current request's DBTiming and to process-wide totals.
+    """
+
+    # Upper bounds (ms) of the wait histogram buckets; the last bucket is open
+    BUCKETS_MS = (1, 10, 100, 1000)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.checkouts = 0
+        self.failed = 0
+        self.wait_ms = 0.0
+        self.max_wait_ms = 0.0
+        self.histogram = [0] * (len(self.BUCKETS_MS) + 1)
+        self.open_connections = 0
+
+    def connection_checked_out(self, event):
+        wait_ms = (event.duration or 0) * 1000
+        bucket = next((i for i, bound in enumerate(self.BUCKETS_MS) if wait_ms < bound), len(self.BUCKETS_MS))
+        with self._lock:
+            self.checkouts += 1
+            self.wait_ms += wait_ms
+            self.max_wait_ms = max(self.max_wait_ms, wait_ms)
+            self.histogram[bucket] += 1
+        timing = current_db_timing.get()
+        if timing is not None:
+            timing.record_pool_wait(wait_ms)
+
+    def connection_check_out_failed(self, event):
+        with self._lock:
+            self.failed += 1
+
+    def connection_created(self, event):
+        with self._lock:
+            self.open_connections += 1
+
+    def connection_closed(self, event):
+        with self._lock:
+            self.open_connections -= 1
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_check_out_started(self, event):
+        pass
+
+    def connection_checked_in(self, event):
+        pass
+
+    def metrics(self) -> dict:
+        labels = [f"<{bound}ms" for bound in self.BUCKETS_MS] + [f">={self.BUCKETS_MS[-1]}ms"]
+        return {
+            "checkouts": self.checkouts,
+            "failed_checkouts": self.failed,
+            "open_connections": self.open_connections,
+            "avg_wait_ms": round(self.wait_ms / self.checkouts, 3) if self.checkouts else 0.0,
+            "max_wait_ms": round(self.max_wait_ms, 3),
+            "wait_histogram": dict(zip(labels, self.histogram)),
+        }
+
+
+class ProfileStore:
+    """Bounded store of recent profile reports, oldest evicted first.
+
+    Reports are always kept in memory; when ``directory`` is set the profiler
+    output is written to disk instead of being held in memory.
+    """
+
+    def __init__(self, max_reports: int = 50, directory: Optional[str] = None):
+        self.max_reports = max_reports
+        self.directory = directory
+        self._reports = OrderedDict()
+        self._artifacts = {}
+        self._lock = threading.Lock()
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def add(self, report: dict, artifact: bytes):
+        with self._lock:
+            if self.directory:
+                with open(self._artifact_path(report), "wb") as f:
+                    f.write(artifact)
+                with open(os.path.join(self.directory, f"{report['id']}.json"), "w") as f:
+                    json.dump(report, f)
+            else:
+                self._artifacts[report["id"]] = artifact
+            self._reports[report["id"]] = report
+
+            while len(self._reports) > self.max_reports:
+                _, evicted = self._reports.popitem(last=False)
+                self._discard(evicted)
+
+    def list(self):
+        with self._lock:
+            return [
+                {k: v for k, v in report.items() if k != "top_functions"}
+                for report in reversed(self._reports.values())
+            ]
+
+    def get(self, profile_id: str):
+        with self._lock:
+            return self._reports.get(profile_id)
+
+    def get_artifact(self, profile_id: str):
+        with self._lock:
+            report = self._reports.get(profile_id)
+            if report is None:
+                return None
+            if not self.directory:
+                return self._artifacts.get(profile_id)
+        with open(self._artifact_path(report), "rb") as f:
+            return f.read()
+
+    def _artifact_path(self, report: dict):
+        return os.path.join(self.directory, report["artifact"])
+
+    def _discard(self, report: dict):
+        self._artifacts.pop(report["id"], None)
+        if self.directory:
+            for path in (self._artifact_path(report), os.path.join(self.directory, f"{report['id']}.json")):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+
+class ProfilingMiddleware:
+    """ASGI middleware that profiles requests carrying the debug header or
+    selected by the sampling rate. Everything else is passed straight through.
+    """
+
+    def __init__(
+        self,
+        app,
+        store: ProfileStore,
+        token: Optional[str] = None,
+        sample_rate: float = 0.0,
+        header: str = "x-debug-profile",
+        exclude_prefix: str = "/api/debug/",
+        top_functions: int = 30,
+    ):
+        self.app = app
+        self.store = store
+        self.token = token.encode() if token else None
+        self.sample_rate = sample_rate
+        self.header = header.encode()
+        self.exclude_prefix = exclude_prefix
+        self.top_functions = top_functions
+        # Profilers hook the event loop thread, so only one request at a time
+        self._active = False
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or self._active or not self._should_profile(scope):
+            await self.app(scope, receive, send)
+            return
+        self._active = True
+        try:
+            await self._profile(scope, receive, send)
+        finally:
+            self._active = False
+
+    def _should_profile(self, scope):
+        if not self.token and not self.sample_rate:
+            return False
+        if scope["path"].startswith(self.exclude_prefix):
+            return False
+        if self.token:
+            for name, value in scope["headers"]:
+                if name == self.header:
+                    return hmac.compare_digest(value, self.token)
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+    async def _profile(self, scope, receive, send):
+        profile_id = uuid.uuid4().hex[:16]
+        response_status = None
+
+        async def send_wrapper(message):
+            nonlocal response_status
+            if message["type"] == "http.response.start":
+                response_status = message["status"]
+                message["headers"] = list(message.get("headers", [])) + [
+                    (b"x-profile-id", profile_id.encode())
+                ]
+            await send(message)
+
+        timing = DBTiming()
+        timing_token = current_db_timing.set(timing)
+        use_pyinstrument = PyinstrumentProfiler is not None
+
+        started_at = datetime.utcnow()
+        wall_start = time.perf_counter()
+        cpu_start = time.thread_time()
+        if use_pyinstrument:
+            profiler = PyinstrumentProfiler(async_mode="enabled")
+            profiler.start()
+        else:
+            profiler = cProfile.Profile()
+            profiler.enable()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            if use_pyinstrument:
+                profiler.stop()
+            else:
+                profiler.disable()
+            cpu_ms = (time.thread_time() - cpu_start) * 1000
+            wall_ms = (time.perf_counter() - wall_start) * 1000
+            current_db_timing.reset(timing_token)
+
+            report = {
+                "id": profile_id,
+                "method": scope["method"],
+                "path": scope["path"],
+                "query": scope.get("query_string", b"").decode("latin-1"),
+                "status": response_status,
+                "started_at": started_at.isoformat(),
+                "wall_ms": round(wall_ms, 3),
+                # CPU time of the event loop thread while the request was in
+                # flight; includes any concurrently running requests.
+                "cpu_ms": round(cpu_ms, 3),
+                "awaited_ms": round(max(wall_ms - cpu_ms, 0.0), 3),
+                "db": timing.to_dict(),
+            }
+            if use_pyinstrument:
+                report["profiler"] = "pyinstrument"
+                report["artifact"] = f"{profile_id}.txt"
+                report["top_functions"] = self._top_sampled_functions(profiler.last_session.root_frame())
+                artifact = profiler.output_text(unicode=True, color=False).encode()
+            else:
+                report["profiler"] = "cprofile"
+                report["artifact"] = f"{profile_id}.prof"
+                report["top_functions"] = self._top_functions(profiler)
+                artifact = marshal.dumps(pstats.Stats(profiler).stats)
+            self.store.add(report, artifact)
+
+    def _top_functions(self, profiler):
+        stats = pstats.Stats(profiler, stream=io.StringIO())
+        rows = []
+        for (filename, lineno, name), (_, ncalls, tottime, cumtime, _) in stats.stats.items():
+            rows.append({
+                "function": f"{os.path.basename(filename)}:{lineno}({name})",
+                "calls": ncalls,
+                "self_ms": round(tottime * 1000, 3),
+                "cumulative_ms": round(cumtime * 1000, 3),
+            })
+        rows.sort(key=lambda r: r["cumulative_ms"], reverse=True)
+        return rows[: self.top_functions]
+
+    def _top_sampled_functions(self, root):
+        """Rows like _top_functions from a pyinstrument frame tree (sampled, so no call counts)"""
+        totals = {}
+
+        def visit(frame, active):
+            if frame is None or frame.is_synthetic:
+                return
+            key = f"{os.path.basename(frame.file_path or '')}:{frame.line_no}({frame.function})"
+            row = totals.setdefault(key, {"function": key, "calls": None, "self_ms": 0.0, "cumulative_ms": 0.0})
+            row["self_ms"] += frame.total_self_time * 1000
+            # Recursive calls are already inside the outer call's time
+            if key not in active:
+                row["cumulative_ms"] += frame.time * 1000
+            for child in frame.children:
+                visit(child, active | {key})
+
+        visit(root, frozenset())
+        rows = sorted(totals.values(), key=lambda r: r["cumulative_ms"], reverse=True)[: self.top_functions]
+        for row in rows:
+            row["self_ms"] = round(row["self_ms"], 3)
+            row["cumulative_ms"] = round(row["cumulative_ms"], 3)
+        return rows
+
+
+class DBRoundTripMiddleware:
+    """ASGI middleware that counts Mongo round trips per request and reports
+    them in the X-DB-Round-Trips, X-DB-Time-Ms and X-DB-Pool-Wait-Ms
+    response headers.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        timing = current_db_timing.get()
+        token = None
+        if timing is None:
+            timing = DBTiming()
+            token = current_db_timing.set(timing)
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                message["headers"] = list(message.get("headers", [])) + [
+                    (b"x-db-round-trips", str(timing.round_trips).encode()),
+                    (b"x-db-time-ms", f"{timing.time_ms:.3f}".encode()),
+                    (b"x-db-pool-wait-ms", f"{timing.pool_wait_ms:.3f}".encode()),
+                ]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            if token is not None:
+                current_db_timing.reset(token)
@@ -0,0 +1,139 @@
+"""
+RideShare - Recurring Rides
+Ride series (commute templates) and lazy materialization of their occurrences
+
+A series stores the ride once with a weekday mask and a date range. Its
+occurrences are ordinary rides (tagged with ``series_id``), so search,
+booking and chat work on them unchanged. They are only created a bounded
+horizon ahead: the scheduler looks at series whose ``materialized_until`` is
+behind the horizon and inserts the missing occurrences with one
+``insert_many`` per batch of series. A unique (series_id, date) index makes
+materialization idempotent when several workers run it at once.
+"""
+
+from datetime import date, datetime, timedelta
+from typing import Callable, Iterable, List, Optional
+
+from bson import ObjectId
+from pymongo.errors import BulkWriteError
+
+from events import ride_created_event, with_event_doc
+from segments import segment_count
+
+# Template fields copied onto every occurrence
+OCCURRENCE_FIELDS = (
+    "pickup_location", "pickup_lat", "pickup_lng", "drop_location", "drop_lat", "drop_lng", "stops",
+    "time", "available_seats", "price_per_seat", "car_model", "car_number", "notes",
+)
+
+
+def occurrence_dates(series: dict, after: date, until: date) -> List[date]:
+    """Dates of a series' occurrences in (after, until]"""
+    first = max(date.fromisoformat(series["start_date"]), after + timedelta(days=1))
+    last = until
+    if series.get("end_date"):
+        last = min(last, date.fromisoformat(series["end_date"]))
+    weekdays = set(series["weekdays"])
+    days = []
+    day = first
+    while day <= last:
+        if day.weekday() in weekdays:
+            days.append(day)
+        day += timedelta(days=1)
+    return days
+
+
+class RideSeriesScheduler:
+    """Materializes upcoming occurrences of ride series"""
+
+    def __init__(self, storage, horizon_days: int = 14, batch_size: int = 100,
+                 on_insert: Optional[Callable[[List[dict]], None]] = None):
+        self.storage = storage
+        self.horizon_days = horizon_days
+        self.batch_size = batch_size
+        self.on_insert = on_insert  # Called with the occurrences created
+
+    def horizon(self) -> date:
+        return datetime.utcnow().date() + timedelta(days=self.horizon_days)
+
+    async def materialize_due(self) -> int:
+        """Top up every active series that is behind the horizon; returns rides created"""
+        horizon = self.horizon().isoformat()
+        await self.storage.ride_series.update_many(
+            {"status": "active", "end_date": {"$lt": datetime.utcnow().date().isoformat()}},
+            {"$set": {"status": "completed", "updated_at": datetime.utcnow()}},
+        )
+        created = 0
+        while True:
+            # Each pass advances materialized_until, so this loop drains the backlog
+            batch = await self.storage.ride_series.find({
+                "status": "active",
+                "materialized_until": {"$lt": horizon},
+            }).to_list(self.batch_size)
+            if not batch:
+                return created
+            created += await self.materialize(batch)
+
+    async def materialize(self, series_list: Iterable[dict]) -> int:
+        series_list = list(series_list)
+        horizon = self.horizon()
+        today = datetime.utcnow().date()
+
+        # Current driver details for the denormalized fields; series of deleted
+        # accounts get no new occurrences while the deletion cascade runs
+        driver_ids = {ObjectId(s["driver_id"]) for s in series_list}
+        drivers = {
+            str(u["_id"]): u
+            for u in await self.storage.users.find(
+                {"_id": {"$in": list(driver_ids)}, "deleted_at": {"$exists": False}},
+                {"name": 1, "photo": 1, "rating": 1}
+            ).to_list(None)
+        }
+
+        now = datetime.utcnow()
+        rides = []
+        for series in series_list:
+            driver = drivers.get(series["driver_id"])
+            if driver is None:
+                continue
+            # Never backfill days that are already past
+            after = max(date.fromisoformat(series["materialized_until"]), today - timedelta(days=1))
+            for day in occurrence_dates(series, after, horizon):
+                ride = {field: series.get(field) for field in OCCURRENCE_FIELDS}
+                ride.update({
+                    "_id": ObjectId(),
+                    "date": day.isoformat(),
+                    "series_id": str(series["_id"]),
+                    "driver_id": series["driver_id"],
+                    "driver_name": driver.get("name", "Unknown Driver"),
+                    "driver_photo": driver.get("photo"),
+                    "driver_rating": driver.get("rating", 0.0),
+                    "status": "active",
+                    "booked_seats": 0,
+                    "segment_seats": [0] * segment_count(series),
+                    "created_at": now,
+                    "updated_at": now,
+                })
+                rides.append(with_event_doc(ride, ride_created_event(ride)))
+
+        created = []
+        if rides:
+            try:
+                await self.storage.rides.insert_many(rides, ordered=False)
+                created = rides
+            except BulkWriteError as e:
+                # Occurrences another worker already created
+                if any(err["code"] != 11000 for err in e.details["writeErrors"]):
+                    raise
+                duplicates = {err["index"] for err in e.details["writeErrors"]}
+                created = [ride for i, ride in enumerate(rides) if i not in duplicates]
+        if self.on_insert and created:
+            self.on_insert(created)
+
+        await self.storage.ride_series.update_many(
+            {"_id": {"$in": [s["_id"] for s in series_list]}, "status": "active"},
+            {"$max": {"materialized_until": horizon.isoformat()}},
+        )
+        for series in series_list:
+            series["materialized_until"] = max(series["materialized_until"], horizon.isoformat())
+        return len(created)
@@ -0,0 +1,158 @@
+"""
+RideShare - Ride Import
+Streaming bulk import of rides from NDJSON or CSV
+
+The request body is consumed chunk by chunk and parsed line by line; valid
+rows are buffered only up to one insert_many batch, so memory stays bounded
+however large the upload is. Every failed row is reported with its line
+number (up to a cap). In ordered mode the import stops at the first failed
+row, like an ordered insert_many; unordered mode skips bad rows and keeps
+going.
+"""
+
+import csv
+import json
+from typing import AsyncIterator, Callable, List, Optional
+
+from bson import ObjectId
+from pydantic import BaseModel, ValidationError
+from pymongo.errors import BulkWriteError
+
+FORMATS = ("ndjson", "csv")
+
+
+async def iter_lines(chunks: AsyncIterator[bytes], max_line_bytes: int):
+    """Split a byte stream into (line number, line) pairs; oversized lines yield None"""
+    buffer = b""
+    number = 0
+    skipping = False
+    async for chunk in chunks:
+        buffer += chunk
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            if skipping:
+                # Tail of an oversized line already reported
+                skipping = False
+                continue
+            number += 1
+            yield number, line.rstrip(b"\r") if len(line) <= max_line_bytes else None
+        if len(buffer) > max_line_bytes and not skipping:
+            number += 1
+            yield number, None
+            skipping = True
+            buffer = b""
+        elif skipping:
+            buffer = b""
+    if buffer and not skipping:
+        yield number + 1, buffer.rstrip(b"\r")
+
+
+def _validation_message(error: ValidationError) -> str:
+    return "; ".join(f"{'.'.join(str(p) for p in e['loc'])}: {e['msg']}" for e in error.errors())
+
+
+class RideImporter:
+    """Validates rows with a pydantic model and inserts them in batches"""
+
+    def __init__(self, collection, model: type, batch_size: int = 500,
+                 max_line_bytes: int = 64 * 1024, max_errors: int = 1000,
+                 on_insert: Optional[Callable[[List[dict]], None]] = None):
+        self.collection = collection
+        self.model = model
+        self.batch_size = batch_size
+        self.max_line_bytes = max_line_bytes
+        self.max_errors = max_errors
+        self.on_insert = on_insert  # Called with the rides of each written batch
+
+    async def run(self, chunks: AsyncIterator[bytes], fmt: str, build: Callable[[BaseModel], dict],
+                  ordered: bool = False, dry_run: bool = False) -> dict:
+        """Import a stream; build() turns a validated row into the ride document"""
+        import_id = str(ObjectId())
+        report = {
+            "import_id": import_id, "rows": 0, "valid": 0, "inserted": 0, "failed": 0,
+            "errors": [], "completed": True,
+        }
+        batch: List[dict] = []
+        batch_lines: List[int] = []
+        header: Optional[List[str]] = None
+
+        def fail(line_number: int, message: str):
+            report["failed"] += 1
+            if len(report["errors"]) < self.max_errors:
+                report["errors"].append({"line": line_number, "error": message})
+
+        async for number, line in iter_lines(chunks, self.max_line_bytes):
+            if line is not None and not line.strip():
+                continue
+            if fmt == "csv" and header is None and line is not None:
+                header = [name.strip() for name in next(csv.reader([line.decode("utf-8-sig")]))]
+                continue
+
+            report["rows"] += 1
+            try:
+                if line is None:
+                    raise ValueError(f"Row is longer than {self.max_line_bytes} bytes")
+                ride = build(self.model.model_validate(self._parse(line, fmt, header)))
+            except ValidationError as e:
+                fail(number, _validation_message(e))
+            except ValueError as e:
+                fail(number, str(e))
+            else:
+                ride["import_id"] = import_id
+                batch.append(ride)
+                batch_lines.append(number)
+                report["valid"] += 1
+
+            # Write when the batch is full, or up to a bad row that stops an ordered import
+            stop = ordered and report["failed"] > 0
+            if len(batch) < self.batch_size and not stop:
+                continue
+            if batch and not await self._flush(batch, batch_lines, report, fail, ordered, dry_run):
+                stop = True
+            batch, batch_lines = [], []
+            if stop:
+                report["completed"] = False
+                return report
+
+        if batch and not await self._flush(batch, batch_lines, report, fail, ordered, dry_run):
+            report["completed"] = False
+        return report
+
+    @staticmethod
+    def _parse(line: bytes, fmt: str, header: Optional[List[str]]) -> dict:
+        text = line.decode("utf-8")
+        if fmt == "ndjson":
+            try:
+                row = json.loads(text)
+            except json.JSONDecodeError as e:
+                raise ValueError(f"Invalid JSON: {e.msg}")
+            if not isinstance(row, dict):
+                raise ValueError("Row must be a JSON object")
+            return row
+        values = next(csv.reader([text]))
+        if len(values) != len(header):
+            raise ValueError(f"Expected {len(header)} columns, got {len(values)}")
+        # Empty cells are missing values
+        return {name: value for name, value in zip(header, values) if value != ""}
+
+    async def _flush(self, batch: List[dict], lines: List[int], report: dict, fail,
+                     ordered: bool, dry_run: bool) -> bool:
+        """Insert one batch; returns False if an ordered import must stop"""
+        if dry_run:
+            return True
+        try:
+            result = await self.collection.insert_many(batch, ordered=ordered)
+            report["inserted"] += len(result.inserted_ids)
+            inserted = batch
+        except BulkWriteError as e:
+            report["inserted"] += e.details["nInserted"]
+            failed = set()
+            for error in e.details["writeErrors"]:
+                fail(lines[error["index"]], error["errmsg"])
+                failed.add(error["index"])
+            # An ordered insert stops at its first error
+            end = min(failed) if ordered else len(batch)
+            inserted = [ride for i, ride in enumerate(batch[:end]) if i not in failed]
+        if self.on_insert and inserted:
+            self.on_insert(inserted)
+        return len(inserted) == len(batch) or not ordered
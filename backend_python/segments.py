@@ -0,0 +1,116 @@
+"""
+RideShare - Ride Segments
+Per-segment seat inventory for rides with intermediate stops
+
+A ride's route is pickup, its ``stops`` in order, then drop; consecutive
+points bound its segments. ``segment_seats`` holds the seats taken on each
+segment, so a passenger riding A→B and another riding B→C can share a seat.
+``booked_seats`` is kept equal to the busiest segment, which is what
+"seats left" means for the whole route.
+
+Seat changes are expressed as a delta per segment and applied with one
+conditional pipeline update: the filter checks capacity on the segments the
+delta adds to, and the update adds the deltas and recomputes
+``booked_seats``. Both are O(segments) and the update is atomic, so
+concurrent overlapping bookings cannot oversell a segment. Rides created
+before stops existed have no ``segment_seats``; they read as a single
+segment holding ``booked_seats`` and are converted by their first update.
+"""
+
+from datetime import datetime
+from typing import List, Tuple
+
+from bson import ObjectId
+
+# segment_seats of a ride, falling back to a one-segment ride
+SEGMENT_SEATS = {"$ifNull": ["$segment_seats", ["$booked_seats"]]}
+
+
+def route(ride: dict) -> List[dict]:
+    """Points of the route: pickup, stops, drop"""
+    return [
+        {"location": ride["pickup_location"], "lat": ride["pickup_lat"], "lng": ride["pickup_lng"]},
+        *(ride.get("stops") or []),
+        {"location": ride["drop_location"], "lat": ride["drop_lat"], "lng": ride["drop_lng"]},
+    ]
+
+
+def segment_count(ride: dict) -> int:
+    return len(ride.get("stops") or []) + 1
+
+
+def segment_seats(ride: dict) -> List[int]:
+    return ride.get("segment_seats") or [ride.get("booked_seats", 0)]
+
+
+def booking_legs(booking: dict) -> Tuple[int, int]:
+    """(from_stop, to_stop) of a booking; older bookings cover the whole single-segment ride"""
+    return booking.get("from_stop", 0), booking.get("to_stop", 1)
+
+
+def seats_free(ride: dict, from_stop: int, to_stop: int) -> int:
+    """Seats free on every segment between two route points"""
+    return ride["available_seats"] - max(segment_seats(ride)[from_stop:to_stop])
+
+
+def closest_legs(ride: dict, pickup: Tuple[float, float], drop: Tuple[float, float]) -> Tuple[int, int, float]:
+    """Route points nearest to a pickup and drop, in travel order; returns (from, to, distance)"""
+    points = [(p["lat"], p["lng"]) for p in route(ride)]
+
+    def distance(point, target):
+        # Simple distance calculation (not accurate for large distances)
+        return abs(point[0] - target[0]) + abs(point[1] - target[1])
+
+    best = None
+    for i in range(len(points) - 1):
+        for j in range(i + 1, len(points)):
+            score = distance(points[i], pickup) + distance(points[j], drop)
+            if best is None or score < best[2]:
+                best = (i, j, score)
+    return best
+
+
+def add_seats(deltas: List[int], from_stop: int, to_stop: int, seats: int):
+    """Add seats to the segments between two route points of a delta vector"""
+    if len(deltas) < to_stop:
+        deltas.extend([0] * (to_stop - len(deltas)))
+    for segment in range(from_stop, to_stop):
+        deltas[segment] += seats
+
+
+def booking_deltas(booking: dict) -> List[int]:
+    """Seats a booking holds on each segment"""
+    deltas: List[int] = []
+    add_seats(deltas, *booking_legs(booking), booking["seats"])
+    return deltas
+
+
+def capacity_filter(ride_id: str, deltas: List[int]) -> dict:
+    """Filter matching the ride only if every segment can take its added seats"""
+    checks = [
+        {"$lte": [{"$add": [{"$arrayElemAt": [SEGMENT_SEATS, segment]}, seats]}, "$available_seats"]}
+        for segment, seats in enumerate(deltas) if seats > 0
+    ]
+    query = {"_id": ObjectId(ride_id)}
+    if checks:
+        query["$expr"] = {"$and": checks}
+    return query
+
+
+def seats_update(deltas: List[int]) -> List[dict]:
+    """Pipeline update adding deltas to segment_seats and refreshing booked_seats and updated_at"""
+    return [
+        {"$set": {"segment_seats": {"$map": {
+            "input": {"$range": [0, {"$size": SEGMENT_SEATS}]},
+            "as": "segment",
+            "in": {"$add": [
+                {"$arrayElemAt": [SEGMENT_SEATS, "$$segment"]},
+                {"$ifNull": [{"$arrayElemAt": [{"$literal": deltas}, "$$segment"]}, 0]},
+            ]},
+        }}}},
+        {"$set": {"booked_seats": {"$max": "$segment_seats"}, "updated_at": datetime.utcnow()}},
+    ]
+
+
+def negate(deltas: List[int]) -> List[int]:
+    return [-seats for seats in deltas]
@@ -0,0 +1,96 @@
+"""
+RideShare - Production Server
+Multi-worker entry point: gunicorn supervising uvicorn workers on uvloop/httptools
+
+The app is imported once in the master and workers are forked from it
+(preload), which mostly saves import time: reference counting soon copies
+the pages of shared objects. This is safe because the Mongo client opens no
+connections until first used, which happens after the fork: each worker gets
+its own pool, background loops and job workers from the app's lifespan. For
+the same reason state loaded from the database is built per worker after the
+fork, notably the place index (a scan of all rides and private requests) and
+the ETag, token and search caches.
+
+On SIGTERM a worker stops accepting connections, lets in-flight requests
+finish for up to GRACEFUL_TIMEOUT seconds less a margin, then runs the
+lifespan shutdown, which stops background loops, flushes buffered counts and
+closes the client. Workers are not recycled by default, since a replacement
+rebuilds all of that state. In-process caches are bounded; set MAX_REQUESTS
+(with a random jitter so workers don't all restart together) only to contain
+a leak, high enough that replacements stay rare.
+
+Usage:
+    python serve.py [--workers N] [--bind 0.0.0.0:8001] [--max-requests N]
+"""
+
+import argparse
+import os
+
+from gunicorn.app.base import BaseApplication
+from uvicorn.workers import UvicornWorker
+
+# Seconds of GRACEFUL_TIMEOUT kept for the lifespan shutdown after draining
+SHUTDOWN_MARGIN_SECONDS = 5
+
+
+class RideShareWorker(UvicornWorker):
+    """Uvicorn worker pinned to uvloop and httptools"""
+
+    CONFIG_KWARGS = {"loop": "uvloop", "http": "httptools", "lifespan": "on"}
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Stop waiting for open connections (e.g. WebSockets) in time for the
+        # lifespan shutdown to run before gunicorn kills the worker
+        self.config.timeout_graceful_shutdown = max(self.cfg.graceful_timeout - SHUTDOWN_MARGIN_SECONDS, 1)
+
+
+class RideShareServer(BaseApplication):
+    """Gunicorn application serving server:app with the given settings"""
+
+    def __init__(self, options: dict):
+        self.options = options
+        super().__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+
+    def load(self):
+        from server import app, storage
+
+        if storage.backend == "memory" and self.cfg.workers > 1:
+            print("WARNING: Each worker has its own in-memory storage; use STORAGE_BACKEND=mongo with several workers")
+        return app
+
+
+def options_from_env(**overrides) -> dict:
+    """Gunicorn settings from the environment, with overrides taking precedence"""
+    options = {
+        "bind": os.getenv("BIND", f"0.0.0.0:{os.getenv('PORT', '8001')}"),
+        "workers": int(os.getenv("WEB_CONCURRENCY", str(os.cpu_count() or 1))),
+        "worker_class": "serve.RideShareWorker",
+        "preload_app": True,
+        "max_requests": int(os.getenv("MAX_REQUESTS", "0")),
+        "max_requests_jitter": int(os.getenv("MAX_REQUESTS_JITTER", "10000")),
+        "graceful_timeout": int(os.getenv("GRACEFUL_TIMEOUT", "30")),
+        "timeout": int(os.getenv("WORKER_TIMEOUT", "60")),
+        "keepalive": int(os.getenv("KEEPALIVE_SECONDS", "5")),
+        "accesslog": os.getenv("ACCESS_LOG") or None,
+    }
+    options.update({key: value for key, value in overrides.items() if value is not None})
+    return options
+
+
+def main():
+    parser = argparse.ArgumentParser(description="RideShare production server")
+    parser.add_argument("--workers", type=int, help="Worker processes (default: WEB_CONCURRENCY or CPU count)")
+    parser.add_argument("--bind", help="Address to listen on (default: BIND or 0.0.0.0:$PORT)")
+    parser.add_argument("--max-requests", type=int, help="Requests a worker serves before it is replaced (default: MAX_REQUESTS or 0, never)")
+    args = parser.parse_args()
+
+    RideShareServer(options_from_env(workers=args.workers, bind=args.bind, max_requests=args.max_requests)).run()
+
+
+if __name__ == "__main__":
+    main()
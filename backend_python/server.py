@@ -3,58 +3,294 @@ RideShare - Carpooling App Backend
 A BlaBlaCar-style carpooling application API
 """
 
-from fastapi import FastAPI, HTTPException, Depends, status, UploadFile, File
+from fastapi import FastAPI, HTTPException, Depends, Header, Request, status, UploadFile, File, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import Response, StreamingResponse
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
+from contextlib import asynccontextmanager
 from pydantic import BaseModel, Field
+from pymongo import ReturnDocument, UpdateOne
 from typing import Optional, List
-from datetime import datetime, timedelta
+from datetime import date, datetime, timedelta, timezone
 from bson import ObjectId
-from motor.motor_asyncio import AsyncIOMotorClient
 from jose import jwt, JWTError
 from passlib.context import CryptContext
 import os
 import random
 import string
+import asyncio
 import base64
+import hmac
+import json
+import time
+import uuid
 from dotenv import load_dotenv
 
+from profiling import ProfileStore, ProfilingMiddleware, DBRoundTripMiddleware, MongoTimingListener, PoolWaitListener
+from storage import create_storage
+from sessions import TokenCache, RevocationList
+from jobs import JobQueue
+from account_deletion import AccountDeletionCascade
+from fanout import ProfileFanout
+from recurring import RideSeriesScheduler
+from ride_import import RideImporter, FORMATS as IMPORT_FORMATS
+from data_export import UserDataExport
+from places import PlaceIndex
+from corridors import CorridorRollup, SearchWarmer
+from etags import ETagCache, make_etag, etag_matches, not_modified, set_etag
+from live_locations import LiveLocations
+from idempotency import IdempotencyStore, IdempotencyMiddleware
+from admission import AdmissionController, AdmissionMiddleware, CRITICAL, NORMAL, LOW
+from archival import Archiver
+from segments import (
+    route, segment_count, seats_free, closest_legs, add_seats, booking_legs,
+    booking_deltas, capacity_filter, seats_update, negate, SEGMENT_SEATS,
+)
+from events import (
+    EventStream, NDJSONFileSink, WebhookSink, new_event, with_event, with_event_doc, event_json, ride_created_event,
+    ride_cancelled_event, booking_status_event, BOOKING_EVENT_FIELDS,
+)
+from analytics import AnalyticsRollup, GRANULARITIES
+
 load_dotenv()
 
 # ============== Configuration ==============
 MONGO_URL = os.getenv("MONGO_URL", "mongodb://localhost:27017")
 DB_NAME = os.getenv("DB_NAME", "rideshare_db")
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "mongo")  # "mongo" or "memory"
+# Mongo client pool, timeouts and wire compression (MONGO_COMPRESSORS=zstd,zlib;
+# zstd needs the zstandard package); unset variables keep the driver defaults
+MONGO_CLIENT_OPTIONS = {
+    option: cast(os.environ[variable])
+    for option, variable, cast in (
+        ("maxPoolSize", "MONGO_MAX_POOL_SIZE", int),
+        ("minPoolSize", "MONGO_MIN_POOL_SIZE", int),
+        ("maxConnecting", "MONGO_MAX_CONNECTING", int),
+        ("maxIdleTimeMS", "MONGO_MAX_IDLE_TIME_MS", int),
+        ("waitQueueTimeoutMS", "MONGO_WAIT_QUEUE_TIMEOUT_MS", int),
+        ("connectTimeoutMS", "MONGO_CONNECT_TIMEOUT_MS", int),
+        ("socketTimeoutMS", "MONGO_SOCKET_TIMEOUT_MS", int),
+        ("serverSelectionTimeoutMS", "MONGO_SERVER_SELECTION_TIMEOUT_MS", int),
+        ("compressors", "MONGO_COMPRESSORS", str),
+        ("appname", "MONGO_APP_NAME", str),
+    )
+    if os.getenv(variable)
+}
+# Ride search/listings, corridor stats and other users' profiles and reviews
+# read from secondaries at most MONGO_MAX_STALENESS_SECONDS behind (MongoDB's
+# minimum is 90); SECONDARY_READS=false keeps every read on the primary
+SECONDARY_READS = os.getenv("SECONDARY_READS", "true").lower() == "true"
+MONGO_MAX_STALENESS_SECONDS = int(os.getenv("MONGO_MAX_STALENESS_SECONDS", "90"))
+SECONDARY_READ_CONCERN = os.getenv("SECONDARY_READ_CONCERN", "local")
 SECRET_KEY = os.getenv("SECRET_KEY", "rideshare-secret-key-2025-carpooling-app")
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_DAYS = 30
+TOKEN_CACHE_SIZE = int(os.getenv("TOKEN_CACHE_SIZE", "10000"))
+REVOCATION_SYNC_SECONDS = float(os.getenv("REVOCATION_SYNC_SECONDS", "5"))
+DELETION_BATCH_SIZE = int(os.getenv("DELETION_BATCH_SIZE", "500"))
+
+# Background jobs: JOB_WORKERS workers run inside the API process; set it to
+# 0 when jobs are run by the separate worker entry point (worker.py)
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "2"))
+JOB_VISIBILITY_TIMEOUT = float(os.getenv("JOB_VISIBILITY_TIMEOUT", "60"))
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "5"))
+SMS_DELIVERY = os.getenv("SMS_DELIVERY", "false").lower() == "true"
+IMPORT_BATCH_SIZE = int(os.getenv("IMPORT_BATCH_SIZE", "1000"))
+EXPORT_BATCH_SIZE = int(os.getenv("EXPORT_BATCH_SIZE", "500"))
+MAX_RIDE_STOPS = int(os.getenv("MAX_RIDE_STOPS", "8"))
+# Ride/search volume per corridor (pair of CORRIDOR_CELL_DEGREES grid cells) is
+# flushed every CORRIDOR_FLUSH_SECONDS; searches of the CORRIDOR_TOP_N busiest
+# corridors are served from results warmed every CORRIDOR_WARM_SECONDS
+CORRIDOR_CELL_DEGREES = float(os.getenv("CORRIDOR_CELL_DEGREES", "0.05"))
+CORRIDOR_FLUSH_SECONDS = float(os.getenv("CORRIDOR_FLUSH_SECONDS", "10"))
+CORRIDOR_WARM_SECONDS = float(os.getenv("CORRIDOR_WARM_SECONDS", "60"))
+CORRIDOR_TOP_N = int(os.getenv("CORRIDOR_TOP_N", "20"))
+# Conditional GETs trust an ETag served in the last ETAG_CACHE_SECONDS without
+# reading the database; bodies of GZIP_MIN_BYTES or more are compressed
+ETAG_CACHE_SECONDS = float(os.getenv("ETAG_CACHE_SECONDS", "2"))
+GZIP_MIN_BYTES = int(os.getenv("GZIP_MIN_BYTES", "1024"))
+# Live driver locations stay in memory; one point per LOCATION_TRACK_SECONDS
+# is kept for the ride's track and written every LOCATION_FLUSH_SECONDS
+LOCATION_TRACK_SECONDS = float(os.getenv("LOCATION_TRACK_SECONDS", "15"))
+LOCATION_FLUSH_SECONDS = float(os.getenv("LOCATION_FLUSH_SECONDS", "10"))
+LOCATION_GRANT_SECONDS = float(os.getenv("LOCATION_GRANT_SECONDS", "60"))
+MAX_LOCATION_BATCH = int(os.getenv("MAX_LOCATION_BATCH", "500"))
+# Responses to requests with an Idempotency-Key are kept IDEMPOTENCY_TTL_SECONDS;
+# a retry of a request still running waits up to IDEMPOTENCY_WAIT_SECONDS for it
+IDEMPOTENCY_TTL_SECONDS = float(os.getenv("IDEMPOTENCY_TTL_SECONDS", "86400"))
+IDEMPOTENCY_WAIT_SECONDS = float(os.getenv("IDEMPOTENCY_WAIT_SECONDS", "10"))
+IDEMPOTENT_ROUTES = {
+    ("POST", "/api/bookings"),
+    ("POST", "/api/rides"),
+    ("POST", "/api/chats/message"),
+    ("POST", "/api/reviews"),
+}
+# Admission control: requests over their class's in-flight cap get 503. The
+# normal/low caps shrink while event-loop lag or critical-request latency is
+# over target and grow back after; normal/low requests are also limited to
+# ADMISSION_USER_RATE per second per user (0 disables the buckets)
+ADMISSION_CONTROL = os.getenv("ADMISSION_CONTROL", "true").lower() == "true"
+ADMISSION_MAX_INFLIGHT = {
+    CRITICAL: int(os.getenv("ADMISSION_MAX_INFLIGHT_CRITICAL", "500")),
+    NORMAL: int(os.getenv("ADMISSION_MAX_INFLIGHT_NORMAL", "200")),
+    LOW: int(os.getenv("ADMISSION_MAX_INFLIGHT_LOW", "100")),
+}
+ADMISSION_MIN_INFLIGHT = int(os.getenv("ADMISSION_MIN_INFLIGHT", "4"))
+ADMISSION_INTERVAL_SECONDS = float(os.getenv("ADMISSION_INTERVAL_SECONDS", "0.5"))
+ADMISSION_LAG_TARGET_MS = float(os.getenv("ADMISSION_LAG_TARGET_MS", "50"))
+ADMISSION_LATENCY_TARGET_MS = float(os.getenv("ADMISSION_LATENCY_TARGET_MS", "250"))
+ADMISSION_USER_RATE = float(os.getenv("ADMISSION_USER_RATE", "20"))
+ADMISSION_USER_BURST = float(os.getenv("ADMISSION_USER_BURST", "40"))
+ADMISSION_ROUTE_CLASSES = [
+    ("*", r"/api/auth/.*", CRITICAL),
+    ("*", r"/api/bookings(/.*)?", CRITICAL),
+    ("GET", r"/api/health", CRITICAL),
+    ("*", r"/api/users/profile", CRITICAL),
+    ("POST", r"/api/rides/search", LOW),
+    ("GET", r"/api/rides", LOW),
+    ("GET", r"/api/rides/(my-rides|dashboard|popular-routes)", LOW),
+    ("GET", r"/api/ride-series", LOW),
+    ("GET", r"/api/private-requests(/nearby)?", LOW),
+    ("GET", r"/api/places/autocomplete", LOW),
+    ("GET", r"/api/reviews/user/[^/]+", LOW),
+]
+# Rides and bookings (with their chats) dated more than ARCHIVE_AFTER_DAYS ago
+# are moved to archive collections by a job enqueued every ARCHIVE_INTERVAL_SECONDS
+ARCHIVE_AFTER_DAYS = int(os.getenv("ARCHIVE_AFTER_DAYS", "90"))
+ARCHIVE_INTERVAL_SECONDS = float(os.getenv("ARCHIVE_INTERVAL_SECONDS", "3600"))
+ARCHIVE_BATCH_SIZE = int(os.getenv("ARCHIVE_BATCH_SIZE", "500"))
+# Autocomplete picks up places created by other app servers every PLACES_REFRESH_SECONDS
+PLACES_REFRESH_SECONDS = float(os.getenv("PLACES_REFRESH_SECONDS", "30"))
+# A place is only suggested once PLACES_MIN_USERS different users have entered it
+PLACES_MIN_USERS = int(os.getenv("PLACES_MIN_USERS", "2"))
+# Occurrences of recurring rides are created RIDE_SERIES_HORIZON_DAYS ahead
+RIDE_SERIES_HORIZON_DAYS = int(os.getenv("RIDE_SERIES_HORIZON_DAYS", "14"))
+RIDE_SERIES_SCHEDULE_SECONDS = float(os.getenv("RIDE_SERIES_SCHEDULE_SECONDS", "3600"))
+# Name/photo/rating copies are refreshed FANOUT_DELAY_SECONDS after a change
+# (coalescing bursts), writing at most FANOUT_DOCS_PER_SECOND documents
+FANOUT_DELAY_SECONDS = float(os.getenv("FANOUT_DELAY_SECONDS", "5"))
+FANOUT_CHUNK_SIZE = int(os.getenv("FANOUT_CHUNK_SIZE", "500"))
+FANOUT_DOCS_PER_SECOND = float(os.getenv("FANOUT_DOCS_PER_SECOND", "2000"))
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")  # Enables /api/debug and /api/admin endpoints
+
+# Event feed: outbox events are relayed every EVENT_POLL_SECONDS and kept for
+# EVENT_RETENTION_DAYS; optional sinks get every event at least once. Bulk
+# status changes write one event per document, EVENT_BATCH_SIZE per bulk write
+EVENT_POLL_SECONDS = float(os.getenv("EVENT_POLL_SECONDS", "1"))
+EVENT_BATCH_SIZE = int(os.getenv("EVENT_BATCH_SIZE", "500"))
+EVENT_RETENTION_DAYS = int(os.getenv("EVENT_RETENTION_DAYS", "7"))
+EVENT_NDJSON_PATH = os.getenv("EVENT_NDJSON_PATH")
+EVENT_WEBHOOK_URL = os.getenv("EVENT_WEBHOOK_URL")
+EVENT_WEBHOOK_SECRET = os.getenv("EVENT_WEBHOOK_SECRET")
+# Ops statistics are rolled up from the event feed per hour and day and per
+# ANALYTICS_REGION_DEGREES grid cell; /api/admin/stats reads only the rollups
+ANALYTICS_REGION_DEGREES = float(os.getenv("ANALYTICS_REGION_DEGREES", "0.5"))
+ANALYTICS_HOURLY_RETENTION_DAYS = int(os.getenv("ANALYTICS_HOURLY_RETENTION_DAYS", "30"))
+ANALYTICS_DAILY_RETENTION_DAYS = int(os.getenv("ANALYTICS_DAILY_RETENTION_DAYS", "730"))
+
+# Profiling: requests carrying "X-Debug-Profile: <ADMIN_TOKEN>" are always
+# profiled, others are sampled at PROFILE_SAMPLE_RATE (0 disables sampling)
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_MAX_REPORTS = int(os.getenv("PROFILE_MAX_REPORTS", "50"))
+PROFILE_DIR = os.getenv("PROFILE_DIR")  # Keep profiler output on disk instead of memory
+# Report Mongo round trips per request in X-DB-Round-Trips (tests and debugging)
+DB_STATS_HEADER = os.getenv("DB_STATS_HEADER", "false").lower() == "true"
 
-# ============== App Setup ==============
-app = FastAPI(title="RideShare API", version="1.0.0")
+# ============== Database ==============
+pool_waits = PoolWaitListener()
+storage = create_storage(
+    STORAGE_BACKEND, MONGO_URL, DB_NAME, event_listeners=[MongoTimingListener(), pool_waits], **MONGO_CLIENT_OPTIONS
+)
+# Reads that tolerate bounded staleness; writes through these still go to the primary
+replica_reads = (
+    storage.secondary_reads(MONGO_MAX_STALENESS_SECONDS, SECONDARY_READ_CONCERN) if SECONDARY_READS else storage
+)
 
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"],
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
+# Collections
+users_collection = storage.users
+rides_collection = storage.rides
+ride_series_collection = storage.ride_series
+bookings_collection = storage.bookings
+private_requests_collection = storage.private_requests
+chats_collection = storage.chats
+reviews_collection = storage.reviews
+otp_collection = storage.otps
+revocations_collection = storage.revocations
+jobs_collection = storage.jobs
+
+job_queue = JobQueue(jobs_collection, visibility_timeout=JOB_VISIBILITY_TIMEOUT, max_attempts=JOB_MAX_ATTEMPTS)
+account_deletion = AccountDeletionCascade(storage, batch_size=DELETION_BATCH_SIZE)
+job_queue.handler("account_deletion")(account_deletion.run)
+profile_fanout = ProfileFanout(storage, chunk_size=FANOUT_CHUNK_SIZE, docs_per_second=FANOUT_DOCS_PER_SECOND)
+job_queue.handler("profile_fanout")(profile_fanout.run)
+user_data_export = UserDataExport(storage, batch_size=EXPORT_BATCH_SIZE)
+archiver = Archiver(storage, retention_days=ARCHIVE_AFTER_DAYS, batch_size=ARCHIVE_BATCH_SIZE)
+job_queue.handler("archival")(archiver.run)
+
+RIDE_PLACE_FIELDS = [("pickup_location", "pickup_lat", "pickup_lng"), ("drop_location", "drop_lat", "drop_lng")]
+REQUEST_PLACE_FIELDS = [("from_location", "from_lat", "from_lng"), ("to_location", "to_lat", "to_lng")]
+place_index = PlaceIndex([
+    (rides_collection, RIDE_PLACE_FIELDS, "driver_id"),
+    (private_requests_collection, REQUEST_PLACE_FIELDS, "passenger_id"),
+], min_users=PLACES_MIN_USERS)
+corridor_rollup = CorridorRollup(replica_reads.corridors, cell_degrees=CORRIDOR_CELL_DEGREES)
+etag_cache = ETagCache(ttl=ETAG_CACHE_SECONDS)
+live_locations = LiveLocations(
+    storage.ride_tracks, track_interval=LOCATION_TRACK_SECONDS, grant_ttl=LOCATION_GRANT_SECONDS
+)
+idempotency_store = IdempotencyStore(
+    storage.idempotency_keys, ttl_seconds=IDEMPOTENCY_TTL_SECONDS, wait_seconds=IDEMPOTENCY_WAIT_SECONDS
+)
+admission = AdmissionController(
+    ADMISSION_ROUTE_CLASSES,
+    ADMISSION_MAX_INFLIGHT,
+    min_inflight=ADMISSION_MIN_INFLIGHT,
+    interval=ADMISSION_INTERVAL_SECONDS,
+    lag_target_ms=ADMISSION_LAG_TARGET_MS,
+    latency_target_ms=ADMISSION_LATENCY_TARGET_MS,
+    user_rate=ADMISSION_USER_RATE,
+    user_burst=ADMISSION_USER_BURST,
 )
 
-# ============== Database ==============
-client = AsyncIOMotorClient(MONGO_URL)
-db = client[DB_NAME]
+def rides_created(rides: List[dict]):
+    """Index, count and un-warm the days of rides this process just inserted"""
+    for ride in rides:
+        place_index.observe(ride, RIDE_PLACE_FIELDS, "driver_id")
+        search_warmer.invalidate(ride["date"])
+    corridor_rollup.record_rides(rides)
 
-# Collections
-users_collection = db["users"]
-rides_collection = db["rides"]
-bookings_collection = db["bookings"]
-private_requests_collection = db["private_requests"]
-chats_collection = db["chats"]
-reviews_collection = db["reviews"]
-otp_collection = db["otps"]
+ride_series_scheduler = RideSeriesScheduler(
+    storage, horizon_days=RIDE_SERIES_HORIZON_DAYS, on_insert=rides_created
+)
+
+event_stream = EventStream(
+    storage.events,
+    storage.event_state,
+    sources=[
+        rides_collection, ride_series_collection, bookings_collection,
+        private_requests_collection, chats_collection,
+    ],
+    batch_size=EVENT_BATCH_SIZE,
+    retention=timedelta(days=EVENT_RETENTION_DAYS),
+)
+if EVENT_NDJSON_PATH:
+    event_stream.add_sink(NDJSONFileSink(EVENT_NDJSON_PATH))
+if EVENT_WEBHOOK_URL:
+    event_stream.add_sink(WebhookSink(EVENT_WEBHOOK_URL, secret=EVENT_WEBHOOK_SECRET))
+analytics_rollup = AnalyticsRollup(
+    storage.analytics,
+    region_degrees=ANALYTICS_REGION_DEGREES,
+    hourly_retention_days=ANALYTICS_HOURLY_RETENTION_DAYS,
+    daily_retention_days=ANALYTICS_DAILY_RETENTION_DAYS,
+)
+event_stream.add_sink(analytics_rollup)
 
 # ============== Security ==============
 security = HTTPBearer()
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+token_cache = TokenCache(max_entries=TOKEN_CACHE_SIZE)
+revocations = RevocationList(revocations_collection, timedelta(days=ACCESS_TOKEN_EXPIRE_DAYS))
 
 # ============== Helpers ==============
 def serialize_doc(doc):
@@ -62,34 +298,116 @@ def serialize_doc(doc):
     if doc is None:
         return None
     doc["id"] = str(doc.pop("_id"))
+    # Pending outbox events are internal
+    doc.pop("_outbox", None)
+    doc.pop("_outbox_at", None)
     return doc
 
 def serialize_docs(docs):
     """Convert list of MongoDB documents"""
     return [serialize_doc(doc) for doc in docs]
 
+def decode_token(token: str) -> dict:
+    """Verify a JWT, serving repeat tokens from the cache, and check revocation"""
+    claims = token_cache.get(token)
+    if claims is None:
+        try:
+            claims = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        except JWTError:
+            raise HTTPException(status_code=401, detail="Invalid token")
+        if claims.get("sub") is None:
+            raise HTTPException(status_code=401, detail="Invalid token")
+        token_cache.put(token, claims)
+    
+    if revocations.is_revoked(claims):
+        raise HTTPException(status_code=401, detail="Session revoked")
+    return claims
+
+def token_subject(token: str) -> Optional[str]:
+    """User id of a valid token, or None"""
+    try:
+        return decode_token(token)["sub"]
+    except HTTPException:
+        return None
+
 async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
     """Validate JWT token and return current user"""
-    try:
-        payload = jwt.decode(credentials.credentials, SECRET_KEY, algorithms=[ALGORITHM])
-        user_id = payload.get("sub")
-        if user_id is None:
-            raise HTTPException(status_code=401, detail="Invalid token")
-        
-        user = await users_collection.find_one({"_id": ObjectId(user_id)})
-        if user is None:
-            raise HTTPException(status_code=401, detail="User not found")
-        
-        return serialize_doc(user)
-    except JWTError:
-        raise HTTPException(status_code=401, detail="Invalid token")
+    payload = decode_token(credentials.credentials)
+    
+    user = await users_collection.find_one({"_id": ObjectId(payload["sub"])})
+    if user is None or user.get("deleted_at"):
+        raise HTTPException(status_code=401, detail="User not found")
+    
+    return serialize_doc(user)
+
+async def require_token(credentials: HTTPAuthorizationCredentials = Depends(security)) -> dict:
+    """Validate the JWT without loading the user (for lookups needing no user data)"""
+    return decode_token(credentials.credentials)
+
+async def require_admin(x_admin_token: Optional[str] = Header(None)):
+    """Allow only requests carrying the configured admin token"""
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=404, detail="Not found")
+    if not x_admin_token or not hmac.compare_digest(x_admin_token, ADMIN_TOKEN):
+        raise HTTPException(status_code=403, detail="Not authorized")
+
+async def schedule_profile_fanout(user_id: str):
+    """Refresh copies of a user's name/photo/rating on other documents"""
+    await job_queue.enqueue(
+        "profile_fanout", {"user_id": user_id}, delay=FANOUT_DELAY_SECONDS, dedupe_key=f"fanout:{user_id}"
+    )
 
 def create_access_token(user_id: str):
     """Create JWT access token"""
     expire = datetime.utcnow() + timedelta(days=ACCESS_TOKEN_EXPIRE_DAYS)
-    payload = {"sub": user_id, "exp": expire}
+    payload = {"sub": user_id, "exp": expire, "iat": int(time.time()), "jti": uuid.uuid4().hex}
     return jwt.encode(payload, SECRET_KEY, algorithm=ALGORITHM)
 
+# ============== App Setup ==============
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Start services before serving requests; stop them and close the client after"""
+    await start_services()
+    try:
+        yield
+    finally:
+        await stop_services()
+
+app = FastAPI(title="RideShare API", version="1.0.0", lifespan=lifespan)
+
+# Innermost, so stored responses are uncompressed and replays still get CORS headers
+app.add_middleware(
+    IdempotencyMiddleware,
+    store=idempotency_store,
+    routes=IDEMPOTENT_ROUTES,
+    identify=token_subject,
+)
+
+app.add_middleware(GZipMiddleware, minimum_size=GZIP_MIN_BYTES)
+
+# Outside everything that does real work, so rejections are cheap
+if ADMISSION_CONTROL:
+    app.add_middleware(AdmissionMiddleware, controller=admission, identify=token_subject)
+
+app.add_middleware(
+    CORSMiddleware,
+    allow_origins=["*"],
+    allow_credentials=True,
+    allow_methods=["*"],
+    allow_headers=["*"],
+)
+
+if DB_STATS_HEADER:
+    app.add_middleware(DBRoundTripMiddleware)
+
+profile_store = ProfileStore(max_reports=PROFILE_MAX_REPORTS, directory=PROFILE_DIR)
+app.add_middleware(
+    ProfilingMiddleware,
+    store=profile_store,
+    token=ADMIN_TOKEN,
+    sample_rate=PROFILE_SAMPLE_RATE,
+)
+
 # ============== Pydantic Models ==============
 
 # Auth Models
@@ -112,6 +430,11 @@ class UserUpdate(BaseModel):
     car_number: Optional[str] = None
 
 # Ride Models
+class RideStop(BaseModel):
+    location: str
+    lat: float
+    lng: float
+
 class RideCreate(BaseModel):
     pickup_location: str
     pickup_lat: float
@@ -119,6 +442,7 @@ class RideCreate(BaseModel):
     drop_location: str
     drop_lat: float
     drop_lng: float
+    stops: List[RideStop] = Field(default_factory=list, max_length=MAX_RIDE_STOPS)  # In travel order
     date: str  # ISO format
     time: str  # HH:MM format
     available_seats: int = Field(..., ge=1, le=8)
@@ -127,6 +451,24 @@ class RideCreate(BaseModel):
     car_number: Optional[str] = None
     notes: Optional[str] = None
 
+class RideSeriesCreate(BaseModel):
+    pickup_location: str
+    pickup_lat: float
+    pickup_lng: float
+    drop_location: str
+    drop_lat: float
+    drop_lng: float
+    stops: List[RideStop] = Field(default_factory=list, max_length=MAX_RIDE_STOPS)
+    weekdays: List[int] = Field(..., min_length=1, max_length=7)  # 0 = Monday ... 6 = Sunday
+    start_date: str  # ISO format
+    end_date: Optional[str] = None  # ISO format, open-ended if not set
+    time: str  # HH:MM format
+    available_seats: int = Field(..., ge=1, le=8)
+    price_per_seat: float = Field(..., ge=0)
+    car_model: Optional[str] = None
+    car_number: Optional[str] = None
+    notes: Optional[str] = None
+
 class RideUpdate(BaseModel):
     available_seats: Optional[int] = None
     price_per_seat: Optional[float] = None
@@ -144,11 +486,21 @@ class RideSearch(BaseModel):
 class BookingCreate(BaseModel):
     ride_id: str
     seats: int = Field(..., ge=1)
+    # Route points to board and leave at (0 = pickup); defaults to the whole route
+    from_stop: int = Field(0, ge=0)
+    to_stop: Optional[int] = None
     message: Optional[str] = None
 
 class BookingStatusUpdate(BaseModel):
     status: str  # pending, accepted, rejected, cancelled, completed
 
+class BulkBookingStatusItem(BaseModel):
+    booking_id: str
+    status: str
+
+class BulkBookingStatusUpdate(BaseModel):
+    updates: List[BulkBookingStatusItem] = Field(..., min_length=1, max_length=100)
+
 # Private Request Models
 class PrivateRequestCreate(BaseModel):
     from_location: str
@@ -173,6 +525,17 @@ class ChatMessage(BaseModel):
     booking_id: Optional[str] = None
     request_id: Optional[str] = None
 
+# Location Models
+class LocationPing(BaseModel):
+    lat: float = Field(..., ge=-90, le=90)
+    lng: float = Field(..., ge=-180, le=180)
+    ts: Optional[float] = None  # Unix seconds; defaults to when the server receives it
+    heading: Optional[float] = None
+    speed: Optional[float] = None
+
+class LocationBatch(BaseModel):
+    points: List[LocationPing] = Field(..., min_length=1, max_length=MAX_LOCATION_BATCH)
+
 # Review Models
 class ReviewCreate(BaseModel):
     ride_id: str
@@ -209,8 +572,9 @@ async def send_otp(request: SendOTPRequest):
         upsert=True
     )
     
-    # In production, integrate with SMS service (Twilio/Firebase)
-    # print(f"[DEBUG] OTP for {phone}: {otp}")
+    # Delivery happens in the background so SMS latency isn't on this request
+    if SMS_DELIVERY:
+        await job_queue.enqueue("deliver_otp", {"phone": phone})
     
     return {
         "success": True,
@@ -256,8 +620,8 @@ async def verify_otp(request: VerifyOTPRequest):
             "created_at": datetime.utcnow(),
             "updated_at": datetime.utcnow()
         }
-        result = await users_collection.insert_one(new_user)
-        user = await users_collection.find_one({"_id": result.inserted_id})
+        await users_collection.insert_one(new_user)
+        user = new_user
     
     # Create token
     token = create_access_token(str(user["_id"]))
@@ -268,15 +632,29 @@ async def verify_otp(request: VerifyOTPRequest):
     }
 
 @app.post("/api/auth/logout")
-async def logout(current_user: dict = Depends(get_current_user)):
-    """Logout user (client should delete token)"""
+async def logout(
+    credentials: HTTPAuthorizationCredentials = Depends(security),
+    current_user: dict = Depends(get_current_user)
+):
+    """Logout user (revokes the current session)"""
+    claims = decode_token(credentials.credentials)
+    if claims.get("jti"):
+        await revocations.revoke_session(claims)
+    else:
+        # Tokens issued before session ids existed can only be revoked per user
+        await revocations.revoke_user(current_user["id"])
+    token_cache.discard(credentials.credentials)
     return {"success": True, "message": "Logged out successfully"}
 
 # ============== User Endpoints ==============
 
 @app.get("/api/users/profile")
-async def get_profile(current_user: dict = Depends(get_current_user)):
+async def get_profile(request: Request, response: Response, current_user: dict = Depends(get_current_user)):
     """Get current user profile"""
+    etag = make_etag("profile", current_user["id"], current_user.get("updated_at"))
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return not_modified(etag)
+    set_etag(response, etag)
     return current_user
 
 @app.put("/api/users/profile")
@@ -285,51 +663,79 @@ async def update_profile(update: UserUpdate, current_user: dict = Depends(get_cu
     update_data = {k: v for k, v in update.dict().items() if v is not None}
     update_data["updated_at"] = datetime.utcnow()
     
-    await users_collection.update_one(
+    user = await users_collection.find_one_and_update(
         {"_id": ObjectId(current_user["id"])},
-        {"$set": update_data}
+        {"$set": update_data},
+        return_document=ReturnDocument.AFTER
     )
-    
-    user = await users_collection.find_one({"_id": ObjectId(current_user["id"])})
+    if "name" in update_data or "photo" in update_data:
+        await schedule_profile_fanout(current_user["id"])
+    etag_cache.invalidate(("user", current_user["id"]))
     return serialize_doc(user)
 
 @app.delete("/api/users/account")
 async def delete_account(current_user: dict = Depends(get_current_user)):
-    """Delete user account and all associated data"""
-    user_id = ObjectId(current_user["id"])
-    
-    # Delete user's rides
-    await rides_collection.delete_many({"driver_id": str(user_id)})
-    
-    # Delete user's bookings
-    await bookings_collection.delete_many({"passenger_id": str(user_id)})
-    
-    # Delete user's private requests
-    await private_requests_collection.delete_many({"passenger_id": str(user_id)})
+    """Delete user account; associated data is removed in the background"""
+    user_id = current_user["id"]
+    now = datetime.utcnow()
     
-    # Delete user's chats
-    await chats_collection.delete_many({"$or": [
-        {"sender_id": str(user_id)},
-        {"receiver_id": str(user_id)}
-    ]})
-    
-    # Delete user's reviews
-    await reviews_collection.delete_many({"$or": [
-        {"reviewer_id": str(user_id)},
-        {"reviewee_id": str(user_id)}
-    ]})
+    # Tombstone the account and release the phone number for a new signup
+    await users_collection.update_one(
+        {"_id": ObjectId(user_id)},
+        {"$set": {
+            "deleted_at": now,
+            "phone": f"deleted:{user_id}",
+            "name": None,
+            "photo": None,
+            "updated_at": now
+        }}
+    )
+    await revocations.revoke_user(user_id)
+    etag_cache.invalidate(("user", user_id))
     
-    # Delete user
-    await users_collection.delete_one({"_id": user_id})
+    # Rides, bookings, requests, chats and reviews go in a resumable job
+    job_id = await job_queue.enqueue(
+        "account_deletion", {"user_id": user_id}, state=AccountDeletionCascade.initial_state()
+    )
     
-    return {"success": True, "message": "Account deleted successfully"}
+    return {"success": True, "message": "Account deleted successfully", "deletion_job_id": job_id}
+
+@app.get("/api/users/export")
+async def export_user_data(gzip: bool = False, current_user: dict = Depends(get_current_user)):
+    """Download the user's complete history as NDJSON (streamed)"""
+    # The profile is the user document already loaded for authentication
+    user = {"_id": ObjectId(current_user["id"]), **{k: v for k, v in current_user.items() if k != "id"}}
+    filename = f"rideshare-export-{current_user['id']}.ndjson"
+    if gzip:
+        return StreamingResponse(
+            user_data_export.gzip(user),
+            media_type="application/gzip",
+            headers={"Content-Disposition": f'attachment; filename="{filename}.gz"'},
+        )
+    return StreamingResponse(
+        user_data_export.lines(user),
+        media_type="application/x-ndjson",
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+    )
+
+async def user_stamp(user_id: str):
+    user = await replica_reads.users.find_one({"_id": ObjectId(user_id)}, {"updated_at": 1, "deleted_at": 1})
+    return None if not user or user.get("deleted_at") else user.get("updated_at")
 
-@app.get("/api/users/{user_id}")
-async def get_user(user_id: str, current_user: dict = Depends(get_current_user)):
+@app.get("/api/users/{user_id}", dependencies=[Depends(require_token)])
+async def get_user(user_id: str, request: Request, response: Response):
     """Get user by ID (public profile)"""
-    user = await users_collection.find_one({"_id": ObjectId(user_id)})
-    if not user:
+    key = ("user", user_id)
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match:
+        etag = await etag_cache.current(key, lambda: user_stamp(user_id))
+        if etag_matches(if_none_match, etag):
+            return not_modified(etag)
+    
+    user = await replica_reads.users.find_one({"_id": ObjectId(user_id)})
+    if not user or user.get("deleted_at"):
         raise HTTPException(status_code=404, detail="User not found")
+    set_etag(response, etag_cache.put(key, make_etag(*key, user.get("updated_at"))))
     
     # Return limited public info
     public_user = serialize_doc(user)
@@ -339,23 +745,51 @@ async def get_user(user_id: str, current_user: dict = Depends(get_current_user))
 
 # ============== Ride Endpoints ==============
 
-@app.post("/api/rides")
-async def create_ride(ride: RideCreate, current_user: dict = Depends(get_current_user)):
-    """Create a new ride offer"""
+def new_ride_doc(ride: RideCreate, driver: dict) -> dict:
+    """Ride document for a ride offered by driver"""
     ride_data = ride.dict()
-    ride_data["driver_id"] = current_user["id"]
-    ride_data["driver_name"] = current_user.get("name", "Unknown Driver")
-    ride_data["driver_photo"] = current_user.get("photo")
-    ride_data["driver_rating"] = current_user.get("rating", 0.0)
+    ride_data["_id"] = ObjectId()
+    ride_data["driver_id"] = driver["id"]
+    ride_data["driver_name"] = driver.get("name", "Unknown Driver")
+    ride_data["driver_photo"] = driver.get("photo")
+    ride_data["driver_rating"] = driver.get("rating", 0.0)
     ride_data["status"] = "active"
     ride_data["booked_seats"] = 0
+    ride_data["segment_seats"] = [0] * segment_count(ride_data)
     ride_data["created_at"] = datetime.utcnow()
     ride_data["updated_at"] = datetime.utcnow()
+    return with_event_doc(ride_data, ride_created_event(ride_data))
+
+@app.post("/api/rides")
+async def create_ride(ride: RideCreate, current_user: dict = Depends(get_current_user)):
+    """Create a new ride offer"""
+    ride_data = new_ride_doc(ride, current_user)
     
-    result = await rides_collection.insert_one(ride_data)
-    ride_doc = await rides_collection.find_one({"_id": result.inserted_id})
+    await rides_collection.insert_one(ride_data)
+    rides_created([ride_data])
     
-    return serialize_doc(ride_doc)
+    return serialize_doc(ride_data)
+
+ride_importer = RideImporter(rides_collection, RideCreate, batch_size=IMPORT_BATCH_SIZE, on_insert=rides_created)
+
+@app.post("/api/rides/import")
+async def import_rides(
+    request: Request,
+    format: Optional[str] = None,
+    ordered: bool = False,
+    dry_run: bool = False,
+    current_user: dict = Depends(get_current_user)
+):
+    """Bulk-create rides from a streamed NDJSON or CSV body; returns a per-row error report"""
+    if format is None:
+        format = "csv" if "csv" in request.headers.get("content-type", "") else "ndjson"
+    if format not in IMPORT_FORMATS:
+        raise HTTPException(status_code=400, detail=f"format must be one of {', '.join(IMPORT_FORMATS)}")
+    
+    return await ride_importer.run(
+        request.stream(), format, lambda ride: new_ride_doc(ride, current_user),
+        ordered=ordered, dry_run=dry_run
+    )
 
 @app.get("/api/rides")
 async def get_rides(
@@ -367,77 +801,226 @@ async def get_rides(
     if status:
         query["status"] = status
     
-    rides = await rides_collection.find(query).sort("created_at", -1).to_list(100)
+    rides = await replica_reads.rides.find(query).sort("created_at", -1).to_list(100)
     return serialize_docs(rides)
 
 @app.get("/api/rides/my-rides")
 async def get_my_rides(current_user: dict = Depends(get_current_user)):
     """Get rides offered by current user"""
-    rides = await rides_collection.find(
-        {"driver_id": current_user["id"]}
-    ).sort("created_at", -1).to_list(100)
+    rides = await archiver.history("rides", {"driver_id": current_user["id"]}, ("created_at", -1), 100)
     return serialize_docs(rides)
 
-@app.post("/api/rides/search")
-async def search_rides(search: RideSearch, current_user: dict = Depends(get_current_user)):
-    """Search for rides"""
+DASHBOARD_RIDE_FIELDS = [
+    "pickup_location", "drop_location", "stops", "date", "time", "price_per_seat",
+    "available_seats", "booked_seats", "segment_seats", "status",
+]
+DASHBOARD_BOOKING_FIELDS = ["passenger_id", "passenger_name", "seats", "total_price", "message", "created_at"]
+
+@app.get("/api/rides/dashboard")
+async def get_driver_dashboard(
+    limit: int = 20,
+    cursor: Optional[str] = None,
+    current_user: dict = Depends(get_current_user)
+):
+    """Upcoming rides of the driver with booking counts and pending requests (one query)"""
+    limit = max(1, min(limit, 100))
+    match = {
+        "driver_id": current_user["id"],
+        "status": "active",
+        "date": {"$gte": datetime.utcnow().strftime("%Y-%m-%d")},
+    }
+    # Keyset pagination by departure: cursor is "<date>|<time>|<ride id>"
+    if cursor:
+        try:
+            after_date, after_time, after_id = cursor.split("|")
+            after_id = ObjectId(after_id)
+        except Exception:
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+        match["$or"] = [
+            {"date": {"$gt": after_date}},
+            {"date": after_date, "time": {"$gt": after_time}},
+            {"date": after_date, "time": after_time, "_id": {"$gt": after_id}},
+        ]
+    
+    bookings_lookup = {
+        "from": bookings_collection.name,
+        "localField": "ride_key",
+        "foreignField": "ride_id",
+    }
+    pipeline = [
+        {"$match": match},
+        {"$sort": {"date": 1, "time": 1, "_id": 1}},
+        {"$limit": limit + 1},
+        {"$addFields": {"ride_key": {"$toString": "$_id"}}},
+        {"$lookup": {**bookings_lookup, "as": "booking_counts", "pipeline": [
+            {"$group": {"_id": "$status", "count": {"$sum": 1}}},
+        ]}},
+        {"$lookup": {**bookings_lookup, "as": "pending_bookings", "pipeline": [
+            {"$match": {"status": "pending"}},
+            {"$sort": {"created_at": 1}},
+            {"$project": {field: 1 for field in DASHBOARD_BOOKING_FIELDS}},
+        ]}},
+        {"$project": {
+            **{field: 1 for field in DASHBOARD_RIDE_FIELDS},
+            "seats_remaining": {"$subtract": ["$available_seats", "$booked_seats"]},
+            "booking_counts": {"$arrayToObject": {"$map": {
+                "input": "$booking_counts",
+                "in": {"k": "$$this._id", "v": "$$this.count"},
+            }}},
+            "pending_bookings": 1,
+        }},
+    ]
+    rides = await rides_collection.aggregate(pipeline).to_list(None)
+    
+    next_cursor = None
+    if len(rides) > limit:
+        rides = rides[:limit]
+        last = rides[-1]
+        next_cursor = f"{last['date']}|{last['time']}|{last['_id']}"
+    for ride in rides:
+        serialize_docs(ride["pending_bookings"])
+    return {"rides": serialize_docs(rides), "next_cursor": next_cursor}
+
+@app.get("/api/rides/popular-routes", dependencies=[Depends(require_token)])
+async def get_popular_routes(days: int = 7, limit: int = 10, by: str = "searches"):
+    """Most searched (or offered) corridors for travel from the last days on"""
+    if by not in ("searches", "rides"):
+        raise HTTPException(status_code=400, detail="by must be searches or rides")
+    start = datetime.utcnow().date() - timedelta(days=max(1, min(days, 90)) - 1)
+    corridors = await corridor_rollup.popular(start.isoformat(), max(1, min(limit, 50)), by=by)
+    return [
+        {
+            "origin": c["_id"]["origin"],
+            "destination": c["_id"]["destination"],
+            "origin_name": c.get("origin_name"),
+            "destination_name": c.get("destination_name"),
+            "rides": c["rides"],
+            "searches": c["searches"],
+        }
+        for c in corridors
+    ]
+
+def ride_search_query(day: Optional[str], seats_needed: Optional[int]) -> dict:
     query = {"status": "active"}
     
     # Filter by date if provided
-    if search.date:
-        query["date"] = search.date
+    if day:
+        query["date"] = day
     
-    # Filter by available seats
-    if search.seats_needed:
+    # Filter by available seats: a ride qualifies if its least busy segment
+    # has room; the segments the passenger actually uses are checked later
+    if seats_needed:
         query["$expr"] = {
             "$gte": [
-                {"$subtract": ["$available_seats", "$booked_seats"]},
-                search.seats_needed
+                {"$subtract": ["$available_seats", {"$min": SEGMENT_SEATS}]},
+                seats_needed
             ]
         }
+    return query
+
+async def find_search_candidates(day: Optional[str], seats_needed: Optional[int]) -> List[dict]:
+    return await replica_reads.rides.find(ride_search_query(day, seats_needed)).sort("created_at", -1).to_list(100)
+
+# Warmed candidates are those of a one-seat search, the default
+search_warmer = SearchWarmer(
+    corridor_rollup,
+    lambda day: find_search_candidates(day, 1),
+    top_n=CORRIDOR_TOP_N,
+    max_age_seconds=2 * CORRIDOR_WARM_SECONDS,
+)
+
+@app.post("/api/rides/search")
+async def search_rides(search: RideSearch, current_user: dict = Depends(get_current_user)):
+    """Search for rides"""
+    rides = None
+    
+    # If coordinates provided, board and leave at the closest route points and sort by distance
+    by_distance = search.pickup_lat and search.pickup_lng and search.drop_lat and search.drop_lng
+    warmable = False
+    if by_distance:
+        corridor = corridor_rollup.corridor(search.pickup_lat, search.pickup_lng, search.drop_lat, search.drop_lng)
+        corridor_rollup.record_search(corridor, search.date or datetime.utcnow().strftime("%Y-%m-%d"))
+        warmable = bool(search.date) and search.seats_needed == 1 and corridor in search_warmer.hot
+        if warmable:
+            rides = search_warmer.get(corridor, search.date)
+    if rides is None:
+        version = search_warmer.version
+        rides = await find_search_candidates(search.date, search.seats_needed)
+        if warmable:
+            search_warmer.put(search.date, rides, version)
+    
+    results = []
+    for ride in serialize_docs(rides):
+        if by_distance:
+            from_stop, to_stop, distance = closest_legs(
+                ride, (search.pickup_lat, search.pickup_lng), (search.drop_lat, search.drop_lng)
+            )
+            ride["relevance_score"] = distance
+        else:
+            from_stop, to_stop = 0, segment_count(ride)
+        ride["from_stop"], ride["to_stop"] = from_stop, to_stop
+        ride["seats_free"] = seats_free(ride, from_stop, to_stop)
+        if not search.seats_needed or ride["seats_free"] >= search.seats_needed:
+            results.append(ride)
     
-    rides = await rides_collection.find(query).sort("created_at", -1).to_list(100)
-    results = serialize_docs(rides)
-    
-    # If coordinates provided, calculate approximate distance and sort
-    if search.pickup_lat and search.pickup_lng and search.drop_lat and search.drop_lng:
-        for ride in results:
-            # Simple distance calculation (not accurate for large distances)
-            pickup_dist = abs(ride["pickup_lat"] - search.pickup_lat) + abs(ride["pickup_lng"] - search.pickup_lng)
-            drop_dist = abs(ride["drop_lat"] - search.drop_lat) + abs(ride["drop_lng"] - search.drop_lng)
-            ride["relevance_score"] = pickup_dist + drop_dist
-        
+    if by_distance:
         results.sort(key=lambda x: x.get("relevance_score", 999))
     
     return results
 
-@app.get("/api/rides/{ride_id}")
-async def get_ride(ride_id: str, current_user: dict = Depends(get_current_user)):
-    """Get ride details"""
-    ride = await rides_collection.find_one({"_id": ObjectId(ride_id)})
+async def ride_stamp(ride_id: str):
+    ride = await archiver.find_one("rides", {"_id": ObjectId(ride_id)}, {"updated_at": 1})
+    return ride and ride.get("updated_at")
+
+@app.get("/api/rides/{ride_id}", dependencies=[Depends(require_token)])
+async def get_ride(ride_id: str, request: Request, response: Response):
+    """Get ride details; clients polling seat counts should send If-None-Match"""
+    key = ("ride", ride_id)
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match:
+        etag = await etag_cache.current(key, lambda: ride_stamp(ride_id))
+        if etag_matches(if_none_match, etag):
+            return not_modified(etag)
+    
+    ride = await archiver.find_one("rides", {"_id": ObjectId(ride_id)})
     if not ride:
         raise HTTPException(status_code=404, detail="Ride not found")
+    set_etag(response, etag_cache.put(key, make_etag(*key, ride.get("updated_at"))))
     return serialize_doc(ride)
 
 @app.put("/api/rides/{ride_id}")
 async def update_ride(ride_id: str, update: RideUpdate, current_user: dict = Depends(get_current_user)):
     """Update ride (only by driver)"""
-    ride = await rides_collection.find_one({"_id": ObjectId(ride_id)})
-    if not ride:
-        raise HTTPException(status_code=404, detail="Ride not found")
-    
-    if ride["driver_id"] != current_user["id"]:
-        raise HTTPException(status_code=403, detail="Not authorized")
-    
     update_data = {k: v for k, v in update.dict().items() if v is not None}
     update_data["updated_at"] = datetime.utcnow()
+    query = {"_id": ObjectId(ride_id), "driver_id": current_user["id"]}
+    changes = {"$set": update_data}
+    
+    cancelling = None
+    if update_data.get("status") == "cancelled":
+        # Cancelling by update records the same event as DELETE, once
+        cancelling = await rides_collection.find_one(
+            {**query, "status": {"$ne": "cancelled"}}, {"driver_id": 1, "pickup_lat": 1, "pickup_lng": 1, "status": 1}
+        )
+        if cancelling:
+            query["status"] = cancelling["status"]
+            changes = with_event(changes, ride_cancelled_event(cancelling))
     
-    await rides_collection.update_one(
-        {"_id": ObjectId(ride_id)},
-        {"$set": update_data}
-    )
+    ride = await rides_collection.find_one_and_update(query, changes, return_document=ReturnDocument.AFTER)
+    if not ride:
+        if cancelling:
+            # The status changed since it was read
+            return await update_ride(ride_id, update, current_user)
+        # Only the failure path pays for telling "missing" from "not yours"
+        if await rides_collection.find_one({"_id": ObjectId(ride_id)}, {"_id": 1}):
+            raise HTTPException(status_code=403, detail="Not authorized")
+        raise HTTPException(status_code=404, detail="Ride not found")
+    search_warmer.invalidate(ride["date"])
+    etag_cache.invalidate(("ride", ride_id))
+    if cancelling:
+        live_locations.end(ride_id)
+        await job_queue.enqueue("cancel_ride_bookings", {"ride_id": ride_id})
     
-    ride = await rides_collection.find_one({"_id": ObjectId(ride_id)})
     return serialize_doc(ride)
 
 @app.delete("/api/rides/{ride_id}")
@@ -450,19 +1033,231 @@ async def cancel_ride(ride_id: str, current_user: dict = Depends(get_current_use
     if ride["driver_id"] != current_user["id"]:
         raise HTTPException(status_code=403, detail="Not authorized")
     
-    # Update status to cancelled instead of deleting
-    await rides_collection.update_one(
-        {"_id": ObjectId(ride_id)},
-        {"$set": {"status": "cancelled", "updated_at": datetime.utcnow()}}
+    # Update status to cancelled instead of deleting; only the update that
+    # cancels the ride records the event
+    result = await rides_collection.update_one(
+        {"_id": ObjectId(ride_id), "status": {"$ne": "cancelled"}},
+        with_event({"$set": {"status": "cancelled", "updated_at": datetime.utcnow()}}, ride_cancelled_event(ride))
     )
+    if result.modified_count == 1:
+        search_warmer.invalidate(ride["date"])
+        ride_ended(ride_id)
+        # Cancel all pending bookings for this ride in the background
+        await job_queue.enqueue("cancel_ride_bookings", {"ride_id": ride_id})
     
-    # Cancel all pending bookings for this ride
-    await bookings_collection.update_many(
-        {"ride_id": ride_id, "status": "pending"},
-        {"$set": {"status": "cancelled", "updated_at": datetime.utcnow()}}
+    return {"success": True, "message": "Ride cancelled"}
+
+def ride_ended(ride_id: str):
+    """Drop cached state of a ride that was cancelled"""
+    etag_cache.invalidate(("ride", ride_id))
+    live_locations.end(ride_id)
+
+async def cancel_rides(rides: List[dict]) -> int:
+    """Cancel active rides, each with its own ride.cancelled event; returns how many changed"""
+    cancelled = 0
+    for start in range(0, len(rides), EVENT_BATCH_SIZE):
+        batch = rides[start:start + EVENT_BATCH_SIZE]
+        now = datetime.utcnow()
+        result = await rides_collection.bulk_write([
+            UpdateOne(
+                {"_id": ride["_id"], "status": "active"},
+                with_event({"$set": {"status": "cancelled", "updated_at": now}}, ride_cancelled_event(ride)),
+            )
+            for ride in batch
+        ], ordered=False)
+        cancelled += result.modified_count
+        for ride in batch:
+            ride_ended(str(ride["_id"]))
+    return cancelled
+
+# ============== Ride Series Endpoints ==============
+
+@app.post("/api/ride-series")
+async def create_ride_series(series: RideSeriesCreate, current_user: dict = Depends(get_current_user)):
+    """Create a recurring ride; its upcoming occurrences are created as rides"""
+    try:
+        start = date.fromisoformat(series.start_date)
+        end = date.fromisoformat(series.end_date) if series.end_date else None
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Dates must be in YYYY-MM-DD format")
+    if end is not None and end < start:
+        raise HTTPException(status_code=400, detail="end_date is before start_date")
+    if any(day < 0 or day > 6 for day in series.weekdays):
+        raise HTTPException(status_code=400, detail="weekdays must be between 0 (Monday) and 6 (Sunday)")
+    
+    series_data = series.dict()
+    series_data["weekdays"] = sorted(set(series.weekdays))
+    series_data["driver_id"] = current_user["id"]
+    series_data["status"] = "active"
+    series_data["materialized_until"] = (start - timedelta(days=1)).isoformat()
+    series_data["created_at"] = datetime.utcnow()
+    series_data["updated_at"] = datetime.utcnow()
+    
+    await ride_series_collection.insert_one(series_data)
+    occurrences = await ride_series_scheduler.materialize([series_data])
+    
+    return {**serialize_doc(series_data), "occurrences_created": occurrences}
+
+@app.get("/api/ride-series")
+async def get_my_ride_series(current_user: dict = Depends(get_current_user)):
+    """Get recurring rides of current user"""
+    series = await ride_series_collection.find(
+        {"driver_id": current_user["id"]}
+    ).sort("created_at", -1).to_list(100)
+    return serialize_docs(series)
+
+@app.delete("/api/ride-series/{series_id}")
+async def cancel_ride_series(series_id: str, current_user: dict = Depends(get_current_user)):
+    """Cancel a recurring ride and all its upcoming occurrences"""
+    event = new_event("ride_series.cancelled", {"series_id": series_id, "driver_id": current_user["id"]})
+    series = await ride_series_collection.find_one_and_update(
+        {"_id": ObjectId(series_id), "driver_id": current_user["id"], "status": "active"},
+        with_event({"$set": {"status": "cancelled", "updated_at": datetime.utcnow()}}, event)
     )
+    if series is None:
+        existing = await ride_series_collection.find_one({"_id": ObjectId(series_id)}, {"driver_id": 1})
+        if not existing:
+            raise HTTPException(status_code=404, detail="Ride series not found")
+        if existing["driver_id"] != current_user["id"]:
+            raise HTTPException(status_code=403, detail="Not authorized")
+        raise HTTPException(status_code=400, detail="Ride series is not active")
     
-    return {"success": True, "message": "Ride cancelled"}
+    # Cancel every upcoming occurrence
+    rides = await rides_collection.find(
+        {"series_id": series_id, "status": "active", "date": {"$gte": datetime.utcnow().strftime("%Y-%m-%d")}},
+        {"driver_id": 1, "pickup_lat": 1, "pickup_lng": 1},
+    ).to_list(None)
+    cancelled = await cancel_rides(rides)
+    await job_queue.enqueue("cancel_ride_bookings", {"series_id": series_id})
+    search_warmer.invalidate()
+    
+    return {"success": True, "message": "Ride series cancelled", "rides_cancelled": cancelled}
+
+# ============== Live Location Endpoints ==============
+
+async def can_publish_location(ride_id: str, user_id: str) -> bool:
+    """Only the driver of an active ride publishes its position"""
+    ride = await rides_collection.find_one(
+        {"_id": ObjectId(ride_id), "driver_id": user_id, "status": "active"}, {"_id": 1}
+    )
+    return ride is not None
+
+async def can_watch_location(ride_id: str, user_id: str) -> bool:
+    """The driver and passengers with an accepted booking watch an active ride"""
+    ride = await rides_collection.find_one({"_id": ObjectId(ride_id), "status": "active"}, {"driver_id": 1})
+    if ride is None:
+        return False
+    if ride["driver_id"] == user_id:
+        return True
+    booking = await bookings_collection.find_one(
+        {"ride_id": ride_id, "passenger_id": user_id, "status": "accepted"}, {"_id": 1}
+    )
+    return booking is not None
+
+async def authorize_location(ride_id: str, user_id: str, role: str) -> bool:
+    if not ObjectId.is_valid(ride_id):
+        return False
+    check = can_publish_location if role == "publish" else can_watch_location
+    return await live_locations.authorize(ride_id, user_id, role, lambda: check(ride_id, user_id))
+
+def websocket_claims(websocket: WebSocket) -> Optional[dict]:
+    """Claims of the bearer token, from the Authorization header or ?token= (browsers can't set headers)"""
+    token = websocket.query_params.get("token")
+    authorization = websocket.headers.get("authorization", "")
+    if authorization.lower().startswith("bearer "):
+        token = authorization[7:]
+    if not token:
+        return None
+    try:
+        return decode_token(token)
+    except HTTPException:
+        return None
+
+@app.post("/api/rides/{ride_id}/location")
+async def push_location(ride_id: str, batch: LocationBatch, claims: dict = Depends(require_token)):
+    """Record a batch of GPS pings from the driver of an active ride"""
+    if not await authorize_location(ride_id, claims["sub"], "publish"):
+        raise HTTPException(status_code=403, detail="Only the driver of an active ride can share its location")
+    accepted = sum(live_locations.ping(ride_id, p.lat, p.lng, p.ts, p.heading, p.speed) for p in batch.points)
+    return {"accepted": accepted, "rejected": len(batch.points) - accepted}
+
+@app.get("/api/rides/{ride_id}/location")
+async def get_location(ride_id: str, claims: dict = Depends(require_token)):
+    """Latest position of the driver of a ride the user is on"""
+    if not await authorize_location(ride_id, claims["sub"], "watch"):
+        raise HTTPException(status_code=403, detail="Not authorized")
+    position = live_locations.position(ride_id) or await live_locations.last_persisted(ride_id)
+    if position is None:
+        raise HTTPException(status_code=404, detail="No location shared yet")
+    return position
+
+@app.websocket("/api/rides/{ride_id}/location/ws")
+async def location_socket(websocket: WebSocket, ride_id: str):
+    """The driver sends pings (a JSON object or list per message); passengers receive positions"""
+    claims = websocket_claims(websocket)
+    user_id = claims["sub"] if claims else None
+    if user_id and await authorize_location(ride_id, user_id, "publish"):
+        await websocket.accept()
+        await receive_locations(websocket, ride_id, user_id)
+    elif user_id and await authorize_location(ride_id, user_id, "watch"):
+        await websocket.accept()
+        await send_locations(websocket, ride_id, user_id)
+    else:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+
+async def receive_locations(websocket: WebSocket, ride_id: str, user_id: str):
+    try:
+        while True:
+            message = await websocket.receive_text()
+            # Re-checked against the database once per grant, so a cancelled ride stops
+            if not await authorize_location(ride_id, user_id, "publish"):
+                await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+                return
+            try:
+                points = json.loads(message)
+            except ValueError:
+                continue
+            live_locations.ingest(ride_id, points if isinstance(points, list) else [points])
+    except WebSocketDisconnect:
+        pass
+
+async def send_locations(websocket: WebSocket, ride_id: str, user_id: str):
+    changed = live_locations.watch(ride_id)
+    # Watchers send nothing; receiving only tells us when they disconnect
+    receiver = asyncio.ensure_future(websocket.receive())
+    sent_ts = None
+    try:
+        while True:
+            changed.clear()
+            position = live_locations.position(ride_id) or await live_locations.last_persisted(ride_id)
+            if position is not None and (sent_ts is None or position["ts"] > sent_ts):
+                await websocket.send_json(position)
+                sent_ts = position["ts"]
+            
+            waiter = asyncio.ensure_future(changed.wait())
+            await asyncio.wait(
+                (waiter, receiver), timeout=LOCATION_FLUSH_SECONDS, return_when=asyncio.FIRST_COMPLETED
+            )
+            waiter.cancel()
+            if receiver.done():
+                if receiver.result()["type"] == "websocket.disconnect":
+                    return
+                receiver = asyncio.ensure_future(websocket.receive())
+            if not await authorize_location(ride_id, user_id, "watch"):
+                await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+                return
+    except (WebSocketDisconnect, RuntimeError):
+        pass
+    finally:
+        receiver.cancel()
+        live_locations.unwatch(ride_id, changed)
+
+# ============== Place Endpoints ==============
+
+@app.get("/api/places/autocomplete", dependencies=[Depends(require_token)])
+async def autocomplete_places(q: str, limit: int = 10):
+    """Suggest places already used in rides and requests by several users, most popular first"""
+    return place_index.search(q, max(1, min(limit, 25)))
 
 # ============== Booking Endpoints ==============
 
@@ -479,7 +1274,12 @@ async def create_booking(booking: BookingCreate, current_user: dict = Depends(ge
     if ride["status"] != "active":
         raise HTTPException(status_code=400, detail="Ride is not active")
     
-    available = ride["available_seats"] - ride["booked_seats"]
+    points = route(ride)
+    to_stop = len(points) - 1 if booking.to_stop is None else booking.to_stop
+    if not booking.from_stop < to_stop < len(points):
+        raise HTTPException(status_code=400, detail="Invalid stops for this ride")
+    
+    available = seats_free(ride, booking.from_stop, to_stop)
     if booking.seats > available:
         raise HTTPException(status_code=400, detail=f"Only {available} seats available")
     
@@ -493,6 +1293,7 @@ async def create_booking(booking: BookingCreate, current_user: dict = Depends(ge
         raise HTTPException(status_code=400, detail="You already have a booking for this ride")
     
     booking_data = {
+        "_id": ObjectId(),
         "ride_id": booking.ride_id,
         "passenger_id": current_user["id"],
         "passenger_name": current_user.get("name", "Unknown"),
@@ -502,65 +1303,63 @@ async def create_booking(booking: BookingCreate, current_user: dict = Depends(ge
         "message": booking.message,
         "total_price": booking.seats * ride["price_per_seat"],
         "status": "pending",
-        "pickup_location": ride["pickup_location"],
-        "drop_location": ride["drop_location"],
+        "from_stop": booking.from_stop,
+        "to_stop": to_stop,
+        "pickup_location": points[booking.from_stop]["location"],
+        "pickup_lat": points[booking.from_stop]["lat"],
+        "pickup_lng": points[booking.from_stop]["lng"],
+        "drop_location": points[to_stop]["location"],
         "date": ride["date"],
         "time": ride["time"],
         "created_at": datetime.utcnow(),
         "updated_at": datetime.utcnow()
     }
     
-    result = await bookings_collection.insert_one(booking_data)
-    booking_doc = await bookings_collection.find_one({"_id": result.inserted_id})
+    event = new_event("booking.created", {
+        "booking_id": str(booking_data["_id"]),
+        "ride_id": booking.ride_id,
+        "passenger_id": current_user["id"],
+        "driver_id": ride["driver_id"],
+        "seats": booking.seats,
+        "pickup_lat": booking_data["pickup_lat"],
+        "pickup_lng": booking_data["pickup_lng"],
+    })
+    await bookings_collection.insert_one(with_event_doc(booking_data, event))
     
-    return serialize_doc(booking_doc)
+    return serialize_doc(booking_data)
 
 @app.get("/api/bookings")
 async def get_my_bookings(current_user: dict = Depends(get_current_user)):
     """Get all bookings for current user (as passenger)"""
-    bookings = await bookings_collection.find(
-        {"passenger_id": current_user["id"]}
-    ).sort("created_at", -1).to_list(100)
+    bookings = await archiver.history("bookings", {"passenger_id": current_user["id"]}, ("created_at", -1), 100)
     return serialize_docs(bookings)
 
 @app.get("/api/bookings/requests")
 async def get_booking_requests(current_user: dict = Depends(get_current_user)):
     """Get booking requests for driver's rides"""
-    bookings = await bookings_collection.find(
-        {"driver_id": current_user["id"]}
-    ).sort("created_at", -1).to_list(100)
+    bookings = await archiver.history("bookings", {"driver_id": current_user["id"]}, ("created_at", -1), 100)
     return serialize_docs(bookings)
 
-@app.put("/api/bookings/{booking_id}/status")
-async def update_booking_status(
-    booking_id: str,
-    update: BookingStatusUpdate,
-    current_user: dict = Depends(get_current_user)
-):
-    """Update booking status"""
-    booking = await bookings_collection.find_one({"_id": ObjectId(booking_id)})
-    if not booking:
-        raise HTTPException(status_code=404, detail="Booking not found")
-    
+VALID_BOOKING_TRANSITIONS = {
+    "pending": ["accepted", "rejected", "cancelled"],
+    "accepted": ["cancelled", "completed"],
+}
+
+def check_booking_transition(booking: dict, new_status: str, user_id: str):
+    """Raise unless user_id may move the booking to new_status"""
     # Only driver can accept/reject, only passenger can cancel
-    is_driver = booking["driver_id"] == current_user["id"]
-    is_passenger = booking["passenger_id"] == current_user["id"]
+    is_driver = booking["driver_id"] == user_id
+    is_passenger = booking["passenger_id"] == user_id
     
     if not (is_driver or is_passenger):
         raise HTTPException(status_code=403, detail="Not authorized")
     
-    valid_transitions = {
-        "pending": ["accepted", "rejected", "cancelled"],
-        "accepted": ["cancelled", "completed"],
-    }
-    
     current_status = booking["status"]
-    new_status = update.status
     
-    if current_status not in valid_transitions:
+    if current_status not in VALID_BOOKING_TRANSITIONS:
         raise HTTPException(status_code=400, detail="Cannot update this booking")
     
-    if new_status not in valid_transitions.get(current_status, []):
+    if new_status not in VALID_BOOKING_TRANSITIONS.get(current_status, []):
         raise HTTPException(status_code=400, detail=f"Invalid status transition from {current_status} to {new_status}")
     
     # Drivers can accept/reject, passengers can cancel
@@ -569,28 +1368,165 @@ async def update_booking_status(
     
     if new_status == "cancelled" and not is_passenger and not is_driver:
         raise HTTPException(status_code=403, detail="Not authorized to cancel")
+
+@app.put("/api/bookings/{booking_id}/status")
+async def update_booking_status(
+    booking_id: str,
+    update: BookingStatusUpdate,
+    current_user: dict = Depends(get_current_user)
+):
+    """Update booking status"""
+    booking = await bookings_collection.find_one({"_id": ObjectId(booking_id)})
+    if not booking:
+        raise HTTPException(status_code=404, detail="Booking not found")
     
-    await bookings_collection.update_one(
-        {"_id": ObjectId(booking_id)},
-        {"$set": {"status": new_status, "updated_at": datetime.utcnow()}}
-    )
+    current_status = booking["status"]
+    new_status = update.status
+    check_booking_transition(booking, new_status, current_user["id"])
     
-    # Update ride booked seats if accepted
+    # Reserve seats on the booked segments before accepting, guarded so no
+    # segment of the ride can be overbooked
+    deltas = booking_deltas(booking)
     if new_status == "accepted":
-        await rides_collection.update_one(
-            {"_id": ObjectId(booking["ride_id"])},
-            {"$inc": {"booked_seats": booking["seats"]}}
+        reserved = await rides_collection.update_one(
+            capacity_filter(booking["ride_id"], deltas), seats_update(deltas)
         )
+        if reserved.matched_count == 0:
+            raise HTTPException(status_code=400, detail="Not enough seats available")
+        etag_cache.invalidate(("ride", booking["ride_id"]))
+    
+    # Guard on the status we validated so concurrent updates can't both apply
+    event = booking_status_event(booking, new_status, current_user["id"])
+    updated = await bookings_collection.find_one_and_update(
+        {"_id": ObjectId(booking_id), "status": current_status},
+        with_event({"$set": {"status": new_status, "updated_at": datetime.utcnow()}}, event),
+        return_document=ReturnDocument.AFTER
+    )
+    if updated is None:
+        if new_status == "accepted":
+            await rides_collection.update_one(
+                {"_id": ObjectId(booking["ride_id"])}, seats_update(negate(deltas))
+            )
+            etag_cache.invalidate(("ride", booking["ride_id"]))
+        raise HTTPException(status_code=409, detail="Booking was updated concurrently, please retry")
     
     # Release seats if cancelled after acceptance
     if new_status == "cancelled" and current_status == "accepted":
         await rides_collection.update_one(
-            {"_id": ObjectId(booking["ride_id"])},
-            {"$inc": {"booked_seats": -booking["seats"]}}
+            {"_id": ObjectId(booking["ride_id"])}, seats_update(negate(deltas))
         )
+        etag_cache.invalidate(("ride", booking["ride_id"]))
     
-    booking = await bookings_collection.find_one({"_id": ObjectId(booking_id)})
-    return serialize_doc(booking)
+    return serialize_doc(updated)
+
+@app.post("/api/bookings/bulk-status")
+async def bulk_update_booking_status(
+    request: BulkBookingStatusUpdate,
+    current_user: dict = Depends(get_current_user)
+):
+    """Update the status of many bookings at once; returns a result per item"""
+    results = [{"booking_id": item.booking_id, "success": False} for item in request.updates]
+    
+    def fail(i: int, status_code: int, detail: str):
+        results[i].update({"status_code": status_code, "error": detail})
+    
+    # Load every booking in one query
+    ids = {}
+    for i, item in enumerate(request.updates):
+        if not ObjectId.is_valid(item.booking_id):
+            fail(i, 400, "Invalid booking id")
+        elif item.booking_id in ids:
+            fail(i, 400, "Duplicate booking in request")
+        else:
+            ids[item.booking_id] = i
+    bookings = {
+        str(b["_id"]): b
+        for b in await bookings_collection.find({"_id": {"$in": [ObjectId(b) for b in ids]}}).to_list(None)
+    }
+    
+    # Validate transitions
+    valid = []  # (index, booking, new status)
+    for booking_id, i in ids.items():
+        booking = bookings.get(booking_id)
+        if booking is None:
+            fail(i, 404, "Booking not found")
+            continue
+        try:
+            check_booking_transition(booking, request.updates[i].status, current_user["id"])
+        except HTTPException as e:
+            fail(i, e.status_code, e.detail)
+            continue
+        valid.append((i, booking, request.updates[i].status))
+    
+    # Reserve seats once per ride for all its acceptances, guarded against
+    # overbooking any segment
+    accepted_seats = {}  # ride id -> seats added per segment
+    for _, booking, new_status in valid:
+        if new_status == "accepted":
+            add_seats(accepted_seats.setdefault(booking["ride_id"], []), *booking_legs(booking), booking["seats"])
+    for ride_id, deltas in list(accepted_seats.items()):
+        reserved = await rides_collection.update_one(capacity_filter(ride_id, deltas), seats_update(deltas))
+        if reserved.matched_count == 0:
+            del accepted_seats[ride_id]
+            for i, booking, new_status in valid:
+                if new_status == "accepted" and booking["ride_id"] == ride_id:
+                    fail(i, 400, "Not enough seats available")
+    for ride_id in accepted_seats:
+        etag_cache.invalidate(("ride", ride_id))
+    valid = [
+        (i, booking, new_status) for i, booking, new_status in valid
+        if new_status != "accepted" or booking["ride_id"] in accepted_seats
+    ]
+    if not valid:
+        return {"results": results, "updated": 0}
+    
+    # Apply all transitions in one bulk write, each guarded on the status we validated
+    change_id = uuid.uuid4().hex
+    now = datetime.utcnow()
+    write = await bookings_collection.bulk_write([
+        UpdateOne(
+            {"_id": booking["_id"], "status": booking["status"]},
+            with_event(
+                {"$set": {"status": new_status, "status_change_id": change_id, "updated_at": now}},
+                booking_status_event(booking, new_status, current_user["id"])
+            )
+        )
+        for _, booking, new_status in valid
+    ], ordered=False)
+    
+    applied, lost = valid, []
+    if write.matched_count < len(valid):
+        # Some bookings changed concurrently; find out which updates landed
+        landed = {
+            b["_id"] for b in await bookings_collection.find(
+                {"_id": {"$in": [booking["_id"] for _, booking, _ in valid]}, "status_change_id": change_id},
+                {"_id": 1}
+            ).to_list(None)
+        }
+        applied = [v for v in valid if v[1]["_id"] in landed]
+        lost = [v for v in valid if v[1]["_id"] not in landed]
+        for i, _, _ in lost:
+            fail(i, 409, "Booking was updated concurrently, please retry")
+    
+    # Give back seats of cancelled acceptances and of acceptances that lost a race
+    released = {}  # ride id -> seats given back per segment
+    for _, booking, new_status in applied:
+        if new_status == "cancelled" and booking["status"] == "accepted":
+            add_seats(released.setdefault(booking["ride_id"], []), *booking_legs(booking), booking["seats"])
+    for _, booking, new_status in lost:
+        if new_status == "accepted":
+            add_seats(released.setdefault(booking["ride_id"], []), *booking_legs(booking), booking["seats"])
+    if released:
+        await rides_collection.bulk_write([
+            UpdateOne({"_id": ObjectId(ride_id)}, seats_update(negate(deltas)))
+            for ride_id, deltas in released.items()
+        ], ordered=False)
+        for ride_id in released:
+            etag_cache.invalidate(("ride", ride_id))
+    
+    for i, _, new_status in applied:
+        results[i].update({"success": True, "status": new_status})
+    return {"results": results, "updated": len(applied)}
 
 # ============== Private Request Endpoints ==============
 
@@ -609,10 +1545,10 @@ async def create_private_request(
     request_data["created_at"] = datetime.utcnow()
     request_data["updated_at"] = datetime.utcnow()
     
-    result = await private_requests_collection.insert_one(request_data)
-    doc = await private_requests_collection.find_one({"_id": result.inserted_id})
+    await private_requests_collection.insert_one(request_data)
+    place_index.observe(request_data, REQUEST_PLACE_FIELDS, "passenger_id")
     
-    return serialize_doc(doc)
+    return serialize_doc(request_data)
 
 @app.get("/api/private-requests")
 async def get_my_private_requests(current_user: dict = Depends(get_current_user)):
@@ -650,6 +1586,7 @@ async def respond_to_private_request(
     
     # Create a ride offer based on the request
     ride_data = {
+        "_id": ObjectId(),
         "driver_id": current_user["id"],
         "driver_name": current_user.get("name", "Unknown Driver"),
         "driver_photo": current_user.get("photo"),
@@ -666,29 +1603,36 @@ async def respond_to_private_request(
         "price_per_seat": 0,  # Driver sets this
         "status": "active",
         "booked_seats": 0,
+        "segment_seats": [0],
         "from_private_request": request_id,
         "created_at": datetime.utcnow(),
         "updated_at": datetime.utcnow()
     }
     
-    result = await rides_collection.insert_one(ride_data)
-    ride_doc = await rides_collection.find_one({"_id": result.inserted_id})
+    result = await rides_collection.insert_one(with_event_doc(ride_data, ride_created_event(ride_data)))
+    rides_created([ride_data])
     
     # Update request status
+    event = new_event("private_request.responded", {
+        "request_id": request_id,
+        "passenger_id": request["passenger_id"],
+        "driver_id": current_user["id"],
+        "ride_id": str(result.inserted_id),
+    })
     await private_requests_collection.update_one(
         {"_id": ObjectId(request_id)},
-        {"$set": {
+        with_event({"$set": {
             "status": "responded",
             "responded_by": current_user["id"],
             "ride_offer_id": str(result.inserted_id),
             "updated_at": datetime.utcnow()
-        }}
+        }}, event)
     )
     
     return {
         "success": True,
         "message": "Response sent to passenger",
-        "ride": serialize_doc(ride_doc)
+        "ride": serialize_doc(ride_data)
     }
 
 @app.delete("/api/private-requests/{request_id}")
@@ -752,6 +1696,7 @@ async def send_message(message: ChatMessage, current_user: dict = Depends(get_cu
         raise HTTPException(status_code=400, detail="Must provide booking_id or request_id")
     
     chat_message = {
+        "_id": ObjectId(),
         "booking_id": message.booking_id,
         "request_id": message.request_id,
         "sender_id": current_user["id"],
@@ -762,10 +1707,17 @@ async def send_message(message: ChatMessage, current_user: dict = Depends(get_cu
         "created_at": datetime.utcnow()
     }
     
-    result = await chats_collection.insert_one(chat_message)
-    doc = await chats_collection.find_one({"_id": result.inserted_id})
+    event = new_event("chat.message_sent", {
+        "message_id": str(chat_message["_id"]),
+        "booking_id": message.booking_id,
+        "request_id": message.request_id,
+        "sender_id": current_user["id"],
+        "receiver_id": receiver_id,
+        "content": message.content,
+    })
+    await chats_collection.insert_one(with_event_doc(chat_message, event))
     
-    return serialize_doc(doc)
+    return serialize_doc(chat_message)
 
 @app.get("/api/chats/{context_type}/{context_id}")
 async def get_chat_messages(
@@ -781,7 +1733,7 @@ async def get_chat_messages(
     else:
         raise HTTPException(status_code=400, detail="Invalid context type")
     
-    messages = await chats_collection.find(query).sort("created_at", 1).to_list(500)
+    messages = await archiver.history("chats", query, ("created_at", 1), 500, moved_together=True)
     
     # Mark messages as read
     await chats_collection.update_many(
@@ -838,26 +1790,57 @@ async def create_review(review: ReviewCreate, current_user: dict = Depends(get_c
         "created_at": datetime.utcnow()
     }
     
-    result = await reviews_collection.insert_one(review_data)
+    await reviews_collection.insert_one(review_data)
+    etag_cache.invalidate(("reviews", review.reviewee_id))
     
-    # Update reviewee's average rating
-    all_reviews = await reviews_collection.find({"reviewee_id": review.reviewee_id}).to_list(1000)
-    if all_reviews:
-        avg_rating = sum(r["rating"] for r in all_reviews) / len(all_reviews)
-        await users_collection.update_one(
-            {"_id": ObjectId(review.reviewee_id)},
-            {"$set": {"rating": round(avg_rating, 1), "total_ratings": len(all_reviews)}}
-        )
+    # Update reviewee's average rating in the background; bursts of reviews
+    # for the same user collapse into one recomputation
+    await job_queue.enqueue(
+        "recompute_rating", {"user_id": review.reviewee_id}, dedupe_key=f"rating:{review.reviewee_id}"
+    )
     
-    doc = await reviews_collection.find_one({"_id": result.inserted_id})
-    return serialize_doc(doc)
+    return serialize_doc(review_data)
 
-@app.get("/api/reviews/user/{user_id}")
-async def get_user_reviews(user_id: str, current_user: dict = Depends(get_current_user)):
+REVIEWS_LIMIT = 100
+
+async def reviews_stamp(user_id: str):
+    """Summary that changes whenever a user's reviews are added, removed or edited.
+
+    Read from a secondary while the list itself is read from the primary, so
+    the ETag never describes a newer list than the one it is sent with.
+    """
+    summary = await replica_reads.reviews.aggregate([
+        {"$match": {"reviewee_id": user_id}},
+        {"$group": {"_id": None, "count": {"$sum": 1}, "last_id": {"$max": "$_id"}, "updated": {"$max": "$updated_at"}}},
+    ]).to_list(1)
+    return tuple(summary[0].values()) if summary else "none"
+
+def reviews_list_stamp(reviews: List[dict]):
+    """reviews_stamp of a user whose reviews are all in the list"""
+    if not reviews:
+        return "none"
+    updated = [r["updated_at"] for r in reviews if r.get("updated_at") is not None]
+    return (None, len(reviews), max(r["_id"] for r in reviews), max(updated) if updated else None)
+
+@app.get("/api/reviews/user/{user_id}", dependencies=[Depends(require_token)])
+async def get_user_reviews(user_id: str, request: Request, response: Response):
     """Get reviews for a user"""
+    key = ("reviews", user_id)
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match:
+        etag = await etag_cache.current(key, lambda: reviews_stamp(user_id))
+        if etag_matches(if_none_match, etag):
+            return not_modified(etag)
+    
     reviews = await reviews_collection.find(
         {"reviewee_id": user_id}
-    ).sort("created_at", -1).to_list(100)
+    ).sort("created_at", -1).to_list(REVIEWS_LIMIT)
+    if len(reviews) < REVIEWS_LIMIT:
+        # The list is complete, so it gives the stamp without the aggregate
+        etag = etag_cache.put(key, make_etag(*key, reviews_list_stamp(reviews)))
+    else:
+        etag = await etag_cache.current(key, lambda: reviews_stamp(user_id))
+    set_etag(response, etag)
     return serialize_docs(reviews)
 
 # ============== Image Upload ==============
@@ -876,45 +1859,236 @@ async def upload_image(file: UploadFile = File(...), current_user: dict = Depend
         "image": f"data:{content_type};base64,{base64_image}"
     }
 
+# ============== Debug Endpoints ==============
+
+@app.get("/api/debug/profiles", dependencies=[Depends(require_admin)])
+async def list_profiles():
+    """List stored request profiles, newest first"""
+    return profile_store.list()
+
+@app.get("/api/debug/profiles/{profile_id}", dependencies=[Depends(require_admin)])
+async def get_profile_report(profile_id: str):
+    """Get a profile report (timings, Mongo round trips, hottest functions)"""
+    report = profile_store.get(profile_id)
+    if not report:
+        raise HTTPException(status_code=404, detail="Profile not found")
+    return report
+
+@app.get("/api/debug/profiles/{profile_id}/download", dependencies=[Depends(require_admin)])
+async def download_profile(profile_id: str):
+    """Download raw profiler output (pyinstrument text call tree or cProfile .prof)"""
+    report = profile_store.get(profile_id)
+    artifact = profile_store.get_artifact(profile_id)
+    if not report or artifact is None:
+        raise HTTPException(status_code=404, detail="Profile not found")
+    
+    media_type = "text/plain" if report["profiler"] == "pyinstrument" else "application/octet-stream"
+    return Response(
+        content=artifact,
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="{report["artifact"]}"'}
+    )
+
+# ============== Background Tasks ==============
+
+background_tasks = []
+
+def run_periodically(name: str, interval: float, fn):
+    """Start a background loop calling fn() every interval seconds"""
+    async def loop():
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await fn()
+            except Exception as e:
+                print(f"WARNING: Background task {name} failed: {str(e)}")
+    
+    background_tasks.append(asyncio.create_task(loop(), name=name))
+
+# ============== Jobs ==============
+
+@job_queue.handler("recompute_rating")
+async def recompute_rating_job(job):
+    """Recompute a user's average rating from their reviews"""
+    user_id = job.payload["user_id"]
+    all_reviews = await reviews_collection.find(
+        {"reviewee_id": user_id}, {"rating": 1, "_id": 0}
+    ).to_list(None)
+    if all_reviews:
+        avg_rating = sum(r["rating"] for r in all_reviews) / len(all_reviews)
+        await users_collection.update_one(
+            {"_id": ObjectId(user_id)},
+            {"$set": {"rating": round(avg_rating, 1), "total_ratings": len(all_reviews), "updated_at": datetime.utcnow()}}
+        )
+        etag_cache.invalidate(("user", user_id))
+        await schedule_profile_fanout(user_id)
+
+@job_queue.handler("cancel_ride_bookings")
+async def cancel_ride_bookings_job(job):
+    """Cancel pending bookings of a cancelled ride or of a cancelled series' rides"""
+    if "series_id" in job.payload:
+        rides = await rides_collection.find(
+            {"series_id": job.payload["series_id"], "status": "cancelled"}, {"_id": 1}
+        ).to_list(None)
+        ride_ids = [str(ride["_id"]) for ride in rides]
+    else:
+        ride_ids = [job.payload["ride_id"]]
+    # Each booking records its own status change; cancelled ones drop out of the query
+    while True:
+        bookings = await bookings_collection.find(
+            {"ride_id": {"$in": ride_ids}, "status": "pending"}, BOOKING_EVENT_FIELDS
+        ).to_list(EVENT_BATCH_SIZE)
+        if not bookings:
+            break
+        now = datetime.utcnow()
+        await bookings_collection.bulk_write([
+            UpdateOne(
+                {"_id": booking["_id"], "status": "pending"},
+                with_event(
+                    {"$set": {"status": "cancelled", "updated_at": now}},
+                    booking_status_event(booking, "cancelled", booking["driver_id"])
+                ),
+            )
+            for booking in bookings
+        ], ordered=False)
+
+@job_queue.handler("deliver_otp")
+async def deliver_otp_job(job):
+    """Send the current OTP for a phone number by SMS"""
+    record = await otp_collection.find_one({"phone": job.payload["phone"]})
+    if not record or datetime.utcnow() > record["expires_at"]:
+        return
+    # In production, integrate with SMS service (Twilio/Firebase)
+
+async def schedule_archival():
+    """Queue an archival run unless one is already queued (every app server calls this)"""
+    await job_queue.enqueue("archival", dedupe_key="archival")
+
+# ============== Admin Endpoints ==============
+
+def jsonable(value):
+    """Make ObjectIds in admin/debug documents JSON-serializable"""
+    if isinstance(value, ObjectId):
+        return str(value)
+    if isinstance(value, dict):
+        return {k: jsonable(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [jsonable(v) for v in value]
+    return value
+
+@app.get("/api/admin/jobs/{job_id}", dependencies=[Depends(require_admin)])
+async def get_job(job_id: str):
+    """Get a background job, including its progress state"""
+    job = await job_queue.get(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return jsonable(serialize_doc(job))
+
+@app.get("/api/admin/events", dependencies=[Depends(require_admin)])
+async def get_events(after_seq: int = 0, limit: int = 100, type: Optional[str] = None):
+    """Read the ordered event feed after a sequence number"""
+    events = await event_stream.read(after_seq, min(limit, 1000), types=type.split(",") if type else None)
+    return {
+        "events": [jsonable(event_json(e)) for e in events],
+        "next_after_seq": events[-1]["seq"] if events else after_seq,
+    }
+
+def parse_utc(value: str) -> datetime:
+    """ISO date or datetime as naive UTC"""
+    parsed = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed
+
+@app.get("/api/admin/stats", dependencies=[Depends(require_admin)])
+async def get_stats(
+    granularity: str = "day",
+    start: Optional[str] = None,
+    end: Optional[str] = None,
+    region: Optional[str] = None
+):
+    """Rides, fill rate, acceptance and cancellations per bucket and region in [start, end), from the rollups"""
+    if granularity not in GRANULARITIES:
+        raise HTTPException(status_code=400, detail=f"granularity must be one of {', '.join(GRANULARITIES)}")
+    try:
+        end_at = parse_utc(end) if end else datetime.utcnow()
+        start_at = parse_utc(start) if start else end_at - timedelta(days=7)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="start and end must be ISO dates or datetimes")
+    
+    stats = await analytics_rollup.stats(granularity, start_at, end_at, region)
+    return {
+        "granularity": granularity,
+        "start": start_at.isoformat(),
+        "end": end_at.isoformat(),
+        "watermark_seq": await event_stream.sink_position(analytics_rollup.name),
+        **stats,
+    }
+
+@app.get("/api/admin/metrics", dependencies=[Depends(require_admin)])
+async def get_metrics():
+    """Operational metrics"""
+    return {
+        "jobs": await job_queue.metrics(),
+        "events": await event_stream.metrics(),
+        "search_warmer": search_warmer.metrics(),
+        "etag_cache": etag_cache.metrics(),
+        "live_locations": live_locations.metrics(),
+        "mongo_pool": pool_waits.metrics(),
+        "idempotency": idempotency_store.metrics(),
+        "admission": admission.metrics(),
+        "archive": await archiver.metrics(),
+    }
+
 # ============== Startup ==============
 
-@app.on_event("startup")
-async def startup_event():
-    """Create indexes on startup"""
+async def start_services():
+    """Create indexes and start background tasks"""
     try:
         # Check connectivity
-        await db.command("ping")
-        
-        # User indexes
-        await users_collection.create_index("phone", unique=True)
-        
-        # Rides indexes
-        await rides_collection.create_index("driver_id")
-        await rides_collection.create_index("status")
-        await rides_collection.create_index("date")
-        
-        # Bookings indexes
-        await bookings_collection.create_index("ride_id")
-        await bookings_collection.create_index("passenger_id")
-        await bookings_collection.create_index("driver_id")
+        await storage.ping()
+        await storage.create_indexes()
+        await revocations.sync()
         
-        # Private requests indexes
-        await private_requests_collection.create_index("passenger_id")
-        await private_requests_collection.create_index("status")
-        
-        # Chats indexes
-        await chats_collection.create_index("booking_id")
-        await chats_collection.create_index("request_id")
-        
-        # Reviews indexes
-        await reviews_collection.create_index("reviewee_id")
-        await reviews_collection.create_index("ride_id")
-        
-        print("INFO: RideShare API started successfully with MongoDB!")
+        print(f"INFO: RideShare API started successfully with {storage.backend} storage!")
     except Exception as e:
         print(f"FATAL: Could not connect to MongoDB: {str(e)}")
         # In production, we might want the app to fail if DB is down
+    
+    run_periodically("revocation-sync", REVOCATION_SYNC_SECONDS, revocations.sync)
+    run_periodically("event-stream", EVENT_POLL_SECONDS, event_stream.run_once)
+    run_periodically("ride-series", RIDE_SERIES_SCHEDULE_SECONDS, ride_series_scheduler.materialize_due)
+    run_periodically("places", PLACES_REFRESH_SECONDS, place_index.refresh)
+    run_periodically("corridor-flush", CORRIDOR_FLUSH_SECONDS, corridor_rollup.flush)
+    run_periodically("search-warmer", CORRIDOR_WARM_SECONDS, search_warmer.warm)
+    run_periodically("location-tracks", LOCATION_FLUSH_SECONDS, live_locations.flush)
+    if ADMISSION_CONTROL:
+        run_periodically("admission", ADMISSION_INTERVAL_SECONDS, admission.tick)
+    if ARCHIVE_AFTER_DAYS:
+        run_periodically("archival", ARCHIVE_INTERVAL_SECONDS, schedule_archival)
+    # Build the place index without holding up startup
+    background_tasks.append(asyncio.create_task(place_index.refresh(), name="places-build"))
+    if JOB_WORKERS:
+        job_queue.start(JOB_WORKERS)
+
+async def stop_services():
+    """Stop background tasks, flush buffered counts and close the database client"""
+    await job_queue.stop()
+    for task in background_tasks:
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    background_tasks.clear()
+    try:
+        await corridor_rollup.flush()
+    except Exception as e:
+        print(f"WARNING: Could not flush corridor counts: {str(e)}")
+    try:
+        await live_locations.flush()
+    except Exception as e:
+        print(f"WARNING: Could not flush location tracks: {str(e)}")
+    storage.close()
 
+# Single-process development server; production runs serve.py
 if __name__ == "__main__":
     import uvicorn
     import os
@@ -0,0 +1,137 @@
+"""
+RideShare - Sessions
+Verified-token cache and session revocation for JWT auth
+"""
+
+import hashlib
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import Optional
+
+
+def token_digest(token: str) -> bytes:
+    return hashlib.sha256(token.encode()).digest()
+
+
+class TokenCache:
+    """Bounded LRU of verified token claims keyed by token hash.
+
+    An entry is never served past the token's own ``exp``, so caching cannot
+    extend a token's lifetime; revocation is checked separately on every hit.
+    """
+
+    def __init__(self, max_entries: int = 10000):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+
+    def get(self, token: str) -> Optional[dict]:
+        key = token_digest(token)
+        claims = self._entries.get(key)
+        if claims is None:
+            return None
+        if claims.get("exp", 0) <= time.time():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return claims
+
+    def put(self, token: str, claims: dict):
+        key = token_digest(token)
+        self._entries[key] = claims
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def discard(self, token: str):
+        self._entries.pop(token_digest(token), None)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class RevocationList:
+    """In-memory mirror of the revocations collection.
+
+    Two kinds of revocation are stored: a single session (``jti``) and every
+    session of a user issued up to a point in time (``revoked_before``).
+    Only revocations whose tokens could still be valid are kept, so the
+    denylist stays proportional to recent logouts. Checks never touch the
+    database; ``sync`` pulls revocations written by other workers.
+    """
+
+    def __init__(self, collection, token_lifetime: timedelta, sync_overlap: float = 10.0):
+        self.collection = collection
+        self.token_lifetime = token_lifetime
+        self.sync_overlap = timedelta(seconds=sync_overlap)
+        self._jtis = {}  # jti -> expiry epoch seconds
+        self._users = {}  # user_id -> revoked_before epoch seconds
+        self._watermark = None
+
+    def is_revoked(self, claims: dict) -> bool:
+        jti = claims.get("jti")
+        if jti is not None and jti in self._jtis:
+            return True
+        revoked_before = self._users.get(claims.get("sub"))
+        return revoked_before is not None and claims.get("iat", 0) <= revoked_before
+
+    async def revoke_session(self, claims: dict):
+        """Revoke one token (logout)"""
+        expires_at = datetime.utcfromtimestamp(claims["exp"])
+        self._jtis[claims["jti"]] = claims["exp"]
+        await self.collection.insert_one({
+            "jti": claims["jti"],
+            "user_id": claims.get("sub"),
+            "created_at": datetime.utcnow(),
+            "expires_at": expires_at,
+        })
+
+    async def revoke_user(self, user_id: str):
+        """Revoke every token issued to a user so far (account deletion)"""
+        now = datetime.utcnow()
+        self._users[user_id] = time.time()
+        await self.collection.insert_one({
+            "user_id": user_id,
+            "revoked_before": now,
+            "created_at": now,
+            "expires_at": now + self.token_lifetime,
+        })
+
+    def _apply(self, doc: dict):
+        if doc.get("jti"):
+            self._jtis[doc["jti"]] = _epoch(doc["expires_at"])
+        elif doc.get("revoked_before"):
+            revoked_before = _epoch(doc["revoked_before"])
+            if revoked_before > self._users.get(doc["user_id"], 0):
+                self._users[doc["user_id"]] = revoked_before
+
+    async def sync(self):
+        """Load revocations created since the last sync and prune expired ones.
+
+        The window overlaps the previous one so writes from other workers that
+        commit slightly out of timestamp order are not missed.
+        """
+        query = {"expires_at": {"$gt": datetime.utcnow()}}
+        if self._watermark is not None:
+            query["created_at"] = {"$gte": self._watermark - self.sync_overlap}
+        async for doc in self.collection.find(query):
+            self._apply(doc)
+            if self._watermark is None or doc["created_at"] > self._watermark:
+                self._watermark = doc["created_at"]
+        if self._watermark is None:
+            self._watermark = datetime.utcnow()
+        self._prune()
+
+    def _prune(self):
+        now = time.time()
+        self._jtis = {jti: exp for jti, exp in self._jtis.items() if exp > now}
+        oldest_valid_iat = now - self.token_lifetime.total_seconds()
+        self._users = {uid: ts for uid, ts in self._users.items() if ts > oldest_valid_iat}
+
+    def __len__(self):
+        return len(self._jtis) + len(self._users)
+
+
+def _epoch(value: datetime) -> float:
+    """Epoch seconds of a naive UTC datetime as stored in Mongo"""
+    return (value - datetime(1970, 1, 1)).total_seconds()
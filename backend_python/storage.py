@@ -0,0 +1,1257 @@
+"""
+RideShare - Storage Backends
+MongoDB (Motor) and in-memory implementations of the app's collections
+
+Both backends expose the same collection interface (the subset of the Motor
+API the app uses), so handlers are written once against ``storage.rides``
+etc. The in-memory backend keeps Mongo semantics for the operators, sorting,
+unique/TTL indexes and atomic single-document updates the app relies on, and
+is selected with STORAGE_BACKEND=memory for fast tests and benchmarks.
+"""
+
+import re
+import time
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+from typing import Optional
+
+from bson import ObjectId
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import DeleteMany, DeleteOne, InsertOne, ReturnDocument, UpdateMany, monitoring
+from pymongo.read_concern import ReadConcern
+from pymongo.read_preferences import SecondaryPreferred
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+from pymongo.results import BulkWriteResult, DeleteResult, InsertManyResult, InsertOneResult, UpdateResult
+
+# Attribute name -> collection name
+COLLECTIONS = {
+    "users": "users",
+    "rides": "rides",
+    "ride_series": "ride_series",
+    "bookings": "bookings",
+    "private_requests": "private_requests",
+    "chats": "chats",
+    "reviews": "reviews",
+    "otps": "otps",
+    "revocations": "revocations",
+    "jobs": "jobs",
+    "events": "events",
+    "event_state": "event_state",
+    "corridors": "corridors",
+    "ride_tracks": "ride_tracks",
+    "idempotency_keys": "idempotency_keys",
+    "rides_archive": "rides_archive",
+    "bookings_archive": "bookings_archive",
+    "chats_archive": "chats_archive",
+    "analytics": "analytics_rollups",
+}
+
+# Indexes created on startup: collection attribute -> [(keys, options)]
+INDEXES = {
+    "users": [("phone", {"unique": True})],
+    "rides": [
+        ("driver_id", {}),
+        ("status", {}),
+        ("date", {}),
+        ([("driver_id", 1), ("status", 1), ("date", 1), ("time", 1)], {}),
+        ("_outbox_at", {"sparse": True}),
+        # One occurrence per series and day
+        ([("series_id", 1), ("date", 1)], {"unique": True, "partialFilterExpression": {"series_id": {"$exists": True}}}),
+    ],
+    "ride_series": [("driver_id", {}), ([("status", 1), ("materialized_until", 1)], {})],
+    "bookings": [("ride_id", {}), ("passenger_id", {}), ("driver_id", {}), ("_outbox_at", {"sparse": True})],
+    "private_requests": [("passenger_id", {}), ("status", {}), ("_outbox_at", {"sparse": True})],
+    "chats": [("booking_id", {}), ("request_id", {}), ("sender_id", {}), ("receiver_id", {}),
+              ("_outbox_at", {"sparse": True})],
+    "reviews": [("reviewee_id", {}), ("reviewer_id", {}), ("ride_id", {})],
+    "revocations": [("created_at", {}), ("expires_at", {"expireAfterSeconds": 0})],
+    "jobs": [
+        ([("status", 1), ("run_at", 1)], {}),
+        # At most one queued job per dedupe key
+        ("dedupe_key", {
+            "name": "dedupe_key_queued",
+            "unique": True,
+            "partialFilterExpression": {"status": "queued", "dedupe_key": {"$type": "string"}},
+        }),
+        ("expires_at", {"expireAfterSeconds": 0}),
+    ],
+    "events": [("seq", {"unique": True}), ("expires_at", {"expireAfterSeconds": 0})],
+    "corridors": [([("date", 1), ("searches", -1)], {}), ("expires_at", {"expireAfterSeconds": 0})],
+    "ride_tracks": [("expires_at", {"expireAfterSeconds": 0})],
+    "idempotency_keys": [("expires_at", {"expireAfterSeconds": 0})],
+    # Only what history reads and account deletion need
+    "rides_archive": [([("driver_id", 1), ("created_at", -1)], {})],
+    "bookings_archive": [([("passenger_id", 1), ("created_at", -1)], {}), ([("driver_id", 1), ("created_at", -1)], {})],
+    "chats_archive": [("booking_id", {}), ("sender_id", {}), ("receiver_id", {})],
+    "analytics": [([("granularity", 1), ("bucket", 1)], {}), ("expires_at", {"expireAfterSeconds": 0})],
+}
+
+
+class MotorStorage:
+    """Collections backed by a MongoDB database through Motor"""
+
+    backend = "mongo"
+
+    def __init__(self, mongo_url: str, db_name: str, **client_options):
+        self.client = AsyncIOMotorClient(mongo_url, **client_options)
+        self.db = self.client[db_name]
+        for attr, name in COLLECTIONS.items():
+            setattr(self, attr, self.db[name])
+
+    def collection(self, name: str):
+        """Get a collection that is not one of the core COLLECTIONS"""
+        return self.db[name]
+
+    def secondary_reads(self, max_staleness_seconds: int = 90, read_concern: str = "local"):
+        """The core collections reading from secondaries at most max_staleness_seconds behind.
+
+        Writes through them still go to the primary. The primary serves the
+        reads when no secondary is fresh enough, and on a standalone server.
+        """
+        read_preference = SecondaryPreferred(max_staleness=max_staleness_seconds)
+        return SimpleNamespace(**{
+            attr: getattr(self, attr).with_options(
+                read_preference=read_preference, read_concern=ReadConcern(read_concern)
+            )
+            for attr in COLLECTIONS
+        })
+
+    async def ping(self):
+        await self.db.command("ping")
+
+    async def create_indexes(self):
+        for attr, indexes in INDEXES.items():
+            for keys, options in indexes:
+                await getattr(self, attr).create_index(keys, **options)
+
+    def close(self):
+        self.client.close()
+
+
+class MemoryStorage:
+    """Collections held in process memory (no persistence).
+
+    ``event_listeners`` receive a succeeded event per operation, like pymongo
+    command listeners, so round-trip accounting works on both backends.
+    """
+
+    backend = "memory"
+
+    def __init__(self, event_listeners=()):
+        self._collections = {}
+        self._listeners = list(event_listeners)
+        for attr, name in COLLECTIONS.items():
+            setattr(self, attr, self.collection(name))
+
+    def collection(self, name: str):
+        if name not in self._collections:
+            self._collections[name] = MemoryCollection(name, self._listeners, self)
+        return self._collections[name]
+
+    def secondary_reads(self, max_staleness_seconds: int = 90, read_concern: str = "local"):
+        """There is only one copy of the data"""
+        return self
+
+    async def ping(self):
+        pass
+
+    async def create_indexes(self):
+        for attr, indexes in INDEXES.items():
+            for keys, options in indexes:
+                await getattr(self, attr).create_index(keys, **options)
+
+    def close(self):
+        pass
+
+
+def create_storage(backend: str, mongo_url: str = None, db_name: str = None, **client_options):
+    """Build the storage backend named by STORAGE_BACKEND (client options only apply to Mongo)"""
+    if backend == "mongo":
+        return MotorStorage(mongo_url, db_name, **client_options)
+    if backend == "memory":
+        # There is no connection pool, so only command listeners apply
+        listeners = client_options.get("event_listeners", ())
+        return MemoryStorage([l for l in listeners if isinstance(l, monitoring.CommandListener)])
+    raise ValueError(f"Unknown storage backend: {backend}")
+
+
+# ============== In-memory engine ==============
+
+_MISSING = object()
+
+
+def _clone(value):
+    """Copy containers so callers never share state with stored documents"""
+    if isinstance(value, dict):
+        return {k: _clone(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_clone(v) for v in value]
+    return value
+
+
+def _get_path(doc, path: str):
+    """Resolve a dotted path; list elements are addressed by index"""
+    value = doc
+    for part in path.split("."):
+        if isinstance(value, dict):
+            value = value.get(part, _MISSING)
+        elif isinstance(value, list) and part.isdigit():
+            index = int(part)
+            value = value[index] if index < len(value) else _MISSING
+        else:
+            return _MISSING
+        if value is _MISSING:
+            return _MISSING
+    return value
+
+
+def _set_path(doc, path: str, value):
+    parts = path.split(".")
+    target = doc
+    for part in parts[:-1]:
+        if isinstance(target, list):
+            target = target[int(part)]
+        else:
+            target = target.setdefault(part, {})
+    last = parts[-1]
+    if isinstance(target, list):
+        index = int(last)
+        while len(target) <= index:
+            target.append(None)
+        target[index] = value
+    else:
+        target[last] = value
+
+
+def _unset_path(doc, path: str):
+    parts = path.split(".")
+    target = _get_path(doc, ".".join(parts[:-1])) if len(parts) > 1 else doc
+    if isinstance(target, dict):
+        target.pop(parts[-1], None)
+    elif isinstance(target, list) and parts[-1].isdigit() and int(parts[-1]) < len(target):
+        target[int(parts[-1])] = None
+
+
+def _type_order(value):
+    """BSON comparison order of type brackets"""
+    if value is None or value is _MISSING:
+        return 1
+    if isinstance(value, bool):
+        return 8
+    if isinstance(value, (int, float)):
+        return 2
+    if isinstance(value, str):
+        return 3
+    if isinstance(value, dict):
+        return 4
+    if isinstance(value, list):
+        return 5
+    if isinstance(value, ObjectId):
+        return 7
+    if isinstance(value, datetime):
+        return 9
+    return 10
+
+
+# $type aliases of the type brackets above
+_TYPE_ORDERS = {"null": 1, "number": 2, "string": 3, "object": 4, "array": 5, "objectId": 7, "bool": 8, "date": 9}
+
+
+def _sort_key(value):
+    order = _type_order(value)
+    if order == 1:
+        return (order, 0)
+    if order in (4, 5, 10):
+        return (order, repr(value))
+    return (order, value)
+
+
+def _compare(a, b, op):
+    """Range comparison; like Mongo, only values of the same type bracket match"""
+    if _type_order(a) != _type_order(b):
+        return False
+    if a is None or a is _MISSING:
+        return op in ("$gte", "$lte")
+    try:
+        if op == "$gt":
+            return a > b
+        if op == "$gte":
+            return a >= b
+        if op == "$lt":
+            return a < b
+        return a <= b
+    except TypeError:
+        return False
+
+
+def _values_equal(value, expected):
+    if value is _MISSING:
+        return expected is None
+    if value == expected and _type_order(value) == _type_order(expected):
+        return True
+    if isinstance(value, list) and not isinstance(expected, list):
+        return any(_values_equal(v, expected) for v in value)
+    return False
+
+
+def _match_operators(value, spec: dict, doc) -> bool:
+    for op, arg in spec.items():
+        if op == "$eq":
+            ok = _values_equal(value, arg)
+        elif op == "$ne":
+            ok = not _values_equal(value, arg)
+        elif op in ("$gt", "$gte", "$lt", "$lte"):
+            if isinstance(value, list):
+                ok = any(_compare(v, arg, op) for v in value)
+            else:
+                ok = _compare(value, arg, op)
+        elif op == "$in":
+            ok = any(_values_equal(value, a) for a in arg)
+        elif op == "$nin":
+            ok = not any(_values_equal(value, a) for a in arg)
+        elif op == "$exists":
+            ok = (value is not _MISSING) == bool(arg)
+        elif op == "$type":
+            ok = value is not _MISSING and _type_order(value) == _TYPE_ORDERS[arg]
+        elif op == "$regex":
+            flags = re.IGNORECASE if "i" in spec.get("$options", "") else 0
+            ok = isinstance(value, str) and re.search(arg, value, flags) is not None
+        elif op == "$options":
+            ok = True
+        elif op == "$not":
+            ok = not _match_operators(value, arg, doc)
+        elif op == "$size":
+            ok = isinstance(value, list) and len(value) == arg
+        elif op == "$all":
+            ok = isinstance(value, list) and all(_values_equal(value, a) for a in arg)
+        elif op == "$elemMatch":
+            ok = isinstance(value, list) and any(
+                matches(v, arg) if isinstance(v, dict) else _match_operators(v, arg, doc)
+                for v in value
+            )
+        else:
+            raise NotImplementedError(f"Query operator {op} is not supported by the memory backend")
+        if not ok:
+            return False
+    return True
+
+
+def matches(doc, query: Optional[dict], variables: Optional[dict] = None) -> bool:
+    """Evaluate a Mongo query filter against a document"""
+    if not query:
+        return True
+    for key, condition in query.items():
+        if key == "$and":
+            if not all(matches(doc, q, variables) for q in condition):
+                return False
+        elif key == "$or":
+            if not any(matches(doc, q, variables) for q in condition):
+                return False
+        elif key == "$nor":
+            if any(matches(doc, q, variables) for q in condition):
+                return False
+        elif key == "$expr":
+            if not evaluate(condition, doc, variables):
+                return False
+        else:
+            value = _get_path(doc, key)
+            if isinstance(condition, dict) and condition and all(k.startswith("$") for k in condition):
+                if not _match_operators(value, condition, doc):
+                    return False
+            elif isinstance(condition, re.Pattern):
+                if not (isinstance(value, str) and condition.search(value)):
+                    return False
+            elif not _values_equal(value, condition):
+                return False
+    return True
+
+
+_EXPR_COMPARISONS = {
+    "$gt": lambda a, b: a > b,
+    "$gte": lambda a, b: a >= b,
+    "$lt": lambda a, b: a < b,
+    "$lte": lambda a, b: a <= b,
+}
+
+
+def evaluate(expr, doc, variables: Optional[dict] = None):
+    """Evaluate an aggregation expression ($expr and pipeline stages).
+
+    ``variables`` holds $$-variables: ``let`` values of a $lookup and the
+    element names bound by $map/$filter ("this" by default).
+    """
+    if isinstance(expr, str) and expr.startswith("$$"):
+        name, _, path = expr[2:].partition(".")
+        value = doc if name in ("ROOT", "CURRENT") else (variables or {}).get(name, _MISSING)
+        if path and value is not _MISSING:
+            value = _get_path(value, path)
+        return None if value is _MISSING else value
+    if isinstance(expr, str) and expr.startswith("$"):
+        value = _get_path(doc, expr[1:])
+        return None if value is _MISSING else value
+    if isinstance(expr, list):
+        return [evaluate(e, doc, variables) for e in expr]
+    if not isinstance(expr, dict):
+        return expr
+    if len(expr) != 1 or not next(iter(expr)).startswith("$"):
+        return {k: evaluate(v, doc, variables) for k, v in expr.items()}
+
+    op, args = next(iter(expr.items()))
+    # Operators whose arguments are evaluated lazily or per element
+    if op == "$literal":
+        return args
+    if op == "$cond":
+        if isinstance(args, dict):
+            condition, then, otherwise = args["if"], args["then"], args["else"]
+        else:
+            condition, then, otherwise = args
+        return evaluate(then if evaluate(condition, doc, variables) else otherwise, doc, variables)
+    if op in ("$map", "$filter"):
+        items = evaluate(args["input"], doc, variables) or []
+        name = args.get("as", "this")
+        results = []
+        for item in items:
+            scope = {**(variables or {}), name: item}
+            if op == "$map":
+                results.append(evaluate(args["in"], doc, scope))
+            elif evaluate(args["cond"], doc, scope):
+                results.append(item)
+        return results
+
+    values = evaluate(args, doc, variables) if isinstance(args, list) else [evaluate(args, doc, variables)]
+    if op == "$add":
+        return sum(v or 0 for v in values)
+    if op == "$subtract":
+        return (values[0] or 0) - (values[1] or 0)
+    if op == "$multiply":
+        result = 1
+        for v in values:
+            result *= v or 0
+        return result
+    if op == "$divide":
+        return values[0] / values[1] if values[1] else None
+    if op in _EXPR_COMPARISONS:
+        return _EXPR_COMPARISONS[op](_sort_key(values[0]), _sort_key(values[1]))
+    if op == "$eq":
+        return values[0] == values[1]
+    if op == "$ne":
+        return values[0] != values[1]
+    if op == "$and":
+        return all(values)
+    if op == "$or":
+        return any(values)
+    if op == "$not":
+        return not values[0]
+    if op == "$in":
+        return values[0] in (values[1] or [])
+    if op == "$size":
+        return len(values[0] or [])
+    if op == "$ifNull":
+        return values[0] if values[0] is not None else values[1]
+    if op in ("$sum", "$max", "$min") and len(values) == 1 and isinstance(values[0], list):
+        values = values[0]
+    if op == "$sum":
+        return sum(v for v in values if isinstance(v, (int, float)) and not isinstance(v, bool))
+    if op == "$max":
+        return max((v for v in values if v is not None), default=None, key=_sort_key)
+    if op == "$min":
+        return min((v for v in values if v is not None), default=None, key=_sort_key)
+    if op == "$arrayElemAt":
+        array, index = values
+        return array[index] if array and -len(array) <= index < len(array) else None
+    if op == "$range":
+        return list(range(*values))
+    if op == "$arrayToObject":
+        result = {}
+        for pair in values[0] or []:
+            key, value = (pair["k"], pair["v"]) if isinstance(pair, dict) else pair
+            result[key] = value
+        return result
+    if op == "$toString":
+        return None if values[0] is None else str(values[0])
+    if op == "$toObjectId":
+        return None if values[0] is None else ObjectId(values[0])
+    if op == "$concat":
+        return None if any(v is None for v in values) else "".join(values)
+    if op == "$concatArrays":
+        return None if any(v is None for v in values) else [item for value in values for item in value]
+    raise NotImplementedError(f"Expression operator {op} is not supported by the memory backend")
+
+
+def apply_update(doc: dict, update, inserting: bool = False):
+    """Apply update operators, an update pipeline or a replacement document in place"""
+    if isinstance(update, list):
+        result = _run_pipeline([doc], update, None)[0]
+        if result is not doc:
+            doc.clear()
+            doc.update(result)
+        return
+    if not any(k.startswith("$") for k in update):
+        _id = doc.get("_id")
+        doc.clear()
+        doc.update(_clone(update))
+        if _id is not None:
+            doc["_id"] = _id
+        return
+
+    for op, fields in update.items():
+        for path, arg in fields.items():
+            if op == "$set":
+                _set_path(doc, path, _clone(arg))
+            elif op == "$setOnInsert":
+                if inserting:
+                    _set_path(doc, path, _clone(arg))
+            elif op == "$unset":
+                _unset_path(doc, path)
+            elif op == "$inc":
+                current = _get_path(doc, path)
+                _set_path(doc, path, (0 if current in (_MISSING, None) else current) + arg)
+            elif op == "$mul":
+                current = _get_path(doc, path)
+                _set_path(doc, path, (0 if current in (_MISSING, None) else current) * arg)
+            elif op in ("$min", "$max"):
+                current = _get_path(doc, path)
+                if current is _MISSING or (
+                    _sort_key(arg) < _sort_key(current) if op == "$min" else _sort_key(arg) > _sort_key(current)
+                ):
+                    _set_path(doc, path, _clone(arg))
+            elif op == "$currentDate":
+                _set_path(doc, path, datetime.utcnow())
+            elif op in ("$push", "$addToSet"):
+                current = _get_path(doc, path)
+                array = [] if current in (_MISSING, None) else current
+                items = arg["$each"] if isinstance(arg, dict) and "$each" in arg else [arg]
+                for item in items:
+                    if op == "$push" or item not in array:
+                        array.append(_clone(item))
+                if isinstance(arg, dict) and "$slice" in arg:
+                    limit = arg["$slice"]
+                    array[:] = array[limit:] if limit < 0 else array[:limit]
+                _set_path(doc, path, array)
+            elif op == "$pull":
+                current = _get_path(doc, path)
+                if isinstance(current, list):
+                    if isinstance(arg, dict) and any(k.startswith("$") for k in arg):
+                        current[:] = [v for v in current if not _match_operators(v, arg, doc)]
+                    elif isinstance(arg, dict):
+                        current[:] = [v for v in current if not (isinstance(v, dict) and matches(v, arg))]
+                    else:
+                        current[:] = [v for v in current if v != arg]
+            else:
+                raise NotImplementedError(f"Update operator {op} is not supported by the memory backend")
+
+
+def _project(doc: dict, projection) -> dict:
+    if not projection:
+        return _clone(doc)
+    if isinstance(projection, (list, tuple)):
+        projection = {field: 1 for field in projection}
+    include_id = projection.get("_id", 1)
+    fields = {k: v for k, v in projection.items() if k != "_id"}
+    if fields and all(fields.values()):
+        result = {}
+        for path in fields:
+            value = _get_path(doc, path)
+            if value is not _MISSING:
+                _set_path(result, path, _clone(value))
+        if include_id and "_id" in doc:
+            result["_id"] = doc["_id"]
+        return result
+    result = _clone(doc)
+    for path in fields:
+        _unset_path(result, path)
+    if not include_id:
+        result.pop("_id", None)
+    return result
+
+
+def _normalize_sort(key_or_list, direction=None):
+    if key_or_list is None:
+        return []
+    if isinstance(key_or_list, str):
+        return [(key_or_list, direction or 1)]
+    if isinstance(key_or_list, dict):
+        return list(key_or_list.items())
+    return list(key_or_list)
+
+
+def _sort_docs(docs, sort_spec):
+    # Stable sorts applied from the least to the most significant key
+    for field, direction in reversed(sort_spec):
+        docs.sort(
+            key=lambda d: _sort_key(_get_path(d, field)),
+            reverse=direction in (-1, "desc", "descending"),
+        )
+    return docs
+
+
+def _index_fields(keys):
+    if isinstance(keys, str):
+        return (keys,)
+    return tuple(field for field, _ in keys)
+
+
+def _hashable(value):
+    try:
+        hash(value)
+        return True
+    except TypeError:
+        return False
+
+
+def _freeze(value):
+    """Hashable stand-in for a $group key"""
+    if isinstance(value, dict):
+        return tuple((k, _freeze(v)) for k, v in value.items())
+    if isinstance(value, list):
+        return tuple(_freeze(v) for v in value)
+    return value
+
+
+def _project_stage(doc: dict, spec: dict, variables: Optional[dict]) -> dict:
+    """$project/$addFields-style projection with computed fields"""
+    include_id = spec.get("_id", 1) not in (0, False)
+    fields = {k: v for k, v in spec.items() if k != "_id"}
+    if all(v in (0, False) for v in fields.values()):
+        result = _clone(doc)
+        for path in fields:
+            _unset_path(result, path)
+    else:
+        result = {}
+        for path, value in fields.items():
+            if value in (1, True):
+                found = _get_path(doc, path)
+                if found is not _MISSING:
+                    _set_path(result, path, _clone(found))
+            else:
+                _set_path(result, path, evaluate(value, doc, variables))
+        if include_id and "_id" in doc:
+            result["_id"] = doc["_id"]
+    if not include_id:
+        result.pop("_id", None)
+    elif "_id" in spec and spec["_id"] not in (0, 1, False, True):
+        result["_id"] = evaluate(spec["_id"], doc, variables)
+    return result
+
+
+def _accumulate(op: str, values: list):
+    if op == "$sum":
+        return sum(v for v in values if isinstance(v, (int, float)) and not isinstance(v, bool))
+    if op == "$avg":
+        numbers = [v for v in values if isinstance(v, (int, float)) and not isinstance(v, bool)]
+        return sum(numbers) / len(numbers) if numbers else None
+    if op == "$min":
+        return min((v for v in values if v is not None), default=None, key=_sort_key)
+    if op == "$max":
+        return max((v for v in values if v is not None), default=None, key=_sort_key)
+    if op == "$first":
+        return values[0] if values else None
+    if op == "$last":
+        return values[-1] if values else None
+    if op == "$push":
+        return values
+    if op == "$addToSet":
+        unique = []
+        for v in values:
+            if v not in unique:
+                unique.append(v)
+        return unique
+    raise NotImplementedError(f"Accumulator {op} is not supported by the memory backend")
+
+
+def _group_stage(docs: list, spec: dict, variables: Optional[dict]) -> list:
+    groups = {}  # frozen key -> (key, docs)
+    for doc in docs:
+        key = evaluate(spec["_id"], doc, variables)
+        groups.setdefault(_freeze(key), (key, []))[1].append(doc)
+    results = []
+    for key, members in groups.values():
+        result = {"_id": key}
+        for field, accumulator in spec.items():
+            if field == "_id":
+                continue
+            op, arg = next(iter(accumulator.items()))
+            if op == "$count":
+                result[field] = len(members)
+            else:
+                result[field] = _accumulate(op, [evaluate(arg, d, variables) for d in members])
+        results.append(result)
+    return results
+
+
+def _lookup_stage(docs: list, spec: dict, database, variables: Optional[dict]) -> list:
+    foreign = database.collection(spec["from"])
+    foreign._expire()
+    local_field, foreign_field = spec.get("localField"), spec.get("foreignField")
+    results = []
+    for doc in docs:
+        if local_field:
+            value = _get_path(doc, local_field)
+            value = None if value is _MISSING else value
+            keys = value if isinstance(value, list) else [value]
+            joined = {}
+            for key in keys:
+                query = {foreign_field: key}
+                joined.update((d["_id"], d) for d in foreign._candidates(query) if matches(d, query))
+            joined = list(joined.values())
+        else:
+            joined = list(foreign._docs.values())
+        joined = [_clone(d) for d in joined]
+        if "pipeline" in spec:
+            scope = {**(variables or {}), **{k: evaluate(v, doc, variables) for k, v in spec.get("let", {}).items()}}
+            joined = _run_pipeline(joined, spec["pipeline"], database, scope)
+        result = dict(doc)
+        _set_path(result, spec["as"], joined)
+        results.append(result)
+    return results
+
+
+def _unwind_stage(docs: list, spec) -> list:
+    if isinstance(spec, str):
+        spec = {"path": spec}
+    path = spec["path"][1:]
+    keep_empty = spec.get("preserveNullAndEmptyArrays", False)
+    results = []
+    for doc in docs:
+        value = _get_path(doc, path)
+        if isinstance(value, list) and value:
+            for item in value:
+                unwound = dict(doc)
+                _set_path(unwound, path, item)
+                results.append(unwound)
+        elif isinstance(value, list) or value in (_MISSING, None):
+            if keep_empty:
+                results.append(doc)
+        else:
+            results.append(doc)
+    return results
+
+
+def _run_pipeline(docs: list, pipeline: list, database, variables: Optional[dict] = None) -> list:
+    """Run aggregation stages over documents (already cloned by the caller)"""
+    for stage in pipeline:
+        name, spec = next(iter(stage.items()))
+        if name == "$match":
+            docs = [d for d in docs if matches(d, spec, variables)]
+        elif name == "$sort":
+            docs = _sort_docs(docs, _normalize_sort(spec))
+        elif name == "$skip":
+            docs = docs[spec:]
+        elif name == "$limit":
+            docs = docs[:spec]
+        elif name == "$project":
+            docs = [_project_stage(d, spec, variables) for d in docs]
+        elif name in ("$addFields", "$set"):
+            for d in docs:
+                for path, value in spec.items():
+                    _set_path(d, path, evaluate(value, d, variables))
+        elif name == "$unset":
+            for d in docs:
+                for path in ([spec] if isinstance(spec, str) else spec):
+                    _unset_path(d, path)
+        elif name == "$group":
+            docs = _group_stage(docs, spec, variables)
+        elif name == "$lookup":
+            docs = _lookup_stage(docs, spec, database, variables)
+        elif name == "$unwind":
+            docs = _unwind_stage(docs, spec)
+        elif name == "$count":
+            docs = [{spec: len(docs)}] if docs else []
+        elif name == "$replaceRoot":
+            docs = [evaluate(spec["newRoot"], d, variables) for d in docs]
+        else:
+            raise NotImplementedError(f"Pipeline stage {name} is not supported by the memory backend")
+    return docs
+
+
+class MemoryCommandEvent:
+    """Stand-in for pymongo's CommandSucceededEvent"""
+
+    __slots__ = ("command_name", "database_name", "duration_micros")
+
+    def __init__(self, command_name: str):
+        self.command_name = command_name
+        self.database_name = "memory"
+        self.duration_micros = 0
+
+
+class MemoryCursor:
+    """Lazy query result supporting sort/skip/limit/to_list/async iteration"""
+
+    def __init__(self, collection, query, projection=None):
+        self._collection = collection
+        self._query = query
+        self._projection = projection
+        self._sort = []
+        self._skip = 0
+        self._limit = 0
+
+    def sort(self, key_or_list, direction=None):
+        self._sort = _normalize_sort(key_or_list, direction)
+        return self
+
+    def skip(self, count: int):
+        self._skip = count
+        return self
+
+    def limit(self, count: int):
+        self._limit = count
+        return self
+
+    def batch_size(self, size: int):
+        return self
+
+    def _results(self):
+        docs = self._collection._select(self._query)
+        if self._sort:
+            docs = _sort_docs(docs, self._sort)
+        if self._skip:
+            docs = docs[self._skip:]
+        if self._limit:
+            docs = docs[: self._limit]
+        return [_project(doc, self._projection) for doc in docs]
+
+    async def to_list(self, length: Optional[int] = None):
+        self._collection._command("find")
+        results = self._results()
+        return results[:length] if length else results
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self):
+        self._collection._command("find")
+        for doc in self._results():
+            yield doc
+
+
+class MemoryAggregateCursor:
+    """Result of MemoryCollection.aggregate (computed when first read)"""
+
+    def __init__(self, collection, pipeline):
+        self._collection = collection
+        self._pipeline = pipeline
+
+    def _results(self):
+        collection = self._collection
+        pipeline = self._pipeline
+        # Let a leading $match use the collection's indexes
+        query = pipeline[0]["$match"] if pipeline and "$match" in pipeline[0] else {}
+        docs = [_clone(d) for d in collection._select(query)]
+        return _run_pipeline(docs, pipeline[1:] if query else pipeline, collection._database)
+
+    async def to_list(self, length: Optional[int] = None):
+        self._collection._command("aggregate")
+        results = self._results()
+        return results[:length] if length else results
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self):
+        self._collection._command("aggregate")
+        for doc in self._results():
+            yield doc
+
+
+class MemoryCollection:
+    """In-memory collection with the Motor collection interface.
+
+    Every method completes without awaiting anything internally, so each
+    operation is atomic with respect to other coroutines on the event loop.
+    """
+
+    def __init__(self, name: str, listeners=(), database=None):
+        self.name = name
+        self._database = database
+        self._listeners = listeners
+        self._docs = {}
+        # index name -> {"fields", "unique", "sparse", "ttl", "entries"}
+        self._indexes = {}
+        self._last_expiry_check = 0.0
+
+    def with_options(self, **kwargs):
+        return self
+
+    def _command(self, command_name: str):
+        if self._listeners:
+            event = MemoryCommandEvent(command_name)
+            for listener in self._listeners:
+                listener.succeeded(event)
+
+    # ---- indexes ----
+
+    async def create_index(self, keys, unique: bool = False, sparse: bool = False,
+                           expireAfterSeconds: Optional[int] = None, name: Optional[str] = None,
+                           partialFilterExpression: Optional[dict] = None, **kwargs):
+        self._command("createIndexes")
+        fields = _index_fields(keys)
+        name = name or "_".join(f"{f}_1" for f in fields)
+        if name in self._indexes:
+            return name
+        index = {"fields": fields, "unique": unique, "sparse": sparse, "partial": partialFilterExpression,
+                 "ttl": expireAfterSeconds, "entries": {}, "overflow": set()}
+        for _id, doc in self._docs.items():
+            self._index_add(index, _id, doc)
+        self._indexes[name] = index
+        return name
+
+    async def drop_index(self, name: str):
+        self._command("dropIndexes")
+        self._indexes.pop(name, None)
+
+    async def index_information(self):
+        self._command("listIndexes")
+        info = {"_id_": {"key": [("_id", 1)]}}
+        for name, index in self._indexes.items():
+            info[name] = {"key": [(f, 1) for f in index["fields"]], "unique": index["unique"]}
+        return info
+
+    def _index_key(self, index, doc):
+        if index["partial"] and not matches(doc, index["partial"]):
+            return _MISSING
+        values = []
+        for field in index["fields"]:
+            value = _get_path(doc, field)
+            values.append(None if value is _MISSING else value)
+        if index["sparse"] and all(v is None for v in values):
+            return _MISSING
+        return tuple(values)
+
+    def _index_add(self, index, _id, doc):
+        key = self._index_key(index, doc)
+        if key is _MISSING:
+            return
+        if not _hashable(key):
+            index["overflow"].add(_id)
+            return
+        entries = index["entries"].setdefault(key, {})
+        if index["unique"] and entries and _id not in entries:
+            raise DuplicateKeyError(
+                f"E11000 duplicate key error collection: {self.name} index: {'_'.join(index['fields'])} "
+                f"dup key: {dict(zip(index['fields'], key))}"
+            )
+        entries[_id] = None
+
+    def _index_remove(self, index, _id, doc):
+        key = self._index_key(index, doc)
+        if key is _MISSING:
+            return
+        index["overflow"].discard(_id)
+        if _hashable(key):
+            entries = index["entries"].get(key)
+            if entries is not None:
+                entries.pop(_id, None)
+                if not entries:
+                    del index["entries"][key]
+
+    def _check_unique(self, _id, doc, old_doc=None):
+        for index in self._indexes.values():
+            if not index["unique"]:
+                continue
+            key = self._index_key(index, doc)
+            if key is _MISSING or not _hashable(key):
+                continue
+            if old_doc is not None and self._index_key(index, old_doc) == key:
+                continue
+            entries = index["entries"].get(key)
+            if entries and _id not in entries:
+                raise DuplicateKeyError(
+                    f"E11000 duplicate key error collection: {self.name} index: {'_'.join(index['fields'])} "
+                    f"dup key: {dict(zip(index['fields'], key))}"
+                )
+
+    def _store(self, doc):
+        self._check_unique(doc["_id"], doc)
+        if doc["_id"] in self._docs:
+            raise DuplicateKeyError(f"E11000 duplicate key error collection: {self.name} index: _id_")
+        self._docs[doc["_id"]] = doc
+        for index in self._indexes.values():
+            self._index_add(index, doc["_id"], doc)
+
+    def _replace(self, old_doc, new_doc):
+        self._check_unique(old_doc["_id"], new_doc, old_doc)
+        for index in self._indexes.values():
+            self._index_remove(index, old_doc["_id"], old_doc)
+        self._docs[old_doc["_id"]] = new_doc
+        for index in self._indexes.values():
+            self._index_add(index, new_doc["_id"], new_doc)
+
+    def _remove(self, doc):
+        for index in self._indexes.values():
+            self._index_remove(index, doc["_id"], doc)
+        del self._docs[doc["_id"]]
+
+    def _expire(self):
+        """Drop documents past a TTL index (checked at most once a second)"""
+        now = time.monotonic()
+        if now - self._last_expiry_check < 1:
+            return
+        self._last_expiry_check = now
+        for index in self._indexes.values():
+            if index["ttl"] is None:
+                continue
+            cutoff = datetime.utcnow() - timedelta(seconds=index["ttl"])
+            field = index["fields"][0]
+            expired = [
+                doc for doc in self._docs.values()
+                if isinstance(doc.get(field), datetime) and doc[field] <= cutoff
+            ]
+            for doc in expired:
+                self._remove(doc)
+
+    # ---- query planning ----
+
+    def _candidates(self, query):
+        """Narrow the scan by _id or a single-field index on an equality predicate"""
+        if not query:
+            return list(self._docs.values())
+        _id = query.get("_id", _MISSING)
+        if _id is not _MISSING and not isinstance(_id, dict):
+            doc = self._docs.get(_id)
+            return [doc] if doc is not None else []
+        for index in self._indexes.values():
+            if len(index["fields"]) != 1 or index["sparse"] or index["partial"]:
+                continue
+            value = query.get(index["fields"][0], _MISSING)
+            if isinstance(value, dict) and set(value) == {"$eq"}:
+                value = value["$eq"]
+            if value is _MISSING or value is None or not _hashable(value) or isinstance(value, (dict, list)):
+                continue
+            ids = dict(index["entries"].get((value,), {}))
+            ids.update(dict.fromkeys(index["overflow"]))
+            return [self._docs[_id] for _id in ids]
+        return list(self._docs.values())
+
+    def _select(self, query, sort=None):
+        self._expire()
+        docs = [doc for doc in self._candidates(query) if matches(doc, query)]
+        if sort:
+            docs = _sort_docs(docs, _normalize_sort(sort))
+        return docs
+
+    def _first(self, query, sort=None):
+        if sort:
+            docs = self._select(query, sort)
+            return docs[0] if docs else None
+        self._expire()
+        for doc in self._candidates(query):
+            if matches(doc, query):
+                return doc
+        return None
+
+    # ---- reads ----
+
+    def find(self, filter: Optional[dict] = None, projection=None, sort=None, limit: int = 0, skip: int = 0):
+        cursor = MemoryCursor(self, filter or {}, projection)
+        if sort:
+            cursor.sort(sort)
+        return cursor.skip(skip).limit(limit)
+
+    async def find_one(self, filter: Optional[dict] = None, projection=None, sort=None):
+        self._command("find")
+        doc = self._first(filter or {}, sort)
+        return _project(doc, projection) if doc is not None else None
+
+    async def count_documents(self, filter: Optional[dict] = None, limit: int = 0):
+        self._command("aggregate")
+        count = len(self._select(filter or {}))
+        return min(count, limit) if limit else count
+
+    async def estimated_document_count(self):
+        self._command("count")
+        return len(self._docs)
+
+    def aggregate(self, pipeline: list, **kwargs):
+        return MemoryAggregateCursor(self, pipeline)
+
+    async def distinct(self, key: str, filter: Optional[dict] = None):
+        self._command("distinct")
+        values = []
+        for doc in self._select(filter or {}):
+            value = _get_path(doc, key)
+            for v in (value if isinstance(value, list) else [value]):
+                if v is not _MISSING and v not in values:
+                    values.append(v)
+        return values
+
+    # ---- writes ----
+
+    async def insert_one(self, document: dict):
+        self._command("insert")
+        self._expire()
+        document.setdefault("_id", ObjectId())
+        self._store(_clone(document))
+        return InsertOneResult(document["_id"], acknowledged=True)
+
+    async def insert_many(self, documents, ordered: bool = True):
+        self._command("insert")
+        self._expire()
+        inserted_ids = []
+        write_errors = []
+        for i, document in enumerate(documents):
+            document.setdefault("_id", ObjectId())
+            try:
+                self._store(_clone(document))
+                inserted_ids.append(document["_id"])
+            except DuplicateKeyError as e:
+                write_errors.append({"index": i, "code": 11000, "errmsg": str(e), "op": document})
+                if ordered:
+                    break
+        if write_errors:
+            raise BulkWriteError({
+                "writeErrors": write_errors,
+                "writeConcernErrors": [],
+                "nInserted": len(inserted_ids),
+                "nUpserted": 0,
+                "nMatched": 0,
+                "nModified": 0,
+                "nRemoved": 0,
+                "upserted": [],
+            })
+        return InsertManyResult(inserted_ids, acknowledged=True)
+
+    def _upsert_document(self, filter: dict, update: dict):
+        doc = {}
+        for key, value in (filter or {}).items():
+            if key.startswith("$"):
+                continue
+            if isinstance(value, dict) and all(k.startswith("$") for k in value):
+                if "$eq" in value:
+                    _set_path(doc, key, _clone(value["$eq"]))
+                continue
+            _set_path(doc, key, _clone(value))
+        apply_update(doc, update, inserting=True)
+        doc.setdefault("_id", ObjectId())
+        self._store(doc)
+        return doc
+
+    def _update_doc(self, doc, update):
+        new_doc = _clone(doc)
+        apply_update(new_doc, update)
+        modified = new_doc != doc
+        if modified:
+            self._replace(doc, new_doc)
+        return new_doc, modified
+
+    async def update_one(self, filter: dict, update: dict, upsert: bool = False, sort=None):
+        self._command("update")
+        doc = self._first(filter, sort)
+        if doc is None:
+            if upsert:
+                new_doc = self._upsert_document(filter, update)
+                return UpdateResult({"n": 1, "nModified": 0, "upserted": new_doc["_id"]}, acknowledged=True)
+            return UpdateResult({"n": 0, "nModified": 0}, acknowledged=True)
+        _, modified = self._update_doc(doc, update)
+        return UpdateResult({"n": 1, "nModified": int(modified)}, acknowledged=True)
+
+    async def update_many(self, filter: dict, update: dict, upsert: bool = False):
+        self._command("update")
+        docs = self._select(filter)
+        if not docs and upsert:
+            new_doc = self._upsert_document(filter, update)
+            return UpdateResult({"n": 1, "nModified": 0, "upserted": new_doc["_id"]}, acknowledged=True)
+        modified = 0
+        for doc in docs:
+            modified += int(self._update_doc(doc, update)[1])
+        return UpdateResult({"n": len(docs), "nModified": modified}, acknowledged=True)
+
+    async def replace_one(self, filter: dict, replacement: dict, upsert: bool = False):
+        return await self.update_one(filter, replacement, upsert=upsert)
+
+    async def find_one_and_update(self, filter: dict, update: dict, projection=None, sort=None,
+                                  upsert: bool = False, return_document=ReturnDocument.BEFORE):
+        self._command("findAndModify")
+        doc = self._first(filter, sort)
+        if doc is None:
+            if not upsert:
+                return None
+            new_doc = self._upsert_document(filter, update)
+            return _project(new_doc, projection) if return_document == ReturnDocument.AFTER else None
+        new_doc, _ = self._update_doc(doc, update)
+        result = new_doc if return_document == ReturnDocument.AFTER else doc
+        return _project(result, projection)
+
+    async def find_one_and_replace(self, filter: dict, replacement: dict, projection=None, sort=None,
+                                   upsert: bool = False, return_document=ReturnDocument.BEFORE):
+        return await self.find_one_and_update(filter, replacement, projection, sort, upsert, return_document)
+
+    async def find_one_and_delete(self, filter: dict, projection=None, sort=None):
+        self._command("findAndModify")
+        doc = self._first(filter, sort)
+        if doc is None:
+            return None
+        self._remove(doc)
+        return _project(doc, projection)
+
+    async def delete_one(self, filter: dict):
+        self._command("delete")
+        doc = self._first(filter)
+        if doc is not None:
+            self._remove(doc)
+        return DeleteResult({"n": int(doc is not None)}, acknowledged=True)
+
+    async def delete_many(self, filter: dict):
+        self._command("delete")
+        docs = self._select(filter)
+        for doc in docs:
+            self._remove(doc)
+        return DeleteResult({"n": len(docs)}, acknowledged=True)
+
+    async def bulk_write(self, requests, ordered: bool = True):
+        """Apply pymongo write models; consecutive models of one kind share a command like on the server"""
+        self._expire()
+        result = {"writeErrors": [], "writeConcernErrors": [], "nInserted": 0, "nUpserted": 0,
+                  "nMatched": 0, "nModified": 0, "nRemoved": 0, "upserted": []}
+        last_kind = None
+        for i, request in enumerate(requests):
+            if isinstance(request, InsertOne):
+                kind = "insert"
+            elif isinstance(request, (DeleteOne, DeleteMany)):
+                kind = "delete"
+            else:
+                kind = "update"
+            if kind != last_kind:
+                self._command(kind)
+                last_kind = kind
+            try:
+                self._bulk_apply(i, request, result)
+            except DuplicateKeyError as e:
+                result["writeErrors"].append({"index": i, "code": 11000, "errmsg": str(e), "op": request})
+                if ordered:
+                    break
+        if result["writeErrors"]:
+            raise BulkWriteError(result)
+        return BulkWriteResult(result, acknowledged=True)
+
+    def _bulk_apply(self, index: int, request, result: dict):
+        if isinstance(request, InsertOne):
+            request._doc.setdefault("_id", ObjectId())
+            self._store(_clone(request._doc))
+            result["nInserted"] += 1
+        elif isinstance(request, (DeleteOne, DeleteMany)):
+            docs = self._select(request._filter)
+            if isinstance(request, DeleteOne):
+                docs = docs[:1]
+            for doc in docs:
+                self._remove(doc)
+            result["nRemoved"] += len(docs)
+        else:
+            docs = self._select(request._filter, getattr(request, "_sort", None))
+            if not isinstance(request, UpdateMany):
+                docs = docs[:1]
+            if not docs and request._upsert:
+                new_doc = self._upsert_document(request._filter, request._doc)
+                result["nUpserted"] += 1
+                result["upserted"].append({"index": index, "_id": new_doc["_id"]})
+                return
+            for doc in docs:
+                result["nModified"] += int(self._update_doc(doc, request._doc)[1])
+            result["nMatched"] += len(docs)
+
+    async def drop(self):
+        self._command("drop")
+        self._docs.clear()
+        for index in self._indexes.values():
+            index["entries"].clear()
+            index["overflow"].clear()
@@ -0,0 +1,38 @@
+"""
+RideShare - Job Worker
+Runs background jobs outside the API process
+
+Usage: JOB_WORKERS=0 on the web process, then
+    python worker.py [--concurrency N]
+"""
+
+import argparse
+import asyncio
+import signal
+
+from server import storage, job_queue
+
+
+async def main(concurrency: int):
+    await storage.ping()
+    await storage.create_indexes()
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    job_queue.start(concurrency)
+    print(f"INFO: Job worker started with {concurrency} workers for {', '.join(sorted(job_queue.handlers))}")
+    await stop.wait()
+
+    print("INFO: Job worker stopping, waiting for running jobs")
+    await job_queue.stop()
+    storage.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="RideShare background job worker")
+    parser.add_argument("--concurrency", type=int, default=4, help="Jobs run concurrently")
+    args = parser.parse_args()
+    asyncio.run(main(args.concurrency))
@@ -4,16 +4,55 @@ RideShare Backend API Testing Suite
 Tests all backend APIs for the carpooling application
 """
 
+import gzip
+import os
 import requests
 import json
+import re
 import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 from typing import Dict, Any, Optional
 
+# Max Mongo round trips per request, including the auth user lookup. Checked
+# whenever the server reports X-DB-Round-Trips (DB_STATS_HEADER=true).
+DB_ROUND_TRIP_BUDGETS = [
+    ("POST", r"/auth/send-otp", 1),
+    ("POST", r"/auth/verify-otp", 4),
+    ("PUT", r"/users/profile", 3),
+    ("POST", r"/rides", 2),
+    ("PUT", r"/rides/[^/]+", 2),
+    ("GET", r"/rides/dashboard", 2),
+    ("GET", r"/places/autocomplete\?.*", 0),
+    ("GET", r"/rides/popular-routes", 1),
+    ("POST", r"/rides/[^/]+/location", 1),
+    ("GET", r"/rides/[^/]+/location", 2),
+    ("POST", r"/bookings", 4),
+    ("PUT", r"/bookings/[^/]+/status", 4),
+    ("POST", r"/bookings/bulk-status", 4),
+    ("POST", r"/private-requests", 2),
+    ("POST", r"/private-requests/[^/]+/respond", 4),
+    ("POST", r"/chats/message", 3),
+    ("POST", r"/reviews", 6),
+    ("GET", r"/reviews/user/[^/]+", 1),
+]
+# Claiming an Idempotency-Key costs one more (the record is completed after the response starts)
+IDEMPOTENCY_KEY_ROUND_TRIPS = 1
+
 class RideShareAPITester:
-    def __init__(self, base_url: str):
+    def __init__(self, base_url: str, http=None, otp_lookup=None, server=None, run=None):
         self.base_url = base_url.rstrip('/')
         self.api_url = f"{self.base_url}/api"
+        # HTTP client with the requests API (requests itself or a TestClient)
+        self.http = http or requests
+        # Reads the OTP from storage when the server does not return it
+        self.otp_lookup = otp_lookup
+        # In-process only: the server module and a runner for coroutines on its event loop
+        self.server = server
+        self.run = run
+        # Enables the /api/admin checks
+        self.admin_token = os.getenv("ADMIN_TOKEN")
+        self.round_trip_violations = []
         self.driver_token = None
         self.passenger_token = None
         self.driver_user = None
@@ -30,27 +69,30 @@ class RideShareAPITester:
         print(f"📍 Base URL: {self.base_url}")
         print(f"🔗 API URL: {self.api_url}")
     
-    def make_request(self, method: str, endpoint: str, data: Dict = None, token: str = None) -> Dict[str, Any]:
+    def make_request(self, method: str, endpoint: str, data: Dict = None, token: str = None,
+                     extra_headers: Dict = None) -> Dict[str, Any]:
         """Make HTTP request with proper error handling"""
         url = f"{self.api_url}{endpoint}"
-        headers = {"Content-Type": "application/json"}
+        headers = {"Content-Type": "application/json", **(extra_headers or {})}
         
         if token:
             headers["Authorization"] = f"Bearer {token}"
         
         try:
             if method.upper() == "GET":
-                response = requests.get(url, headers=headers, timeout=30)
+                response = self.http.get(url, headers=headers, timeout=30)
             elif method.upper() == "POST":
-                response = requests.post(url, json=data, headers=headers, timeout=30)
+                response = self.http.post(url, json=data, headers=headers, timeout=30)
             elif method.upper() == "PUT":
-                response = requests.put(url, json=data, headers=headers, timeout=30)
+                response = self.http.put(url, json=data, headers=headers, timeout=30)
             elif method.upper() == "DELETE":
-                response = requests.delete(url, headers=headers, timeout=30)
+                response = self.http.delete(url, headers=headers, timeout=30)
             else:
                 raise ValueError(f"Unsupported method: {method}")
             
             print(f"📡 {method.upper()} {endpoint} -> {response.status_code}")
+            self.check_round_trips(method.upper(), endpoint, response,
+                                   keyed="Idempotency-Key" in (extra_headers or {}))
             
             if response.status_code >= 400:
                 print(f"❌ Error Response: {response.text}")
@@ -58,6 +100,7 @@ class RideShareAPITester:
             return {
                 "status_code": response.status_code,
                 "data": response.json() if response.content else {},
+                "headers": response.headers,
                 "success": 200 <= response.status_code < 300
             }
         except requests.exceptions.RequestException as e:
@@ -75,6 +118,28 @@ class RideShareAPITester:
                 "success": False
             }
     
+    def check_round_trips(self, method: str, endpoint: str, response, keyed: bool = False):
+        """Record requests that exceed their DB round-trip budget"""
+        round_trips = response.headers.get("x-db-round-trips")
+        if round_trips is None or response.status_code >= 400:
+            return
+        for budget_method, pattern, budget in DB_ROUND_TRIP_BUDGETS:
+            if budget_method == method and re.fullmatch(pattern, endpoint):
+                budget += IDEMPOTENCY_KEY_ROUND_TRIPS if keyed else 0
+                if int(round_trips) > budget:
+                    self.round_trip_violations.append(f"{method} {endpoint}: {round_trips} > {budget}")
+                    print(f"❌ {method} {endpoint} used {round_trips} DB round trips (budget {budget})")
+                return
+    
+    def test_db_round_trips(self) -> bool:
+        """Check that no request exceeded its DB round-trip budget"""
+        print("\n🔁 Checking DB Round-Trip Budgets...")
+        if self.round_trip_violations:
+            print(f"❌ {len(self.round_trip_violations)} requests over budget")
+            return False
+        print("✅ All requests within their DB round-trip budgets")
+        return True
+    
     def test_health_check(self) -> bool:
         """Test health check endpoint"""
         print("\n🏥 Testing Health Check...")
@@ -95,6 +160,8 @@ class RideShareAPITester:
         
         if result["success"]:
             otp = result["data"].get("debug_otp")
+            if not otp and self.otp_lookup:
+                otp = self.otp_lookup(phone)
             print(f"✅ OTP sent successfully. Debug OTP: {otp}")
             return otp
         else:
@@ -235,6 +302,18 @@ class RideShareAPITester:
             print("❌ Failed to get specific ride")
             return False
         
+        # Polling with the ETag gets a 304 until the ride changes
+        etag = result["headers"].get("etag")
+        result = self.make_request(
+            "GET", f"/rides/{ride_id}", token=self.passenger_token, extra_headers={"If-None-Match": etag}
+        )
+        if not etag or result["status_code"] != 304:
+            print(f"❌ Conditional GET of an unchanged ride returned {result['status_code']}")
+            return False
+        if result["headers"].get("x-db-round-trips") not in (None, "0"):
+            print("❌ Conditional GET of an unchanged ride read the database")
+            return False
+        
         # Update ride
         update_data = {"available_seats": 2, "price_per_seat": 30.0}
         result = self.make_request("PUT", f"/rides/{ride_id}", update_data, token=self.driver_token)
@@ -242,9 +321,78 @@ class RideShareAPITester:
             print("❌ Failed to update ride")
             return False
         
+        result = self.make_request(
+            "GET", f"/rides/{ride_id}", token=self.passenger_token, extra_headers={"If-None-Match": etag}
+        )
+        if result["status_code"] != 200 or result["headers"].get("etag") == etag:
+            print("❌ Conditional GET did not see the ride update")
+            return False
+        
         print("✅ Ride operations completed")
         return True
     
+    def test_ride_import(self) -> bool:
+        """Test streamed NDJSON and CSV ride imports with bad and oversized rows"""
+        print("\n📥 Testing Ride Import...")
+        
+        tomorrow = (datetime.now() + timedelta(days=1)).strftime("%Y-%m-%d")
+        ride = {
+            "pickup_location": "North Depot", "pickup_lat": 40.85, "pickup_lng": -73.90,
+            "drop_location": "South Pier", "drop_lat": 40.60, "drop_lng": -74.02,
+            "date": tomorrow, "time": "07:15", "available_seats": 2, "price_per_seat": 6.0,
+        }
+        bad = {**ride, "available_seats": 0}
+        oversized = {**ride, "notes": "x" * 70000}  # Over the 64 KiB line limit
+        columns = list(ride) + ["notes"]
+        
+        def csv_row(row):
+            return ",".join(str(row.get(column, "")) for column in columns)
+        bodies = {
+            "ndjson": "\n".join(json.dumps(row) for row in (ride, bad, oversized, ride)) + "\n",
+            "csv": "\n".join([",".join(columns)] + [csv_row(row) for row in (ride, bad, oversized, ride)]) + "\n",
+        }
+        # Line numbers of the bad and oversized rows (the CSV header is line 1)
+        error_lines = {"ndjson": [2, 3], "csv": [3, 4]}
+        
+        headers = {"Authorization": f"Bearer {self.driver_token}"}
+        reports = []
+        for fmt, body in bodies.items():
+            for ordered in (False, True):
+                endpoint = f"/rides/import?format={fmt}&ordered={str(ordered).lower()}"
+                response = self.http.post(f"{self.api_url}{endpoint}", data=body.encode(), headers=headers, timeout=30)
+                print(f"📡 POST {endpoint} -> {response.status_code}")
+                if response.status_code != 200:
+                    print(f"❌ Import failed: {response.text}")
+                    return False
+                report = response.json()
+                reports.append(report)
+                # Unordered imports skip bad rows; ordered ones stop at the first
+                expected = {
+                    "rows": 4 if not ordered else 2,
+                    "inserted": 2 if not ordered else 1,
+                    "failed": 2 if not ordered else 1,
+                    "completed": not ordered,
+                    "error_lines": error_lines[fmt] if not ordered else error_lines[fmt][:1],
+                }
+                actual = {key: report.get(key) for key in expected}
+                actual["error_lines"] = [error["line"] for error in report["errors"]]
+                if actual != expected:
+                    print(f"❌ {fmt} import (ordered={ordered}) reported {actual}, expected {expected}")
+                    return False
+        if "available_seats" not in reports[0]["errors"][0]["error"] or \
+                "longer than" not in reports[0]["errors"][1]["error"]:
+            print(f"❌ Unexpected error messages: {reports[0]['errors']}")
+            return False
+        
+        result = self.make_request("GET", "/rides/my-rides", token=self.driver_token)
+        import_ids = [r.get("import_id") for r in result["data"]] if result["success"] else []
+        if [import_ids.count(report["import_id"]) for report in reports] != [r["inserted"] for r in reports]:
+            print("❌ Imported rides do not match the reported inserted counts")
+            return False
+        
+        print(f"✅ Ride import completed. Inserted {sum(r['inserted'] for r in reports)} rides")
+        return True
+    
     def test_ride_search(self) -> bool:
         """Test ride search functionality"""
         print("\n🔍 Testing Ride Search...")
@@ -260,13 +408,47 @@ class RideShareAPITester:
         }
         
         result = self.make_request("POST", "/rides/search", search_data, token=self.passenger_token)
-        if result["success"]:
-            rides = result["data"]
-            print(f"✅ Search completed. Found {len(rides)} rides")
-            return True
-        else:
+        if not result["success"]:
             print("❌ Failed to search rides")
             return False
+        rides = result["data"]
+        
+        # Places are suggested by prefix once a second user enters them, at rounded coordinates
+        result = self.make_request("GET", "/places/autocomplete?q=airport%20ter", token=self.passenger_token)
+        if not result["success"] or "Airport Terminal" in [p["name"] for p in result["data"]]:
+            print("❌ Autocomplete suggested a place only one user has entered")
+            return False
+        request_data = {
+            "from_location": "Harbor View",
+            "from_lat": 40.7011,
+            "from_lng": -74.0122,
+            "to_location": "airport terminal",
+            "to_lat": 40.6893,
+            "to_lng": -74.1744,
+            "preferred_date": tomorrow,
+            "preferred_time": "09:00",
+            "seats_needed": 1
+        }
+        if not self.make_request("POST", "/private-requests", request_data, token=self.passenger_token)["success"]:
+            print("❌ Failed to create private request")
+            return False
+        result = self.make_request("GET", "/places/autocomplete?q=airport%20ter", token=self.passenger_token)
+        places = [(p["name"], p["lat"], p["lng"]) for p in result["data"]] if result["success"] else []
+        if ("Airport Terminal", 40.69, -74.17) not in places or any(p[0] == "Harbor View" for p in places):
+            print(f"❌ Autocomplete did not suggest the shared place alone: {places}")
+            return False
+        result = self.make_request("GET", "/places/autocomplete?q=harbor", token=self.passenger_token)
+        if not result["success"] or result["data"]:
+            print("❌ Autocomplete suggested a private request's address")
+            return False
+        
+        result = self.make_request("GET", "/rides/popular-routes", token=self.passenger_token)
+        if not result["success"]:
+            print("❌ Failed to get popular routes")
+            return False
+        
+        print(f"✅ Search completed. Found {len(rides)} rides")
+        return True
     
     def test_booking_operations(self) -> bool:
         """Test booking CRUD operations"""
@@ -303,6 +485,17 @@ class RideShareAPITester:
             print("❌ Failed to get booking requests")
             return False
         
+        # Driver dashboard shows the ride with the pending booking
+        result = self.make_request("GET", "/rides/dashboard", token=self.driver_token)
+        if not result["success"]:
+            print("❌ Failed to get driver dashboard")
+            return False
+        ride = next((r for r in result["data"]["rides"] if r["id"] == self.test_ride["id"]), None)
+        if not ride or ride["booking_counts"].get("pending") != 1 \
+                or [b["id"] for b in ride["pending_bookings"]] != [self.test_booking["id"]]:
+            print(f"❌ Dashboard does not show the pending booking: {ride}")
+            return False
+        
         # Accept booking
         booking_id = self.test_booking["id"]
         status_data = {"status": "accepted"}
@@ -314,6 +507,291 @@ class RideShareAPITester:
         print("✅ Booking operations completed")
         return True
     
+    def test_live_location(self) -> bool:
+        """Test sharing the driver's live location with an accepted passenger"""
+        print("\n📍 Testing Live Location...")
+        
+        ride_id = self.test_ride["id"]
+        points = {"points": [{"lat": 37.78, "lng": -122.41, "ts": time.time() - 1}, {"lat": 37.79, "lng": -122.40}]}
+        result = self.make_request("POST", f"/rides/{ride_id}/location", points, token=self.passenger_token)
+        if result["status_code"] != 403:
+            print("❌ A passenger could publish the ride's location")
+            return False
+        result = self.make_request("POST", f"/rides/{ride_id}/location", points, token=self.driver_token)
+        if not result["success"] or result["data"]["accepted"] != 2:
+            print(f"❌ Failed to publish location: {result['data']}")
+            return False
+        
+        # The passenger's booking was accepted, so they see the newest position
+        result = self.make_request("GET", f"/rides/{ride_id}/location", token=self.passenger_token)
+        if not result["success"] or (result["data"]["lat"], result["data"]["lng"]) != (37.79, -122.40):
+            print(f"❌ Passenger did not get the latest location: {result['data']}")
+            return False
+        
+        print("✅ Live location completed")
+        return True
+    
+    def test_bulk_booking_status(self) -> bool:
+        """Test bulk booking status updates"""
+        print("\n📦 Testing Bulk Booking Status...")
+        
+        # A second ride with a booking to accept in bulk
+        saved_ride = self.test_ride
+        if not self.test_create_ride():
+            return False
+        ride, self.test_ride = self.test_ride, saved_ride
+        
+        result = self.make_request("POST", "/bookings", {"ride_id": ride["id"], "seats": 2}, token=self.passenger_token)
+        if not result["success"]:
+            print("❌ Failed to create booking")
+            return False
+        booking_id = result["data"]["id"]
+        
+        updates = [
+            {"booking_id": booking_id, "status": "accepted"},
+            {"booking_id": booking_id, "status": "rejected"},
+            {"booking_id": "0" * 24, "status": "accepted"},
+        ]
+        result = self.make_request("POST", "/bookings/bulk-status", {"updates": updates}, token=self.driver_token)
+        if not result["success"]:
+            print("❌ Failed to update bookings in bulk")
+            return False
+        
+        outcome = [(r["success"], r.get("status_code")) for r in result["data"]["results"]]
+        if outcome != [(True, None), (False, 400), (False, 404)]:
+            print(f"❌ Unexpected bulk results: {result['data']['results']}")
+            return False
+        
+        result = self.make_request("GET", f"/rides/{ride['id']}", token=self.driver_token)
+        if not result["success"] or result["data"]["booked_seats"] != 2:
+            print("❌ Seats were not reserved by the bulk update")
+            return False
+        
+        print("✅ Bulk booking status completed")
+        return True
+    
+    def test_multi_stop_bookings(self) -> bool:
+        """Test per-segment seats on a multi-stop ride under concurrent acceptances"""
+        print("\n🛣️ Testing Multi-Stop Bookings...")
+        
+        # A -> B -> C -> D with 2 seats
+        ride_data = {
+            "pickup_location": "Stop A", "pickup_lat": 40.70, "pickup_lng": -74.00,
+            "drop_location": "Stop D", "drop_lat": 40.40, "drop_lng": -74.30,
+            "stops": [
+                {"location": "Stop B", "lat": 40.60, "lng": -74.10},
+                {"location": "Stop C", "lat": 40.50, "lng": -74.20},
+            ],
+            "date": (datetime.now() + timedelta(days=2)).strftime("%Y-%m-%d"),
+            "time": "08:00",
+            "available_seats": 2,
+            "price_per_seat": 10.0,
+        }
+        result = self.make_request("POST", "/rides", ride_data, token=self.driver_token)
+        if not result["success"] or result["data"].get("segment_seats") != [0, 0, 0]:
+            print("❌ Failed to create multi-stop ride")
+            return False
+        ride_id = result["data"]["id"]
+        
+        # One passenger per leg: A-C, B-D and B-C compete for segment B-C; A-B fits regardless
+        legs = [(0, 2), (1, 3), (1, 2), (0, 1)]
+        bookings = []
+        for n, (from_stop, to_stop) in enumerate(legs):
+            phone = f"+155500020{n}"
+            auth = self.test_verify_otp(phone, self.test_send_otp(phone))
+            if not auth:
+                return False
+            booking_data = {"ride_id": ride_id, "seats": 1, "from_stop": from_stop, "to_stop": to_stop}
+            result = self.make_request("POST", "/bookings", booking_data, token=auth["token"])
+            if not result["success"]:
+                print(f"❌ Failed to book stops {from_stop}-{to_stop}")
+                return False
+            bookings.append(result["data"])
+        
+        # Accept all of them at once
+        def accept(booking):
+            return self.make_request(
+                "PUT", f"/bookings/{booking['id']}/status", {"status": "accepted"}, token=self.driver_token
+            )
+        with ThreadPoolExecutor(max_workers=len(bookings)) as pool:
+            outcomes = list(pool.map(accept, bookings))
+        accepted = [legs[i] for i, outcome in enumerate(outcomes) if outcome["success"]]
+        
+        result = self.make_request("GET", f"/rides/{ride_id}", token=self.driver_token)
+        occupancy = [0, 0, 0]
+        for from_stop, to_stop in accepted:
+            for segment in range(from_stop, to_stop):
+                occupancy[segment] += 1
+        ride = result["data"]
+        if (0, 1) not in accepted or occupancy[1] != 2 or ride["segment_seats"] != occupancy \
+                or ride["booked_seats"] != max(occupancy):
+            print(f"❌ Segment seats inconsistent: accepted {accepted}, ride {ride['segment_seats']}")
+            return False
+        
+        # Search from B to C finds the ride full on that leg only when asking for a seat
+        search_data = {"pickup_lat": 40.60, "pickup_lng": -74.10, "drop_lat": 40.50, "drop_lng": -74.20,
+                       "date": ride_data["date"], "seats_needed": 1}
+        result = self.make_request("POST", "/rides/search", search_data, token=self.passenger_token)
+        if not result["success"] or any(r["id"] == ride_id for r in result["data"]):
+            print("❌ Search returned a ride whose leg is full")
+            return False
+        search_data.update({"pickup_lat": 40.50, "pickup_lng": -74.20, "drop_lat": 40.40, "drop_lng": -74.30})
+        result = self.make_request("POST", "/rides/search", search_data, token=self.passenger_token)
+        match = next((r for r in result["data"] if r["id"] == ride_id), None) if result["success"] else None
+        if not match or (match["from_stop"], match["to_stop"]) != (2, 3):
+            print("❌ Search did not offer the free C-D leg")
+            return False
+        
+        print(f"✅ Multi-stop bookings completed. Accepted legs {accepted}, segment seats {occupancy}")
+        return True
+    
+    def wait_for(self, check, timeout: float = 10.0):
+        """Poll check() until it returns something truthy (background jobs and the event relay)"""
+        deadline = time.time() + timeout
+        while True:
+            value = check()
+            if value or time.time() > deadline:
+                return value
+            time.sleep(0.5)
+    
+    def settled_stats(self) -> Optional[Dict]:
+        """Admin stats totals once every event so far has been rolled up (None without ADMIN_TOKEN)"""
+        if not self.admin_token:
+            return None
+        admin = {"X-Admin-Token": self.admin_token}
+        
+        def settled():
+            result = self.make_request("GET", "/admin/metrics", extra_headers=admin)
+            events = result["data"].get("events", {})
+            return events.get("pending_outbox") == 0 and events.get("sink_lag", {}).get("analytics") == 0
+        self.wait_for(settled)
+        result = self.make_request("GET", "/admin/stats?granularity=day", extra_headers=admin)
+        return result["data"]["totals"] if result["success"] else None
+    
+    def test_repeated_cancellation(self) -> bool:
+        """Test that cancelling a ride again counts one cancellation in the stats"""
+        print("\n🚫 Testing Repeated Ride Cancellation...")
+        
+        saved_ride = self.test_ride
+        if not self.test_create_ride():
+            return False
+        ride, self.test_ride = self.test_ride, saved_ride
+        before = self.settled_stats()
+        
+        for _ in range(2):
+            result = self.make_request("DELETE", f"/rides/{ride['id']}", token=self.driver_token)
+            if not result["success"]:
+                print("❌ Failed to cancel the ride")
+                return False
+        
+        after = self.settled_stats()
+        if before is not None and after["rides_cancelled"] - before["rides_cancelled"] != 1:
+            print(f"❌ Cancelling one ride twice counted {after['rides_cancelled'] - before['rides_cancelled']}")
+            return False
+        
+        print("✅ Repeated ride cancellation completed")
+        return True
+    
+    def test_ride_series(self) -> bool:
+        """Test recurring rides: scheduled occurrences and cancelling the series"""
+        print("\n🔁 Testing Ride Series...")
+        
+        start = (datetime.now() + timedelta(days=1)).date()
+        before = self.settled_stats()
+        series_data = {
+            "pickup_location": "Suburb Park & Ride",
+            "pickup_lat": 40.80,
+            "pickup_lng": -73.95,
+            "drop_location": "Office District",
+            "drop_lat": 40.75,
+            "drop_lng": -73.98,
+            "weekdays": list(range(7)),
+            "start_date": start.isoformat(),
+            "end_date": (start + timedelta(days=6)).isoformat(),
+            "time": "08:00",
+            "available_seats": 3,
+            "price_per_seat": 8.0
+        }
+        result = self.make_request("POST", "/ride-series", series_data, token=self.driver_token)
+        if not result["success"] or result["data"]["occurrences_created"] != 7:
+            print(f"❌ Failed to create ride series: {result['data']}")
+            return False
+        series_id = result["data"]["id"]
+        
+        if self.server is not None:
+            # A scheduler pass that starts over does not create occurrences twice
+            from bson import ObjectId
+            self.run(self.server.ride_series_collection.update_one,
+                     {"_id": ObjectId(series_id)}, {"$set": {"materialized_until": start.isoformat()}})
+            created = self.run(self.server.ride_series_scheduler.materialize_due)
+            if created:
+                print(f"❌ Scheduler created {created} duplicate occurrences")
+                return False
+        
+        result = self.make_request("GET", "/rides/my-rides", token=self.driver_token)
+        occurrences = [r for r in result["data"] if r.get("series_id") == series_id] if result["success"] else []
+        if sorted(r["date"] for r in occurrences) != [(start + timedelta(days=i)).isoformat() for i in range(7)]:
+            print(f"❌ Expected one occurrence per day, got {sorted(r['date'] for r in occurrences)}")
+            return False
+        ride_id = occurrences[0]["id"]
+        
+        result = self.make_request("GET", f"/rides/{ride_id}", token=self.passenger_token)
+        etag = result["headers"].get("etag")
+        result = self.make_request("POST", "/bookings", {"ride_id": ride_id, "seats": 1}, token=self.passenger_token)
+        if not result["success"]:
+            print("❌ Failed to book an occurrence")
+            return False
+        booking_id = result["data"]["id"]
+        
+        # Cancelling the series cancels every upcoming occurrence and its pending bookings
+        result = self.make_request("DELETE", f"/ride-series/{series_id}", token=self.driver_token)
+        if not result["success"] or result["data"]["rides_cancelled"] != 7:
+            print(f"❌ Failed to cancel the series: {result['data']}")
+            return False
+        result = self.make_request("DELETE", f"/ride-series/{series_id}", token=self.driver_token)
+        if result["status_code"] != 400:
+            print(f"❌ Cancelling a cancelled series returned {result['status_code']}")
+            return False
+        result = self.make_request(
+            "GET", f"/rides/{ride_id}", token=self.passenger_token, extra_headers={"If-None-Match": etag}
+        )
+        if result["status_code"] != 200 or result["data"]["status"] != "cancelled":
+            print(f"❌ Polling the occurrence did not see the cancellation: {result['status_code']}")
+            return False
+        
+        def booking_cancelled():
+            result = self.make_request("GET", "/bookings", token=self.passenger_token)
+            return any(b["id"] == booking_id and b["status"] == "cancelled" for b in result["data"])
+        if not self.wait_for(booking_cancelled):
+            print("❌ The occurrence's pending booking was not cancelled")
+            return False
+        
+        if self.server is not None:
+            # One ride.cancelled event per occurrence reaches the feed
+            ride_ids = {r["id"] for r in occurrences}
+            
+            def cancellations():
+                events = self.run(self.server.event_stream.read, 0, 10000, ["ride.cancelled"])
+                found = [e for e in events if e["data"]["ride_id"] in ride_ids]
+                return found if len(found) >= len(ride_ids) else None
+            events = self.wait_for(cancellations) or []
+            if len(events) != 7:
+                print(f"❌ Expected 7 ride.cancelled events, found {len(events)}")
+                return False
+        
+        # The rollups count every occurrence and the booking, posted and cancelled
+        after = self.settled_stats()
+        if before is not None:
+            expected = {"rides_posted": 7, "seats_offered": 21, "rides_cancelled": 7,
+                        "bookings_requested": 1, "bookings_cancelled": 1}
+            changes = {counter: (after or {}).get(counter, 0) - before[counter] for counter in expected}
+            if changes != expected:
+                print(f"❌ Stats changed by {changes}, expected {expected}")
+                return False
+        
+        print("✅ Ride series completed")
+        return True
+    
     def test_private_requests(self) -> bool:
         """Test private request operations"""
         print("\n🔒 Testing Private Request Operations...")
@@ -381,11 +859,25 @@ class RideShareAPITester:
             "booking_id": self.test_booking["id"]
         }
         
-        result = self.make_request("POST", "/chats/message", message_data, token=self.passenger_token)
+        key = {"Idempotency-Key": f"chat-{time.time_ns()}"}
+        result = self.make_request("POST", "/chats/message", message_data, token=self.passenger_token,
+                                   extra_headers=key)
         if not result["success"]:
             print("❌ Failed to send message from passenger")
             return False
         
+        # A retry with the same key gets the original response instead of a duplicate
+        retry = self.make_request("POST", "/chats/message", message_data, token=self.passenger_token,
+                                  extra_headers=key)
+        if retry["data"].get("id") != result["data"]["id"] or retry["headers"].get("idempotent-replayed") != "true":
+            print(f"❌ Retried message was not answered from the stored response: {retry}")
+            return False
+        reused = self.make_request("POST", "/chats/message", {**message_data, "content": "Changed"},
+                                   token=self.passenger_token, extra_headers=key)
+        if reused["status_code"] != 422:
+            print(f"❌ Reusing an Idempotency-Key for another message returned {reused['status_code']}")
+            return False
+        
         # Send reply from driver
         reply_data = {
             "content": "Great! I'll pick you up on time.",
@@ -405,6 +897,9 @@ class RideShareAPITester:
             return False
         
         messages = result["data"]
+        if len(messages) != 2:
+            print(f"❌ Expected 2 messages, got {len(messages)}")
+            return False
         print(f"✅ Chat operations completed. {len(messages)} messages exchanged")
         return True
     
@@ -455,9 +950,125 @@ class RideShareAPITester:
             return False
         
         reviews = result["data"]
+        result = self.make_request("GET", f"/reviews/user/{driver_id}", token=self.passenger_token,
+                                   extra_headers={"If-None-Match": result["headers"].get("etag")})
+        if result["status_code"] != 304:
+            print(f"❌ Conditional GET of unchanged reviews returned {result['status_code']}")
+            return False
         print(f"✅ Review operations completed. {len(reviews)} reviews found")
         return True
     
+    def test_data_export(self) -> bool:
+        """Test the streamed NDJSON data export"""
+        print("\n📦 Testing Data Export...")
+        
+        headers = {"Authorization": f"Bearer {self.passenger_token}"}
+        response = self.http.get(f"{self.api_url}/users/export", headers=headers, timeout=30)
+        print(f"📡 GET /users/export -> {response.status_code}")
+        if response.status_code != 200:
+            print(f"❌ Failed to export user data: {response.text}")
+            return False
+        
+        lines = [json.loads(line) for line in response.text.splitlines() if line]
+        types = {line["type"] for line in lines}
+        if not lines or lines[0]["type"] != "profile" or not {"booking", "chat", "review"} <= types:
+            print(f"❌ Export is missing sections: {sorted(types)}")
+            return False
+        if lines[0]["data"]["id"] != self.passenger_user["id"]:
+            print(f"❌ Export profile is not the requesting user's: {lines[0]['data']}")
+            return False
+        
+        response = self.http.get(f"{self.api_url}/users/export?gzip=true", headers=headers, timeout=30)
+        if response.status_code != 200 or gzip.decompress(response.content).decode() == "":
+            print("❌ Failed to export user data with gzip")
+            return False
+        
+        print(f"✅ Data export completed. {len(lines)} records exported")
+        return True
+    
+    def test_archival(self) -> bool:
+        """Test moving a past ride with its booking and chat to the archives"""
+        print("\n🗄️ Testing Archival...")
+        if self.needs_server():
+            return True
+        from bson import ObjectId
+        server = self.server
+        
+        saved_ride = self.test_ride
+        if not self.test_create_ride():
+            return False
+        ride, self.test_ride = self.test_ride, saved_ride
+        result = self.make_request("POST", "/bookings", {"ride_id": ride["id"], "seats": 1}, token=self.passenger_token)
+        if not result["success"]:
+            print("❌ Failed to create booking")
+            return False
+        booking_id = result["data"]["id"]
+        message = {"content": "See you at the station", "booking_id": booking_id}
+        if not self.make_request("POST", "/chats/message", message, token=self.passenger_token)["success"]:
+            print("❌ Failed to send message")
+            return False
+        
+        # Date the ride (and its booking) past the retention once their events are relayed
+        past = (datetime.utcnow() - timedelta(days=server.ARCHIVE_AFTER_DAYS + 1)).strftime("%Y-%m-%d")
+        ride_query, booking_query = {"_id": ObjectId(ride["id"])}, {"_id": ObjectId(booking_id)}
+        for collection, query in ((server.rides_collection, ride_query), (server.bookings_collection, booking_query)):
+            self.run(collection.update_one, query, {"$set": {"date": past}})
+        
+        def relayed():
+            return not any(
+                self.run(collection.count_documents, {**query, "_outbox_at": {"$exists": True}})
+                for collection, query in (
+                    (server.rides_collection, ride_query),
+                    (server.bookings_collection, booking_query),
+                    (server.chats_collection, {"booking_id": booking_id}),
+                )
+            )
+        if not self.wait_for(relayed):
+            print("❌ Outbox events were not relayed")
+            return False
+        etag = self.make_request("GET", f"/rides/{ride['id']}", token=self.passenger_token)["headers"].get("etag")
+        
+        job_id = self.run(server.job_queue.enqueue, "archival")
+        job = self.wait_for(lambda: (lambda j: j if j["status"] in ("completed", "dead") else None)(
+            self.run(server.job_queue.get, job_id)
+        ))
+        if not job or job["status"] != "completed":
+            print(f"❌ Archival job did not complete: {job}")
+            return False
+        if self.run(server.rides_collection.find_one, ride_query) or \
+                self.run(server.bookings_collection.find_one, booking_query) or \
+                self.run(server.chats_collection.find_one, {"booking_id": booking_id}):
+            print("❌ Archived documents are still in the hot collections")
+            return False
+        
+        # Reads fall back to the archives, also for the ETag of a ride this worker has not cached
+        server.etag_cache.invalidate(("ride", ride["id"]))
+        result = self.make_request(
+            "GET", f"/rides/{ride['id']}", token=self.passenger_token, extra_headers={"If-None-Match": etag}
+        )
+        if result["status_code"] != 304:
+            print(f"❌ Conditional GET of an archived ride returned {result['status_code']}")
+            return False
+        result = self.make_request("GET", f"/rides/{ride['id']}", token=self.passenger_token)
+        if not result["success"] or result["data"]["date"] != past:
+            print("❌ Failed to get an archived ride")
+            return False
+        result = self.make_request("GET", "/rides/my-rides", token=self.driver_token)
+        if not any(r["id"] == ride["id"] for r in result["data"]):
+            print("❌ Archived ride missing from my rides")
+            return False
+        result = self.make_request("GET", "/bookings", token=self.passenger_token)
+        if not any(b["id"] == booking_id for b in result["data"]):
+            print("❌ Archived booking missing from my bookings")
+            return False
+        result = self.make_request("GET", f"/chats/booking/{booking_id}", token=self.passenger_token)
+        if [m["content"] for m in result["data"]] != [message["content"]]:
+            print(f"❌ Archived chat not returned: {result['data']}")
+            return False
+        
+        print(f"✅ Archival completed. Moved {job['state'].get('moved')}")
+        return True
+    
     def test_user_deletion(self) -> bool:
         """Test user account deletion"""
         print("\n🗑️ Testing User Account Deletion...")
@@ -472,14 +1083,223 @@ class RideShareAPITester:
         if not temp_auth:
             return False
         
+        # A booking whose events may not be relayed yet when the cascade reaches it
+        booking_id = None
+        if self.server is not None:
+            saved_ride = self.test_ride
+            if not self.test_create_ride():
+                return False
+            ride, self.test_ride = self.test_ride, saved_ride
+            result = self.make_request("POST", "/bookings", {"ride_id": ride["id"], "seats": 1}, token=temp_auth["token"])
+            if not result["success"]:
+                print("❌ Failed to create booking")
+                return False
+            booking_id = result["data"]["id"]
+        
         # Delete the temporary account
         result = self.make_request("DELETE", "/users/account", token=temp_auth["token"])
-        if result["success"]:
-            print("✅ User account deletion completed")
-            return True
-        else:
+        if not result["success"]:
             print("❌ Failed to delete user account")
             return False
+        
+        if booking_id:
+            from bson import ObjectId
+            server = self.server
+            job_id = result["data"]["deletion_job_id"]
+            job = self.wait_for(lambda: (lambda j: j if j["status"] in ("completed", "dead") else None)(
+                self.run(server.job_queue.get, job_id)
+            ), timeout=30)
+            if not job or job["status"] != "completed":
+                print(f"❌ Account deletion job did not complete: {job}")
+                return False
+            if self.run(server.bookings_collection.find_one, {"_id": ObjectId(booking_id)}):
+                print("❌ The deleted user's booking is still there")
+                return False
+            cancelled = self.run(server.event_stream.events.count_documents, {
+                "type": "booking.status_changed", "data.booking_id": booking_id, "data.to_status": "cancelled",
+            })
+            if cancelled != 1:
+                print(f"❌ {cancelled} cancellation events relayed for the deleted booking instead of 1")
+                return False
+        
+        print("✅ User account deletion completed")
+        return True
+    
+    def needs_server(self) -> bool:
+        """Whether a test of server internals must be skipped (not running in-process)"""
+        if self.server is None:
+            print("⏭️ Skipped: needs --in-process")
+            return True
+        return False
+    
+    def test_admission_control(self) -> bool:
+        """Test load shedding: 503 and 429 with Retry-After, critical routes at the cap, adaptive caps"""
+        print("\n🚦 Testing Admission Control...")
+        if self.needs_server():
+            return True
+        from admission import AdmissionController, TokenBuckets, CRITICAL, NORMAL, LOW
+        admission = self.server.admission
+        
+        # Normal and low classes at their caps are shed; critical routes still pass
+        saturation = {cls: admission.max_inflight[cls] for cls in (NORMAL, LOW)}
+        for cls, extra in saturation.items():
+            admission.inflight[cls] += extra
+        try:
+            shed = self.make_request("GET", "/rides", token=self.passenger_token)
+            health = self.make_request("GET", "/health")
+            profile = self.make_request("GET", "/users/profile", token=self.passenger_token)
+        finally:
+            for cls, extra in saturation.items():
+                admission.inflight[cls] -= extra
+        if shed["status_code"] != 503 or shed["headers"].get("retry-after") != str(admission.retry_after):
+            print(f"❌ A low-priority request over the cap got {shed['status_code']} {dict(shed['headers'])}")
+            return False
+        if not health["success"] or not profile["success"]:
+            print("❌ Critical routes were shed with the other classes at their caps")
+            return False
+        
+        # An empty per-user bucket gives 429 with the time until the next token
+        buckets, admission.buckets = admission.buckets, TokenBuckets(rate=0.5, burst=1)
+        try:
+            first = self.make_request("GET", "/rides", token=self.passenger_token)
+            throttled = self.make_request("GET", "/rides", token=self.passenger_token)
+            other_user = self.make_request("GET", "/rides", token=self.driver_token)
+        finally:
+            admission.buckets = buckets
+        if not first["success"] or not other_user["success"]:
+            print("❌ A request with tokens left was throttled")
+            return False
+        if throttled["status_code"] != 429 or throttled["headers"].get("retry-after") != "2":
+            print(f"❌ A request over the user's rate got {throttled['status_code']} {dict(throttled['headers'])}")
+            return False
+        
+        # Caps are cut under event-loop lag and grow back one per healthy tick
+        controller = AdmissionController([], {CRITICAL: 10, NORMAL: 100, LOW: 50}, min_inflight=4,
+                                         interval=0.1, lag_target_ms=50)
+        self.run(controller.tick)
+        time.sleep(0.1 + 0.15)  # Lag of 150ms: over twice the target
+        self.run(controller.tick)
+        if controller.limits != {CRITICAL: 10, NORMAL: 70, LOW: 35}:
+            print(f"❌ Lag did not cut the caps: {controller.metrics()}")
+            return False
+        time.sleep(0.1)
+        self.run(controller.tick)
+        if controller.limits != {CRITICAL: 10, NORMAL: 71, LOW: 36}:
+            print(f"❌ Caps did not grow back once healthy: {controller.metrics()}")
+            return False
+        for _ in range(10):
+            time.sleep(0.1 + 0.15)
+            self.run(controller.tick)
+        if controller.limits[LOW] != 4 or controller.limits[CRITICAL] != 10:
+            print(f"❌ Caps left their bounds: {controller.metrics()}")
+            return False
+        
+        print("✅ Admission control completed")
+        return True
+    
+    def test_event_relay(self) -> bool:
+        """Test the outbox relay: feed order, lease loss and sequence gaps"""
+        print("\n📨 Testing Event Relay...")
+        if self.needs_server():
+            return True
+        from events import EventStream, new_event, with_event_doc
+        
+        class RecordingSink:
+            name = "test"
+            
+            def __init__(self):
+                self.events = []
+            
+            async def deliver(self, events):
+                self.events.extend(events)
+        
+        storage = self.server.storage
+        suffix = time.time_ns()
+        source = storage.collection(f"test_relay_source_{suffix}")
+        feed = storage.collection(f"test_relay_events_{suffix}")
+        state = storage.collection(f"test_relay_state_{suffix}")
+        
+        async def scenario() -> Optional[str]:
+            sink = RecordingSink()
+            stream = EventStream(feed, state, [source], batch_size=2)
+            stream.add_sink(sink)
+            for n in range(5):
+                await source.insert_one(with_event_doc({"_id": n}, new_event("test.created", {"n": n})))
+            await stream.run_once()
+            if [(e["seq"], e["data"]["n"]) for e in sink.events] != [(n + 1, n) for n in range(5)]:
+                return f"Sink got {[(e['seq'], e['data']['n']) for e in sink.events]}"
+            if await source.count_documents({"_outbox_at": {"$exists": True}}):
+                return "Relayed outboxes were not cleared"
+            
+            # Another process takes the lease only once it expires; the old holder then stops
+            rival = EventStream(feed, state, [source])
+            if await rival._acquire_lease():
+                return "A held lease was taken"
+            await state.update_one({"_id": "relay"}, {"$set": {"locked_until": datetime.utcnow()}})
+            if not await rival._acquire_lease():
+                return "An expired lease was not taken"
+            await source.insert_one(with_event_doc({"_id": 5}, new_event("test.created", {"n": 5})))
+            await stream.run_once()
+            if len(sink.events) != 5 or not await source.count_documents({"_outbox_at": {"$exists": True}}):
+                return "The old lease holder kept relaying"
+            
+            # A gap a stalled relay may still fill holds delivery back until it is old
+            rival.add_sink(sink)
+            await rival.relay()
+            now = datetime.utcnow()
+            await feed.insert_one({**new_event("test.late", {}), "seq": 8, "relayed_at": now, "expires_at": now})
+            await rival.dispatch()
+            if [e["seq"] for e in sink.events[5:]] != [6]:
+                return f"Delivered across a fresh gap: {[e['seq'] for e in sink.events]}"
+            await feed.update_one({"seq": 8}, {"$set": {"relayed_at": now - timedelta(hours=1)}})
+            await rival.dispatch()
+            if [e["seq"] for e in sink.events[5:]] != [6, 8]:
+                return f"An old gap held delivery back: {[e['seq'] for e in sink.events]}"
+            return None
+        
+        error = self.run(scenario)
+        if error:
+            print(f"❌ {error}")
+            return False
+        print("✅ Event relay completed")
+        return True
+    
+    def test_job_retries(self) -> bool:
+        """Test that a failing deduped job whose key was re-enqueued while it ran does not get stuck"""
+        print("\n🔁 Testing Job Retries...")
+        if self.needs_server():
+            return True
+        from jobs import JobQueue
+        from storage import INDEXES
+        
+        jobs = self.server.storage.collection(f"test_jobs_{time.time_ns()}")
+        queue = JobQueue(jobs, backoff_base=1)
+        
+        @queue.handler("flaky")
+        async def flaky(job):
+            # Triggered again while running: the new job is queued under the same key
+            await queue.enqueue("flaky", delay=60, dedupe_key="flaky")
+            raise RuntimeError("boom")
+        
+        async def scenario() -> Optional[str]:
+            for keys, options in INDEXES["jobs"]:
+                await jobs.create_index(keys, **options)
+            first = await queue.enqueue("flaky", dedupe_key="flaky")
+            await queue.run_one()
+            job = await queue.get(first)
+            if job["status"] != "superseded" or "boom" not in job.get("last_error", ""):
+                return f"The failed job was left {job['status']}"
+            queued = await jobs.count_documents({"dedupe_key": "flaky", "status": "queued"})
+            if queued != 1:
+                return f"{queued} jobs queued under the key instead of 1"
+            return None
+        
+        error = self.run(scenario)
+        if error:
+            print(f"❌ {error}")
+            return False
+        print("✅ Job retries completed")
+        return True
     
     def run_all_tests(self) -> Dict[str, bool]:
         """Run all API tests"""
@@ -503,9 +1323,15 @@ class RideShareAPITester:
         # Test rides
         results["rides_crud"] = self.test_rides_operations()
         results["ride_search"] = self.test_ride_search()
+        results["ride_import"] = self.test_ride_import()
         
         # Test bookings
         results["bookings"] = self.test_booking_operations()
+        results["live_location"] = self.test_live_location()
+        results["bulk_booking_status"] = self.test_bulk_booking_status()
+        results["multi_stop_bookings"] = self.test_multi_stop_bookings()
+        results["ride_series"] = self.test_ride_series()
+        results["repeated_cancellation"] = self.test_repeated_cancellation()
         
         # Test private requests
         results["private_requests"] = self.test_private_requests()
@@ -515,10 +1341,20 @@ class RideShareAPITester:
         
         # Test reviews
         results["reviews"] = self.test_reviews_operations()
+        results["data_export"] = self.test_data_export()
+        results["archival"] = self.test_archival()
         
         # Test user deletion
         results["user_deletion"] = self.test_user_deletion()
         
+        # Test server internals (in-process only)
+        results["admission_control"] = self.test_admission_control()
+        results["event_relay"] = self.test_event_relay()
+        results["job_retries"] = self.test_job_retries()
+        
+        # Check DB round trips of everything above
+        results["db_round_trips"] = self.test_db_round_trips()
+        
         return results
     
     def print_summary(self, results: Dict[str, bool]):
@@ -541,15 +1377,43 @@ class RideShareAPITester:
         else:
             print("⚠️ Some tests failed - check logs above")
 
-def main():
-    """Main test runner"""
-    # Get backend URL from environment or use default
+def in_process_tester() -> RideShareAPITester:
+    """Tester driving the ASGI app directly on in-memory storage"""
+    import asyncio
     import os
-    backend_url = os.getenv("EXPO_PUBLIC_BACKEND_URL", "https://tripmate-92.preview.emergentagent.com")
+    import sys
+    os.environ.setdefault("STORAGE_BACKEND", "memory")
+    os.environ.setdefault("DB_STATS_HEADER", "true")
+    os.environ.setdefault("ADMIN_TOKEN", "backend-test-admin")
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "backend_python"))
+    
+    import server
+    from fastapi.testclient import TestClient
     
-    print(f"🌐 Using backend URL: {backend_url}")
+    client = TestClient(server.app)
+    client.__enter__()  # Run startup handlers
     
-    tester = RideShareAPITester(backend_url)
+    def otp_lookup(phone: str) -> Optional[str]:
+        record = asyncio.run(server.otp_collection.find_one({"phone": phone}))
+        return record["otp"] if record else None
+    
+    print(f"🧪 Running in-process on {server.storage.backend} storage")
+    return RideShareAPITester(str(client.base_url), http=client, otp_lookup=otp_lookup,
+                              server=server, run=client.portal.call)
+
+def main():
+    """Main test runner"""
+    import sys
+    if "--in-process" in sys.argv:
+        tester = in_process_tester()
+    else:
+        # Get backend URL from environment or use default
+        import os
+        backend_url = os.getenv("EXPO_PUBLIC_BACKEND_URL", "https://tripmate-92.preview.emergentagent.com")
+        
+        print(f"🌐 Using backend URL: {backend_url}")
+        
+        tester = RideShareAPITester(backend_url)
     results = tester.run_all_tests()
     tester.print_summary(results)
     
@@ -0,0 +1,269 @@
+#!/usr/bin/env python3
+"""
+RideShare Worker Scaling Benchmark
+Throughput of the production server (backend_python/serve.py) by worker count
+
+For each worker count the server is started in a subprocess and seeded in the
+gunicorn master before the workers fork, so with STORAGE_BACKEND=memory (the
+default here) every worker serves the same rides. Load processes then drive
+the health and search endpoints in turn, and the server is stopped with
+SIGTERM. With STORAGE_BACKEND=mongo the seeded documents are removed again
+when the server exits.
+
+Load processes share the machine with the server, so keep cores free for
+them (e.g. --clients 2 measuring up to 6 workers on 8 cores); throughput can
+only scale up to the number of cores left to the server.
+
+Requires httpx in addition to the backend requirements.
+
+Examples:
+    python bench_workers.py --workers 1,2,4 --duration 10
+    python bench_workers.py --workers 1,2,4,8 --clients 4 --concurrency 128 --output scaling.json
+"""
+
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import random
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+from typing import List, Tuple
+
+import httpx
+
+BACKEND_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "backend_python")
+sys.path.insert(0, BACKEND_DIR)
+
+from load_test import CITIES, Seeder, jitter, percentile  # noqa: E402
+
+ENDPOINTS = ("health", "search")
+
+
+# ============== Server process ==============
+
+def serve(args):
+    """Seed storage, then run the production server (workers fork from here)"""
+    import serve as production
+    import server
+
+    seeder = Seeder(server, random.Random(args.seed), f"bench{os.getpid()}")
+
+    async def seed():
+        await seeder.seed(args.users, args.rides, 0, 0)
+
+    asyncio.run(seed())
+    # Workers must open their own connections
+    server.storage.close()
+    with open(args.token_file, "w") as f:
+        f.write(seeder.passengers[0]["token"])
+
+    try:
+        production.RideShareServer(production.options_from_env(
+            workers=args.serve_workers, bind=f"127.0.0.1:{args.port}", accesslog=None
+        )).run()
+    finally:
+        asyncio.run(seeder.cleanup())
+
+
+def start_server(args, workers: int) -> Tuple[subprocess.Popen, str, str]:
+    """Start the server and wait until it answers; returns (process, base URL, passenger token)"""
+    port = free_port()
+    token_file = tempfile.NamedTemporaryFile(suffix=".token", delete=False).name
+    env = {
+        "ADMISSION_USER_RATE": "0",  # One passenger token drives all the load
+        **os.environ,
+        "STORAGE_BACKEND": os.getenv("STORAGE_BACKEND", "memory"),
+    }
+    command = [
+        sys.executable, os.path.abspath(__file__), "--serve",
+        "--serve-workers", str(workers), "--port", str(port), "--token-file", token_file,
+        "--users", str(args.users), "--rides", str(args.rides), "--seed", str(args.seed),
+    ]
+    process = subprocess.Popen(command, cwd=BACKEND_DIR, env=env,
+                               stdout=subprocess.DEVNULL, stderr=None if args.verbose else subprocess.DEVNULL)
+    base_url = f"http://127.0.0.1:{port}"
+    try:
+        deadline = time.monotonic() + args.startup_timeout
+        while time.monotonic() < deadline:
+            if process.poll() is not None:
+                raise SystemExit(f"Server with {workers} workers exited during startup")
+            try:
+                if httpx.get(f"{base_url}/api/health", timeout=1).status_code == 200 and os.path.getsize(token_file):
+                    with open(token_file) as f:
+                        return process, base_url, f.read()
+            except httpx.HTTPError:
+                pass
+            time.sleep(0.25)
+        process.kill()
+        raise SystemExit(f"Server with {workers} workers did not start in {args.startup_timeout}s")
+    finally:
+        os.unlink(token_file)
+
+
+def stop_server(process: subprocess.Popen, timeout: float = 60) -> float:
+    """SIGTERM the master and wait for the drain; returns seconds taken"""
+    started = time.monotonic()
+    process.send_signal(signal.SIGTERM)
+    try:
+        process.wait(timeout)
+    except subprocess.TimeoutExpired:
+        process.kill()
+    return time.monotonic() - started
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+# ============== Load processes ==============
+
+def drive(base_url: str, endpoint: str, token: str, concurrency: int, duration: float,
+          seed: int) -> Tuple[List[float], int]:
+    """One load process: closed-loop users for duration seconds; returns (latencies ms, errors)"""
+    return asyncio.run(_drive(base_url, endpoint, token, concurrency, duration, random.Random(seed)))
+
+
+async def _drive(base_url, endpoint, token, concurrency, duration, rng):
+    latencies: List[float] = []
+    errors = 0
+    headers = {"Authorization": f"Bearer {token}"}
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+
+    def search_body():
+        pickup = jitter(rng, CITIES[rng.choice(list(CITIES))])
+        drop = jitter(rng, CITIES[rng.choice(list(CITIES))])
+        return {
+            "pickup_lat": pickup[0], "pickup_lng": pickup[1], "drop_lat": drop[0], "drop_lng": drop[1],
+            "date": (datetime.utcnow() + timedelta(days=rng.randint(0, 6))).strftime("%Y-%m-%d"),
+            "seats_needed": 1,
+        }
+
+    async with httpx.AsyncClient(base_url=base_url, headers=headers, limits=limits, timeout=30) as http:
+        async def user(deadline: float):
+            nonlocal errors
+            while time.perf_counter() < deadline:
+                start = time.perf_counter()
+                try:
+                    if endpoint == "health":
+                        response = await http.get("/api/health")
+                    else:
+                        response = await http.post("/api/rides/search", json=search_body())
+                    ok = response.status_code == 200
+                except httpx.HTTPError:
+                    ok = False
+                latencies.append((time.perf_counter() - start) * 1000)
+                errors += not ok
+
+        deadline = time.perf_counter() + duration
+        await asyncio.gather(*(user(deadline) for _ in range(concurrency)))
+    return latencies, errors
+
+
+def measure(pool, args, base_url: str, endpoint: str, token: str) -> dict:
+    per_client = max(args.concurrency // args.clients, 1)
+    if args.warmup:
+        pool.starmap(drive, [(base_url, endpoint, token, per_client, args.warmup, i) for i in range(args.clients)])
+    started = time.perf_counter()
+    results = pool.starmap(
+        drive, [(base_url, endpoint, token, per_client, args.duration, args.seed + i) for i in range(args.clients)]
+    )
+    elapsed = time.perf_counter() - started
+    latencies = sorted(l for result in results for l in result[0])
+    return {
+        "requests": len(latencies),
+        "errors": sum(result[1] for result in results),
+        "throughput_rps": round(len(latencies) / elapsed, 1),
+        "latency_ms": {
+            "p50": round(percentile(latencies, 50), 2),
+            "p95": round(percentile(latencies, 95), 2),
+            "p99": round(percentile(latencies, 99), 2),
+        },
+    }
+
+
+def benchmark(args) -> dict:
+    worker_counts = [int(n) for n in args.workers.split(",")]
+    runs = []
+    with multiprocessing.get_context("spawn").Pool(args.clients) as pool:
+        for workers in worker_counts:
+            print(f"🚀 {workers} worker(s)", file=sys.stderr)
+            process, base_url, token = start_server(args, workers)
+            try:
+                for endpoint in ENDPOINTS:
+                    result = measure(pool, args, base_url, endpoint, token)
+                    runs.append({"workers": workers, "endpoint": endpoint, **result})
+                    print(f"   {endpoint:<7} {result['throughput_rps']:>9.1f} req/s  "
+                          f"p50 {result['latency_ms']['p50']:.1f} ms  p99 {result['latency_ms']['p99']:.1f} ms  "
+                          f"errors {result['errors']}", file=sys.stderr)
+            finally:
+                drain = stop_server(process)
+                print(f"   stopped in {drain:.1f}s", file=sys.stderr)
+
+    # Speedup over the smallest worker count measured
+    for endpoint in ENDPOINTS:
+        endpoint_runs = [r for r in runs if r["endpoint"] == endpoint]
+        baseline = endpoint_runs[0]["throughput_rps"] or 1
+        for run in endpoint_runs:
+            run["speedup"] = round(run["throughput_rps"] / baseline, 2)
+
+    return {
+        "started_at": datetime.utcnow().isoformat(),
+        "cpu_count": os.cpu_count(),
+        "storage_backend": os.getenv("STORAGE_BACKEND", "memory"),
+        "config": {
+            "clients": args.clients,
+            "concurrency": args.concurrency,
+            "duration_s": args.duration,
+            "warmup_s": args.warmup,
+            "users": args.users,
+            "rides": args.rides,
+        },
+        "runs": runs,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="RideShare worker scaling benchmark")
+    parser.add_argument("--workers", default="1,2,4", help="Comma-separated worker counts to measure")
+    parser.add_argument("--clients", type=int, default=2, help="Load generator processes")
+    parser.add_argument("--concurrency", type=int, default=64, help="Concurrent requests across all clients")
+    parser.add_argument("--duration", type=float, default=10.0, help="Seconds measured per endpoint")
+    parser.add_argument("--warmup", type=float, default=2.0, help="Unmeasured seconds per endpoint first")
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--rides", type=int, default=2000)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--startup-timeout", type=float, default=60.0)
+    parser.add_argument("--output", help="Write the JSON report here instead of stdout")
+    parser.add_argument("--verbose", action="store_true", help="Show the server's log")
+    # Internal: run as the server process
+    parser.add_argument("--serve", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--serve-workers", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--port", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--token-file", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(args)
+        return
+
+    report = benchmark(args)
+    payload = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(payload + "\n")
+        print(f"📄 Report written to {args.output}", file=sys.stderr)
+    else:
+        print(payload)
+
+
+if __name__ == "__main__":
+    main()
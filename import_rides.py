@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+"""
+RideShare Ride Import
+Streams an NDJSON or CSV file of rides to POST /api/rides/import
+
+Rows use the fields of POST /api/rides (pickup_location, pickup_lat, ...,
+date, time, available_seats, price_per_seat, ...); CSV files need a header
+row. The file is sent with chunked transfer encoding, so it is never loaded
+into memory on either side. Rides are published for the driver owning the
+token.
+
+Examples:
+    python import_rides.py rides.ndjson --base-url http://localhost:8001 --token $TOKEN
+    python import_rides.py fleet.csv --base-url http://localhost:8001 --token $TOKEN --ordered
+    cat rides.ndjson | python import_rides.py - --format ndjson --base-url ... --token ... --dry-run
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+CONTENT_TYPES = {"ndjson": "application/x-ndjson", "csv": "text/csv"}
+
+
+def read_chunks(stream, chunk_size: int):
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            return
+        yield chunk
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Bulk import rides into RideShare")
+    parser.add_argument("file", help="NDJSON or CSV file, or - for stdin")
+    parser.add_argument("--base-url", default=os.getenv("EXPO_PUBLIC_BACKEND_URL", "http://localhost:8001"))
+    parser.add_argument("--token", default=os.getenv("RIDESHARE_TOKEN"), help="Driver access token")
+    parser.add_argument("--format", choices=sorted(CONTENT_TYPES), help="Defaults to the file extension")
+    parser.add_argument("--ordered", action="store_true", help="Stop at the first bad row")
+    parser.add_argument("--dry-run", action="store_true", help="Validate only, insert nothing")
+    parser.add_argument("--chunk-size", type=int, default=64 * 1024)
+    parser.add_argument("--timeout", type=float, default=600.0)
+    args = parser.parse_args()
+
+    if not args.token:
+        parser.error("--token or RIDESHARE_TOKEN is required")
+    fmt = args.format or ("csv" if args.file.lower().endswith(".csv") else "ndjson")
+
+    query = urllib.parse.urlencode({
+        "format": fmt,
+        "ordered": str(args.ordered).lower(),
+        "dry_run": str(args.dry_run).lower(),
+    })
+    url = f"{args.base_url.rstrip('/')}/api/rides/import?{query}"
+    stream = sys.stdin.buffer if args.file == "-" else open(args.file, "rb")
+    request = urllib.request.Request(
+        url,
+        data=read_chunks(stream, args.chunk_size),
+        headers={"Authorization": f"Bearer {args.token}", "Content-Type": CONTENT_TYPES[fmt]},
+        method="POST",
+    )
+
+    started = time.perf_counter()
+    try:
+        with urllib.request.urlopen(request, timeout=args.timeout) as response:
+            report = json.load(response)
+    except urllib.error.HTTPError as e:
+        print(f"❌ Import failed: HTTP {e.code} {e.read().decode(errors='replace')}")
+        sys.exit(2)
+    finally:
+        stream.close()
+    elapsed = time.perf_counter() - started
+
+    for error in report["errors"]:
+        print(f"line {error['line']}: {error['error']}")
+    print(
+        f"{'✅' if not report['failed'] else '⚠️'} import {report['import_id']}: "
+        f"{report['rows']} rows, {report['valid']} valid, {report['inserted']} inserted, "
+        f"{report['failed']} failed in {elapsed:.1f}s ({report['rows'] / max(elapsed, 1e-9) * 60:,.0f} rows/min)"
+    )
+    if not report["completed"]:
+        print("⚠️ Import stopped early (ordered mode)")
+    if report["failed"] > len(report["errors"]):
+        print(f"⚠️ {report['failed'] - len(report['errors'])} more errors not shown")
+    sys.exit(1 if report["failed"] else 0)
+
+
+if __name__ == "__main__":
+    main()
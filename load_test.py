@@ -0,0 +1,511 @@
+#!/usr/bin/env python3
+"""
+RideShare Backend Load Testing Suite
+Seeds realistic data and runs scenario mixes, reporting latency per endpoint
+
+Runs either in-process against the ASGI app (--in-process) or against a
+running server (--base-url). Seeding writes straight to the backend's
+storage using its MONGO_URL / DB_NAME / SECRET_KEY, so a remote server must
+share the same database and secret (e.g. a local mongod). In-process runs
+with STORAGE_BACKEND=memory need no database at all.
+
+Requires httpx in addition to the backend requirements.
+
+Examples:
+    STORAGE_BACKEND=memory python load_test.py --in-process --scenario commute_peak --duration 30
+    python load_test.py --base-url http://localhost:8001 --scenario booking_rush \\
+        --users 200 --concurrency 100 --output run.json --slo p95=250
+"""
+
+import argparse
+import asyncio
+import json
+import math
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional
+
+import httpx
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "backend_python"))
+
+# City centers rides are spread around (lat, lng)
+CITIES = {
+    "New York": (40.7128, -74.0060),
+    "Boston": (42.3601, -71.0589),
+    "Philadelphia": (39.9526, -75.1652),
+    "Washington": (38.9072, -77.0369),
+    "Baltimore": (39.2904, -76.6122),
+    "Hartford": (41.7658, -72.6734),
+}
+
+# Operation weights per scenario; override with --mix op=weight,...
+SCENARIOS = {
+    "commute_peak": {"search": 70, "get_ride": 15, "list_rides": 10, "my_bookings": 5},
+    "booking_rush": {"book_hot_ride": 60, "poll_hot_ride": 30, "accept_hot_booking": 10},
+    "chat_polling": {"poll_chat": 85, "send_message": 15},
+    "mixed": {
+        "search": 40, "get_ride": 15, "list_rides": 5, "my_bookings": 5,
+        "book_hot_ride": 10, "poll_chat": 20, "send_message": 5,
+    },
+}
+
+
+def percentile(sorted_values: List[float], pct: float) -> float:
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return 0.0
+    rank = max(math.ceil(pct / 100 * len(sorted_values)), 1)
+    return sorted_values[rank - 1]
+
+
+def jitter(rng: random.Random, center, spread_km: float = 15.0):
+    """Random point within roughly spread_km of a city center"""
+    spread = spread_km / 111.0
+    return (
+        round(center[0] + rng.uniform(-spread, spread), 6),
+        round(center[1] + rng.uniform(-spread, spread), 6),
+    )
+
+
+class Stats:
+    """Latency samples and error counts per endpoint"""
+
+    def __init__(self):
+        self.samples: Dict[str, List[float]] = {}
+        self.errors: Dict[str, int] = {}
+        self.client_errors: Dict[str, int] = {}
+
+    def record(self, endpoint: str, latency_ms: float, status_code: int):
+        self.samples.setdefault(endpoint, []).append(latency_ms)
+        if status_code == 0 or status_code >= 500:
+            self.errors[endpoint] = self.errors.get(endpoint, 0) + 1
+        elif status_code >= 400:
+            self.client_errors[endpoint] = self.client_errors.get(endpoint, 0) + 1
+
+    def report(self, elapsed: float) -> dict:
+        endpoints = {}
+        total = 0
+        total_errors = 0
+        for endpoint, samples in sorted(self.samples.items()):
+            samples.sort()
+            count = len(samples)
+            errors = self.errors.get(endpoint, 0)
+            total += count
+            total_errors += errors
+            endpoints[endpoint] = {
+                "count": count,
+                "errors": errors,
+                "client_errors": self.client_errors.get(endpoint, 0),
+                "error_rate": round(errors / count, 4),
+                "throughput_rps": round(count / elapsed, 2),
+                "latency_ms": {
+                    "p50": round(percentile(samples, 50), 2),
+                    "p95": round(percentile(samples, 95), 2),
+                    "p99": round(percentile(samples, 99), 2),
+                    "mean": round(sum(samples) / count, 2),
+                    "max": round(samples[-1], 2),
+                },
+            }
+        return {
+            "totals": {
+                "requests": total,
+                "errors": total_errors,
+                "error_rate": round(total_errors / total, 4) if total else 0.0,
+                "throughput_rps": round(total / elapsed, 2),
+            },
+            "endpoints": endpoints,
+        }
+
+
+class Seeder:
+    """Bulk-inserts users, rides, bookings and chats for a run"""
+
+    def __init__(self, server, rng: random.Random, run_tag: str):
+        self.server = server
+        self.rng = rng
+        self.run_tag = run_tag
+        self.drivers: List[dict] = []
+        self.passengers: List[dict] = []
+        self.ride_ids: List[str] = []
+        self.hot_ride_id: Optional[str] = None
+        self.hot_driver_token: Optional[str] = None
+        self.chat_bookings: List[dict] = []
+
+    async def seed(self, users: int, rides: int, bookings: int, messages: int):
+        server = self.server
+        now = datetime.utcnow()
+        n_drivers = max(users // 4, 1)
+
+        user_docs = []
+        for i in range(users):
+            user_docs.append({
+                "phone": f"+9{self.run_tag}{i:06d}",
+                "name": f"Load {'Driver' if i < n_drivers else 'Passenger'} {i}",
+                "photo": None,
+                "car_model": "Toyota Prius" if i < n_drivers else None,
+                "car_number": f"LT{i:05d}" if i < n_drivers else None,
+                "rating": round(self.rng.uniform(3.5, 5.0), 1),
+                "total_ratings": self.rng.randint(0, 50),
+                "total_rides_as_driver": 0,
+                "total_rides_as_passenger": 0,
+                "load_test_run": self.run_tag,
+                "created_at": now,
+                "updated_at": now,
+            })
+        result = await server.users_collection.insert_many(user_docs)
+        for doc, inserted_id in zip(user_docs, result.inserted_ids):
+            user = {
+                "id": str(inserted_id),
+                "name": doc["name"],
+                "token": server.create_access_token(str(inserted_id)),
+            }
+            (self.drivers if len(self.drivers) < n_drivers else self.passengers).append(user)
+        if not self.passengers:
+            self.passengers = self.drivers
+
+        city_names = list(CITIES)
+        ride_docs = []
+        for i in range(rides):
+            driver = self.rng.choice(self.drivers)
+            origin, destination = self.rng.sample(city_names, 2)
+            pickup = jitter(self.rng, CITIES[origin])
+            drop = jitter(self.rng, CITIES[destination])
+            ride_docs.append({
+                "pickup_location": f"{origin} #{i}",
+                "pickup_lat": pickup[0],
+                "pickup_lng": pickup[1],
+                "drop_location": f"{destination} #{i}",
+                "drop_lat": drop[0],
+                "drop_lng": drop[1],
+                "date": (now + timedelta(days=self.rng.randint(0, 6))).strftime("%Y-%m-%d"),
+                "time": f"{self.rng.choice([6, 7, 8, 9, 16, 17, 18]):02d}:{self.rng.choice([0, 15, 30, 45]):02d}",
+                "available_seats": self.rng.randint(2, 6),
+                "price_per_seat": round(self.rng.uniform(5, 60), 2),
+                "car_model": "Toyota Prius",
+                "car_number": None,
+                "notes": None,
+                "driver_id": driver["id"],
+                "driver_name": driver["name"],
+                "driver_photo": None,
+                "driver_rating": 4.5,
+                "status": "active",
+                "booked_seats": 0,
+                "load_test_run": self.run_tag,
+                "created_at": now,
+                "updated_at": now,
+            })
+        # The booking rush targets one large ride
+        ride_docs[0]["available_seats"] = 8
+        result = await server.rides_collection.insert_many(ride_docs)
+        self.ride_ids = [str(i) for i in result.inserted_ids]
+        self.hot_ride_id = self.ride_ids[0]
+        self.hot_driver_token = next(d["token"] for d in self.drivers if d["id"] == ride_docs[0]["driver_id"])
+
+        booking_docs = []
+        for _ in range(bookings):
+            idx = self.rng.randrange(1, len(ride_docs)) if len(ride_docs) > 1 else 0
+            ride = ride_docs[idx]
+            passenger = self.rng.choice(self.passengers)
+            booking_docs.append({
+                "ride_id": self.ride_ids[idx],
+                "passenger_id": passenger["id"],
+                "passenger_name": passenger["name"],
+                "passenger_photo": None,
+                "driver_id": ride["driver_id"],
+                "seats": 1,
+                "message": None,
+                "total_price": ride["price_per_seat"],
+                "status": self.rng.choice(["pending", "accepted"]),
+                "pickup_location": ride["pickup_location"],
+                "drop_location": ride["drop_location"],
+                "date": ride["date"],
+                "time": ride["time"],
+                "load_test_run": self.run_tag,
+                "created_at": now,
+                "updated_at": now,
+            })
+        if booking_docs:
+            result = await server.bookings_collection.insert_many(booking_docs)
+            tokens = {u["id"]: u["token"] for u in self.drivers + self.passengers}
+            for doc, inserted_id in zip(booking_docs, result.inserted_ids):
+                self.chat_bookings.append({
+                    "id": str(inserted_id),
+                    "passenger_token": tokens[doc["passenger_id"]],
+                    "driver_token": tokens[doc["driver_id"]],
+                    "passenger_id": doc["passenger_id"],
+                    "driver_id": doc["driver_id"],
+                })
+
+        chat_docs = []
+        for i in range(messages if self.chat_bookings else 0):
+            booking = self.rng.choice(self.chat_bookings)
+            from_passenger = i % 2 == 0
+            chat_docs.append({
+                "booking_id": booking["id"],
+                "request_id": None,
+                "sender_id": booking["passenger_id"] if from_passenger else booking["driver_id"],
+                "sender_name": "Load",
+                "receiver_id": booking["driver_id"] if from_passenger else booking["passenger_id"],
+                "content": f"Seeded message {i}",
+                "read": self.rng.random() < 0.7,
+                "load_test_run": self.run_tag,
+                "created_at": now + timedelta(milliseconds=i),
+            })
+        if chat_docs:
+            await server.chats_collection.insert_many(chat_docs)
+
+    async def cleanup(self):
+        query = {"load_test_run": self.run_tag}
+        for collection in (
+            self.server.users_collection,
+            self.server.rides_collection,
+            self.server.bookings_collection,
+            self.server.chats_collection,
+        ):
+            await collection.delete_many(query)
+        # Documents created through the API during the run
+        user_ids = [u["id"] for u in self.drivers + self.passengers]
+        await self.server.bookings_collection.delete_many({"passenger_id": {"$in": user_ids}})
+        await self.server.chats_collection.delete_many({"sender_id": {"$in": user_ids}})
+
+
+class LoadRunner:
+    """Closed-loop virtual users issuing a weighted mix of operations"""
+
+    def __init__(self, http: httpx.AsyncClient, seeder: Seeder, mix: Dict[str, int], rng: random.Random):
+        self.http = http
+        self.seeder = seeder
+        self.rng = rng
+        self.ops = [getattr(self, f"op_{name}") for name in mix]
+        self.weights = list(mix.values())
+        self.stats = Stats()
+        self.hot_bookings: List[str] = []
+
+    async def call(self, endpoint: str, method: str, path: str, token: str, body: dict = None):
+        headers = {"Authorization": f"Bearer {token}"}
+        start = time.perf_counter()
+        try:
+            response = await self.http.request(method, path, json=body, headers=headers)
+            status_code = response.status_code
+        except httpx.HTTPError:
+            response = None
+            status_code = 0
+        self.stats.record(endpoint, (time.perf_counter() - start) * 1000, status_code)
+        return response
+
+    async def virtual_user(self, deadline: float, think_time: float):
+        while time.perf_counter() < deadline:
+            op = self.rng.choices(self.ops, weights=self.weights)[0]
+            await op()
+            if think_time:
+                await asyncio.sleep(self.rng.uniform(0, think_time * 2))
+
+    async def run(self, concurrency: int, duration: float, think_time: float) -> dict:
+        deadline = time.perf_counter() + duration
+        start = time.perf_counter()
+        await asyncio.gather(*(self.virtual_user(deadline, think_time) for _ in range(concurrency)))
+        return self.stats.report(time.perf_counter() - start)
+
+    # ---- operations ----
+
+    def passenger(self):
+        return self.rng.choice(self.seeder.passengers)
+
+    async def op_search(self):
+        center = CITIES[self.rng.choice(list(CITIES))]
+        pickup = jitter(self.rng, center)
+        drop = jitter(self.rng, CITIES[self.rng.choice(list(CITIES))])
+        body = {
+            "pickup_lat": pickup[0], "pickup_lng": pickup[1],
+            "drop_lat": drop[0], "drop_lng": drop[1],
+            "date": (datetime.utcnow() + timedelta(days=self.rng.randint(0, 6))).strftime("%Y-%m-%d"),
+            "seats_needed": self.rng.randint(1, 2),
+        }
+        await self.call("POST /api/rides/search", "POST", "/api/rides/search", self.passenger()["token"], body)
+
+    async def op_get_ride(self):
+        ride_id = self.rng.choice(self.seeder.ride_ids)
+        await self.call("GET /api/rides/{ride_id}", "GET", f"/api/rides/{ride_id}", self.passenger()["token"])
+
+    async def op_list_rides(self):
+        await self.call("GET /api/rides", "GET", "/api/rides", self.passenger()["token"])
+
+    async def op_my_bookings(self):
+        await self.call("GET /api/bookings", "GET", "/api/bookings", self.passenger()["token"])
+
+    async def op_book_hot_ride(self):
+        body = {"ride_id": self.seeder.hot_ride_id, "seats": 1}
+        response = await self.call("POST /api/bookings", "POST", "/api/bookings", self.passenger()["token"], body)
+        if response is not None and response.status_code == 200:
+            self.hot_bookings.append(response.json()["id"])
+
+    async def op_poll_hot_ride(self):
+        ride_id = self.seeder.hot_ride_id
+        await self.call("GET /api/rides/{ride_id}", "GET", f"/api/rides/{ride_id}", self.passenger()["token"])
+
+    async def op_accept_hot_booking(self):
+        if not self.hot_bookings:
+            return await self.op_poll_hot_ride()
+        booking_id = self.hot_bookings.pop(self.rng.randrange(len(self.hot_bookings)))
+        await self.call(
+            "PUT /api/bookings/{booking_id}/status", "PUT", f"/api/bookings/{booking_id}/status",
+            self.seeder.hot_driver_token, {"status": "accepted"},
+        )
+
+    async def op_poll_chat(self):
+        if not self.seeder.chat_bookings:
+            return
+        booking = self.rng.choice(self.seeder.chat_bookings)
+        token = booking["passenger_token"] if self.rng.random() < 0.5 else booking["driver_token"]
+        await self.call(
+            "GET /api/chats/{context_type}/{context_id}", "GET", f"/api/chats/booking/{booking['id']}", token
+        )
+
+    async def op_send_message(self):
+        if not self.seeder.chat_bookings:
+            return
+        booking = self.rng.choice(self.seeder.chat_bookings)
+        body = {"content": "On my way", "booking_id": booking["id"]}
+        await self.call("POST /api/chats/message", "POST", "/api/chats/message", booking["passenger_token"], body)
+
+
+def parse_mix(value: str) -> Dict[str, int]:
+    mix = {}
+    for part in value.split(","):
+        name, _, weight = part.partition("=")
+        mix[name.strip()] = int(weight or 1)
+    return mix
+
+
+def check_slos(report: dict, slos: List[str]) -> List[str]:
+    """Evaluate "p95=200" (all endpoints) or "POST /api/rides/search:p99=400" SLOs"""
+    violations = []
+    for slo in slos:
+        target, _, limit = slo.rpartition("=")
+        endpoint, _, metric = target.rpartition(":")
+        for name, data in report["endpoints"].items():
+            if endpoint and name != endpoint:
+                continue
+            if metric == "error_rate":
+                value = data["error_rate"]
+            else:
+                value = data["latency_ms"][metric]
+            if value > float(limit):
+                violations.append(f"{name} {metric}={value} > {limit}")
+    return violations
+
+
+async def main_async(args) -> dict:
+    # A few seeded users send far more than real clients; don't throttle them per user
+    os.environ.setdefault("ADMISSION_USER_RATE", "0")
+    import server
+
+    rng = random.Random(args.seed)
+    run_tag = f"{args.seed:04d}{int(time.time()) % 100000:05d}"
+    mix = parse_mix(args.mix) if args.mix else SCENARIOS[args.scenario]
+    unknown = [name for name in mix if not hasattr(LoadRunner, f"op_{name}")]
+    if unknown:
+        raise SystemExit(f"Unknown operations in mix: {', '.join(unknown)}")
+
+    if args.in_process:
+        lifespan = server.app.router.lifespan_context(server.app)
+        await lifespan.__aenter__()
+        transport = httpx.ASGITransport(app=server.app)
+        base_url = "http://rideshare.local"
+    else:
+        lifespan = None
+        transport = None
+        base_url = args.base_url.rstrip("/")
+
+    seeder = Seeder(server, rng, run_tag)
+    print(f"🌱 Seeding {args.users} users, {args.rides} rides, {args.bookings} bookings, "
+          f"{args.messages} messages", file=sys.stderr)
+    await seeder.seed(args.users, args.rides, args.bookings, args.messages)
+
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    try:
+        async with httpx.AsyncClient(
+            base_url=base_url, transport=transport, limits=limits, timeout=args.timeout
+        ) as http:
+            runner = LoadRunner(http, seeder, mix, rng)
+
+            if args.warmup:
+                print(f"🔥 Warming up for {args.warmup}s", file=sys.stderr)
+                await runner.run(args.concurrency, args.warmup, args.think_time)
+                runner.stats = Stats()
+
+            print(f"🚀 Running '{args.scenario if not args.mix else args.mix}' with {args.concurrency} "
+                  f"virtual users for {args.duration}s", file=sys.stderr)
+            result = await runner.run(args.concurrency, args.duration, args.think_time)
+    finally:
+        if not args.keep_data:
+            await seeder.cleanup()
+        if lifespan is not None:
+            await lifespan.__aexit__(None, None, None)
+
+    report = {
+        "scenario": args.scenario if not args.mix else "custom",
+        "mix": mix,
+        "mode": "in-process" if args.in_process else base_url,
+        "config": {
+            "seed": args.seed,
+            "users": args.users,
+            "rides": args.rides,
+            "bookings": args.bookings,
+            "messages": args.messages,
+            "concurrency": args.concurrency,
+            "duration_s": args.duration,
+            "think_time_s": args.think_time,
+        },
+        "started_at": datetime.utcnow().isoformat(),
+        **result,
+    }
+    violations = check_slos(report, args.slo)
+    report["slo"] = {"targets": args.slo, "violations": violations, "passed": not violations}
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="RideShare backend load test")
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument("--in-process", action="store_true", help="Drive the ASGI app in this process")
+    target.add_argument("--base-url", help="Drive a running server, e.g. http://localhost:8001")
+    parser.add_argument("--scenario", choices=sorted(SCENARIOS), default="mixed")
+    parser.add_argument("--mix", help="Custom operation weights, e.g. search=8,get_ride=2")
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--rides", type=int, default=2000)
+    parser.add_argument("--bookings", type=int, default=1000)
+    parser.add_argument("--messages", type=int, default=5000)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--duration", type=float, default=30.0, help="Seconds of measured load")
+    parser.add_argument("--warmup", type=float, default=0.0, help="Seconds of unmeasured load first")
+    parser.add_argument("--think-time", type=float, default=0.0, help="Mean pause between requests per user")
+    parser.add_argument("--timeout", type=float, default=30.0)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--slo", action="append", default=[],
+                        help='Latency/error SLO, e.g. p95=200 or "POST /api/rides/search:p99=400"')
+    parser.add_argument("--output", help="Write the JSON report here instead of stdout")
+    parser.add_argument("--keep-data", action="store_true", help="Do not delete seeded data afterwards")
+    args = parser.parse_args()
+
+    report = asyncio.run(main_async(args))
+    payload = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(payload + "\n")
+        print(f"📄 Report written to {args.output}", file=sys.stderr)
+    else:
+        print(payload)
+
+    if report["slo"]["violations"]:
+        for violation in report["slo"]["violations"]:
+            print(f"❌ SLO violated: {violation}", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()